@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class AccountsConfig(AppConfig):
     name = 'accounts'
+
+    def ready(self):
+        # connects the invalidation of cached users to User saves
+        from accounts import signals  # noqa: F401
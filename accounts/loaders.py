@@ -0,0 +1,156 @@
+import time
+import typing
+import asyncio
+import collections
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from accounts.models import User
+from core import metrics
+from core.offload import get_pool
+
+
+def query_users(ids: typing.List) -> typing.Dict:
+    # on a thread of the db pool, its connection is reused like in core.async_db.db_orm
+    close_old_connections()
+    return User.objects.in_bulk(ids)
+
+
+class UserLoader:
+    """
+    Batched User lookups for async code. Ids requested by every coroutine during one loop tick
+    are fetched together with a single in_bulk query in the 'db' offload pool, results (None for
+    missing users) are cached for `ttl` seconds, at most `max_size` of them. Saving or deleting
+    a user drops it from the cache. Loaded users are shared, treat them as read only.
+
+    Invalidation is process local: a user saved by another process stays cached here until its
+    `ttl` runs out.
+    """
+    def __init__(self, ttl: float = 30, max_size: int = 10000, pool_name: typing.AnyStr = 'db'):
+        self.ttl: float = ttl
+        self.max_size: int = max_size
+        self.pool_name: typing.AnyStr = pool_name
+        # id -> (expires at, user), oldest first
+        self.cache: typing.OrderedDict = collections.OrderedDict()
+        # id -> future of the batch being collected
+        self.pending: typing.Dict[typing.Any, asyncio.Future] = {}
+        self.loop: typing.Optional[asyncio.AbstractEventLoop] = None
+        # bumped on every invalidation, a batch started before one is not cached
+        self.invalidations: int = 0
+
+        self.hits = metrics.counter('user_loader.hits')
+        self.batches = metrics.counter('user_loader.batches')
+        # fetched / batches is the mean batch size
+        self.fetched = metrics.counter('user_loader.fetched')
+
+    def get_cached(self, user_id) -> typing.Tuple[bool, typing.Optional[User]]:
+        entry = self.cache.get(user_id)
+        if entry is None:
+            return False, None
+        if entry[0] < time.monotonic():
+            del self.cache[user_id]
+            return False, None
+        return True, entry[1]
+
+    async def load(self, user_id) -> typing.Optional[User]:
+        found, user = self.get_cached(user_id)
+        if found:
+            self.hits.inc()
+            return user
+        loop = asyncio.get_event_loop()
+        if self.loop is not loop:
+            # futures of another loop cannot be awaited here
+            self.loop = loop
+            self.pending = {}
+        future = self.pending.get(user_id)
+        if future is None:
+            if not self.pending:
+                # runs once the coroutines ready in this tick had their turn to add ids
+                loop.call_soon(self.dispatch)
+            future = self.pending[user_id] = loop.create_future()
+        return await asyncio.shield(future)
+
+    async def load_many(self, user_ids: typing.Iterable) -> typing.Dict[typing.Any, User]:
+        """id -> user of the users found"""
+        user_ids = list(dict.fromkeys(user_ids))
+        users = await asyncio.gather(*(self.load(user_id) for user_id in user_ids))
+        return {user_id: user for user_id, user in zip(user_ids, users) if user is not None}
+
+    def dispatch(self):
+        batch, self.pending = self.pending, {}
+        if batch:
+            asyncio.ensure_future(self.fetch(batch))
+
+    async def fetch(self, batch: typing.Dict[typing.Any, asyncio.Future]):
+        self.batches.inc()
+        self.fetched.inc(len(batch))
+        invalidations = self.invalidations
+        users: typing.Optional[typing.Dict] = None
+        error: typing.Optional[Exception] = None
+        try:
+            users = await get_pool(self.pool_name).run(query_users, list(batch))
+            if invalidations == self.invalidations:
+                self.store(batch, users)
+        except Exception as e:
+            error = e
+        finally:
+            # waiters are released whatever happened, this task being cancelled included
+            for user_id, future in batch.items():
+                if future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                elif users is None:
+                    future.cancel()
+                else:
+                    future.set_result(users.get(user_id))
+
+    def store(self, batch: typing.Dict, users: typing.Dict):
+        expires_at = time.monotonic() + self.ttl
+        for user_id in batch:
+            self.cache[user_id] = (expires_at, users.get(user_id))
+            self.cache.move_to_end(user_id)
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+    def call_in_loop(self, callback: typing.Callable, *args):
+        """
+        run `callback` on the loop using the cache: model signals are sent by whichever thread
+        saved the user, e.g. a db pool thread or a sync view
+        """
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            # no loop uses the cache
+            return callback(*args)
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            return callback(*args)
+        loop.call_soon_threadsafe(callback, *args)
+
+    def drop(self, user_id):
+        self.invalidations += 1
+        self.cache.pop(user_id, None)
+
+    def drop_all(self):
+        self.invalidations += 1
+        self.cache.clear()
+
+    def invalidate(self, user_id):
+        """from any thread"""
+        self.call_in_loop(self.drop, user_id)
+
+    def clear(self):
+        """from any thread"""
+        self.call_in_loop(self.drop_all)
+
+
+def user_summary(user: User) -> typing.Dict:
+    """what other users may see of a user"""
+    return {'id': user.id, 'name': user.get_full_name() or user.username or f'user {user.id}'}
+
+
+user_loader = UserLoader(**settings.USER_LOADER)
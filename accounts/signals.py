@@ -0,0 +1,13 @@
+from django.db.models.signals import post_save
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from accounts.models import User
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user(sender, instance, **kwargs):
+    # imported on first use, loading the app does not pull in the loader and the pools it runs on
+    from accounts.loaders import user_loader
+    user_loader.invalidate(instance.pk)
@@ -1,3 +1,93 @@
-from django.test import TestCase
+import os
+import sys
+import asyncio
+import threading
+import subprocess
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.test import TransactionTestCase
+
+from accounts.models import User
+from accounts.loaders import UserLoader
+from accounts.loaders import user_loader
+from accounts.loaders import user_summary
+
+
+class UserLoaderTestCase(TransactionTestCase):
+    def setUp(self):
+        self.users = [
+            User.objects.create_user(email=f'user{i}@example.com', first_name=f'user{i}') for i in range(3)
+        ]
+        self.loader = UserLoader(ttl=30)
+
+    async def test_lookups_of_one_tick_are_batched(self):
+        batches = self.loader.batches.value
+        ids = [user.id for user in self.users]
+        users = await asyncio.gather(*(self.loader.load(user_id) for user_id in ids + [ids[0], -1]))
+        self.assertEqual([user.first_name for user in users[:4]], ['user0', 'user1', 'user2', 'user0'])
+        self.assertIsNone(users[4])
+        self.assertEqual(self.loader.batches.value - batches, 1)
+
+        # cached, missing users included
+        self.assertEqual(sorted(await self.loader.load_many(ids + [-1])), ids)
+        self.assertEqual(self.loader.batches.value - batches, 1)
+
+    async def test_expired_users_are_loaded_again(self):
+        self.loader.ttl = -1
+        batches = self.loader.batches.value
+        await self.loader.load(self.users[0].id)
+        await self.loader.load(self.users[0].id)
+        self.assertEqual(self.loader.batches.value - batches, 2)
+
+    async def test_invalidation_runs_on_the_loop(self):
+        user = self.users[0]
+        await self.loader.load(user.id)
+        threads = []
+        drop = self.loader.drop
+
+        def recording_drop(user_id):
+            threads.append(threading.current_thread())
+            drop(user_id)
+
+        self.loader.drop = recording_drop
+        # post_save of a user saved by another thread
+        await asyncio.get_running_loop().run_in_executor(None, self.loader.invalidate, user.id)
+        await asyncio.sleep(0)
+        self.assertEqual(threads, [threading.current_thread()])
+        self.assertNotIn(user.id, self.loader.cache)
+
+    async def test_cancelled_fetch_releases_waiters(self):
+        async def never_returns(*args):
+            await asyncio.Event().wait()
+
+        future = asyncio.get_running_loop().create_future()
+        with mock.patch('accounts.loaders.get_pool') as get_pool:
+            get_pool.return_value.run = never_returns
+            task = asyncio.ensure_future(self.loader.fetch({self.users[0].id: future}))
+            await asyncio.sleep(0)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+        self.assertTrue(future.cancelled())
+
+    def test_save_invalidates(self):
+        user = self.users[0]
+        self.assertEqual(async_to_sync(user_loader.load)(user.id).first_name, 'user0')
+        user.first_name = 'renamed'
+        user.save()
+        loaded = async_to_sync(user_loader.load)(user.id)
+        self.assertEqual(loaded.first_name, 'renamed')
+        self.assertEqual(user_summary(loaded), {'id': user.id, 'name': 'renamed'})
+        user.delete()
+        self.assertIsNone(async_to_sync(user_loader.load)(user.id))
+
+    def test_app_loading_leaves_the_loader_unimported(self):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='light.settings')
+        result = subprocess.run(
+            [sys.executable, '-c', 'import sys, django; django.setup(); '
+                                   'print(sorted(m for m in ("accounts.loaders", "core.offload") if m in sys.modules))'],
+            cwd=settings.BASE_DIR, env=env, capture_output=True, text=True, check=True,
+        )
+        self.assertEqual(result.stdout.strip(), '[]', 'the signal receiver should import the loader on first use')
@@ -1,29 +1,57 @@
+import re
 import asyncio
 import copy
 import collections
+import logging
 import functools
-import json
 from channels.consumer import get_handler_name
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
 
+from core.wire import WireFormatMixin
+from core.wire import new_payload_id
+from core.timer_wheel import timer_wheel
+from core.timer_wheel import ConnectionTimersMixin
+from core.presence import presence
+from core.presence import get_presence_user
+from core.lanes import PriorityLanesMixin
+from core.lanes import user_group
+from core.dedup import message_deduplicator
+from core.drain import DrainMixin
+from core.offload import OffloadHandlersMixin
+from core.ratelimit import get_rate_limiter
+from core.ratelimit import rate_limit_user_key
+from chat.history import room_history
+from accounts.loaders import user_loader
+from accounts.loaders import user_summary
 
-class ChatConsumer(AsyncWebsocketConsumer):
+logger = logging.getLogger(__name__)
+
+
+class ChatConsumer(OffloadHandlersMixin, DrainMixin, PriorityLanesMixin, ConnectionTimersMixin, WireFormatMixin,
+                   AsyncWebsocketConsumer):
     MAX_ACTIVE_TASKS = 2
+    MAX_MESSAGE_ID_LENGTH = 64
 
     def __init__(self, *args, **kwargs):
         super(ChatConsumer, self).__init__(*args, **kwargs)
         self.handler_tasks = collections.defaultdict(list)
+        # periodic timers started by handlers, count against MAX_ACTIVE_TASKS like tasks do
+        self.handler_timers = collections.defaultdict(set)
+        # the same timers by group, stopped when the group is left
+        self.group_timers = collections.defaultdict(set)
         self.joined_groups = set()
 
         self.room_name = None
         self.room_group_name = None
+        # user id tracked by presence, None for anonymous connections
+        self.presence_user = None
 
     def complete_task(self, task_instance, handler_name):
-        print(f'Complete task for handler {handler_name}, task instance {task_instance}')
         self.handler_tasks[handler_name].remove(task_instance)
-        print(
-            f'There are still {len(self.handler_tasks[handler_name])} active tasks for'
-            f' handler {handler_name}'
+        logger.debug(
+            'completed task %s of handler %s, %d still active',
+            task_instance, handler_name, len(self.handler_tasks[handler_name])
         )
 
     async def dispatch(self, message):
@@ -33,10 +61,11 @@ class ChatConsumer(AsyncWebsocketConsumer):
             if handler_name.startswith('chat_'):
                 # Create a task to process message
                 loop = asyncio.get_event_loop()
-                if len(self.handler_tasks[handler_name]) >= self.MAX_ACTIVE_TASKS:
-                    await self.send(text_data=json.dumps({
+                active = len(self.handler_tasks[handler_name]) + len(self.handler_timers[handler_name])
+                if active >= self.MAX_ACTIVE_TASKS:
+                    await self.send_payload({
                         'message': 'MAX_ACTIVE_TASKS reached'
-                    }))
+                    })
                 else:
                     handler_task = loop.create_task(handler(message))
                     # don't forget to remove the task from self.handler_tasks
@@ -45,6 +74,9 @@ class ChatConsumer(AsyncWebsocketConsumer):
                         functools.partial(self.complete_task, handler_name=handler_name)
                     )
                     self.handler_tasks[handler_name].append(handler_task)
+            elif self.is_offloaded(handler_name):
+                # runs in the offload pool, the event loop goes on meanwhile
+                await self.dispatch_offloaded(handler_name, message)
             else:
                 # The old way to process message
                 await handler(message)
@@ -52,72 +84,245 @@ class ChatConsumer(AsyncWebsocketConsumer):
             raise ValueError("No handler for message type %s" % message["type"])
 
     async def clear_handler_tasks(self):
-        for handler_name in self.handler_tasks:
-            task_instances = self.handler_tasks[handler_name]
-            for task_instance in task_instances:
-                task_instance.cancel()
-                # try:
-                #     await task_instance
-                # except asyncio.CancelledError:
-                #     print('Cancelled handler task', task_instance)
+        task_instances = self.drain_tasks()
+        for task_instance in task_instances:
+            task_instance.cancel()
+        # wait for the cancelled handlers to unwind, nothing they hold outlives the connection
+        await asyncio.gather(*task_instances, return_exceptions=True)
+
+    def drain_tasks(self):
+        return [task for tasks in self.handler_tasks.values() for task in tasks]
+
+    async def send_reconnect(self, delay):
+        await self.send_payload({'reconnect': {'delay': delay}})
 
     async def disconnect(self, code):
+        self.drain_unregister()
         joined_groups = copy.copy(self.joined_groups)
         for group_name in joined_groups:
             await self.leave_group(group_name)
         self.joined_groups.clear()
+        if self.presence_user is not None:
+            await presence.disconnect(self.presence_user)
+            self.presence_user = None
         await self.clear_handler_tasks()
+        self.cancel_timers()
+        self.handler_timers.clear()
+        self.group_timers.clear()
+        await self.close_lanes()
 
     async def leave_group(self, group_name):
-        await self.channel_layer.group_discard(
-            group_name, self.channel_name
-        )
+        await self.lane_group_discard(group_name)
         self.joined_groups.remove(group_name)
+        for timer in self.group_timers.pop(group_name, ()):
+            self.cancel_timer(timer)
+            for timers in self.handler_timers.values():
+                timers.discard(timer)
+        if self.presence_user is not None:
+            await presence.leave(self.presence_user, group_name)
 
     async def join_group(self, group_name):
-        await self.channel_layer.group_add(
-            group_name, self.channel_name
-        )
+        await self.lane_group_add(group_name)
         self.joined_groups.add(group_name)
+        if self.presence_user is not None:
+            await presence.join(self.presence_user, group_name)
 
     async def connect(self):
+        self.presence_user = get_presence_user(self.scope)
+        if self.presence_user is not None:
+            await presence.connect(self.presence_user)
+            # the user's connections are closed at once when its access is revoked
+            await self.control_group_add(user_group(self.presence_user))
         self.room_name = self.scope['url_route']['kwargs']['room_name']
         self.room_group_name = f'chat_{self.room_name}'
 
         await self.join_group(self.room_group_name)
-        await self.accept()
+        await self.accept_with_wire_format()
+        self.drain_register()
+        self.start_heartbeat()
+        await self.replay_history(self.room_group_name)
+
+    async def send_room_payload(self, group_name, payload, payload_id=None):
+        """send a payload concerning a room, one room per connection needs no tagging"""
+        await self.send_payload(payload, payload_id=payload_id)
+
+    async def replay_history(self, group_name):
+        entries = await room_history.recent(group_name)
+        if entries:
+            await self.send_room_payload(group_name, {
+                'history': entries,
+                'cursor': entries[0]['seq'] if entries[0]['seq'] > 1 else None,
+            })
 
     async def receive(self, text_data=None, bytes_data=None):
-        text_json = json.loads(text_data)
-        message = text_json['message'].strip()
-        if message.endswith('1'):
+        text_json = await self.decode_frame(text_data, bytes_data)
+        if not isinstance(text_json, dict):
+            await self.send_payload({'message': 'invalid data'})
+            return
+        await self.handle_message(self.room_group_name, text_json)
+
+    async def is_duplicate(self, group_name, text_json) -> bool:
+        """a client message id already seen in the room, e.g. a message resent after a reconnect"""
+        message_id = text_json.get('id')
+        if not isinstance(message_id, str) or not 0 < len(message_id) <= self.MAX_MESSAGE_ID_LENGTH:
+            return False
+        return await message_deduplicator.seen(group_name, message_id)
+
+    async def handle_message(self, group_name, text_json):
+        message = text_json.get('message')
+        if not isinstance(message, str):
+            await self.send_room_payload(group_name, {'message': 'invalid data'})
+            return
+        if not get_rate_limiter().allow_room(group_name, rate_limit_user_key(self.scope)):
+            # dropped like frames over the user limit (RateLimitMiddleware)
+            return
+        if await self.is_duplicate(group_name, text_json):
+            # acknowledged so the client stops resending, not fanned out again
+            await self.send_room_payload(group_name, {'duplicate': text_json['id']})
+            return
+        message = message.strip()
+        if message == 'history':
+            # older messages, page by page: pass the returned cursor as 'before'
+            before = text_json.get('before')
+            if before is not None:
+                try:
+                    before = int(before)
+                except (TypeError, ValueError):
+                    before = 0
+                if before < 1:
+                    await self.send_room_payload(group_name, {'message': 'invalid cursor'})
+                    return
+            page = await room_history.fetch(group_name, before=before)
+            await self.send_room_payload(group_name, {
+                'history': page['entries'],
+                'cursor': page['cursor'],
+            })
+        elif message == 'search':
+            # matching recent messages, scanning them is left to the offload pool
+            found = await self.run_offloaded('offload_search_history', {
+                'entries': await room_history.recent(group_name),
+                'query': text_json.get('query'),
+            })
+            await self.send_room_payload(group_name, found)
+        elif message == 'members':
+            # members connected to this process, their details fetched in one batched query
+            users = await user_loader.load_many(presence.index.online_users(group_name))
+            await self.send_room_payload(group_name, {
+                'members': [user_summary(user) for user in users.values()],
+            })
+        elif message.endswith('1'):
 
-            await self.channel_layer.group_send(self.room_group_name, {
+            await self.channel_layer.group_send(group_name, {
                 'type': 'chat_message',
+                'group': group_name,
                 'message': message,
+                'payload_id': new_payload_id(),
+                'history_entry': await room_history.append(group_name, message),
             })
         elif message.endswith('2'):
-            await self.channel_layer.group_send(self.room_group_name, {
+            await self.channel_layer.group_send(group_name, {
                 'type': 'chat_message2',
+                'group': group_name,
                 'message': message,
+                'payload_id': new_payload_id(),
+                'history_entry': await room_history.append(group_name, message),
             })
         else:
-            await self.send(text_data=json.dumps({
+            await self.send_room_payload(group_name, {
                 'message': 'invalid data'
-            }))
+            })
+
+    @staticmethod
+    def offload_search_history(event):
+        query = event['query']
+        if not isinstance(query, str) or not query:
+            return {'message': 'invalid query'}
+        query = query.casefold()
+        return {'found': [entry for entry in event['entries'] if query in entry['message'].casefold()]}
 
     async def chat_message(self, event):
         message = event['message']
+        group_name = event.get('group', self.room_group_name)
+        payload_id = event.get('payload_id')
+        if 'history_entry' in event:
+            room_history.observe(group_name, event['history_entry'])
 
-        while True:
-            print('sending...')
-            await self.send(text_data=json.dumps({
-                'message': message
-            }))
-            await asyncio.sleep(1)
+        logger.debug('sending %s to %s', message, group_name)
+        await self.send_room_payload(group_name, {
+            'message': message
+        }, payload_id=payload_id)
+        # keep sending the message every second until disconnect
+        timer = self.add_timer(
+            timer_wheel.call_every(1, self.send_room_payload, group_name, {'message': message}, payload_id)
+        )
+        self.handler_timers['chat_message'].add(timer)
+        self.group_timers[group_name].add(timer)
 
     async def chat_message2(self, event):
         message = event['message']
-        await self.send(text_data=json.dumps({
+        group_name = event.get('group', self.room_group_name)
+        if 'history_entry' in event:
+            room_history.observe(group_name, event['history_entry'])
+        await self.send_room_payload(group_name, {
             'message': message
-        }))
+        }, payload_id=event.get('payload_id'))
+
+
+class MultiplexChatConsumer(ChatConsumer):
+    """
+    Many rooms over one websocket, so a client in 20 rooms keeps one socket, one auth handshake
+    and one channel layer channel. Control frames join and leave rooms:
+        {"message": "subscribe", "room": "room1"}
+        {"message": "unsubscribe", "room": "room1"}
+    every other frame names its room, {"message": "hello2", "room": "room1"}, and every frame
+    sent to the client carries the room it belongs to.
+    """
+    ROOM_NAME_RE = re.compile(r'^\w+$')
+
+    async def connect(self):
+        self.presence_user = get_presence_user(self.scope)
+        if self.presence_user is not None:
+            await presence.connect(self.presence_user)
+            # the user's connections are closed at once when its access is revoked
+            await self.control_group_add(user_group(self.presence_user))
+        await self.accept_with_wire_format()
+        self.drain_register()
+        self.start_heartbeat()
+
+    async def send_room_payload(self, group_name, payload, payload_id=None):
+        payload = dict(payload, room=group_name[len('chat_'):])
+        # the tagged payload differs from the one single room connections get for the same event
+        await self.send_payload(payload, payload_id=f'{payload_id}.multiplex' if payload_id else None)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        text_json = await self.decode_frame(text_data, bytes_data)
+        if not isinstance(text_json, dict):
+            await self.send_payload({'message': 'invalid data'})
+            return
+        message = text_json.get('message')
+        if not isinstance(message, str):
+            await self.send_payload({'message': 'invalid data'})
+            return
+        message = message.strip()
+        room_name = text_json.get('room')
+        if not isinstance(room_name, str) or not self.ROOM_NAME_RE.match(room_name):
+            await self.send_payload({'message': 'invalid room', 'room': room_name})
+            return
+        group_name = f'chat_{room_name}'
+
+        if message == 'subscribe':
+            if group_name not in self.joined_groups:
+                if len(self.joined_groups) >= settings.CHAT_MULTIPLEX['max_rooms']:
+                    await self.send_payload({'message': 'too many rooms', 'room': room_name})
+                    return
+                await self.join_group(group_name)
+            await self.send_payload({'subscribed': room_name, 'room': room_name})
+            await self.replay_history(group_name)
+        elif message == 'unsubscribe':
+            if group_name in self.joined_groups:
+                await self.leave_group(group_name)
+            await self.send_payload({'unsubscribed': room_name, 'room': room_name})
+        elif group_name not in self.joined_groups:
+            await self.send_payload({'message': 'not subscribed', 'room': room_name})
+        else:
+            await self.handle_message(group_name, text_json)
@@ -0,0 +1,229 @@
+import json
+import time
+import typing
+import collections
+
+from django.conf import settings
+
+from core import metrics
+
+
+class RingBuffer:
+    """fixed size buffer, appending to a full buffer overwrites the oldest item, O(1) random access"""
+    def __init__(self, capacity: int):
+        self.capacity: int = capacity
+        self.items: typing.List = [None] * capacity
+        self.start: int = 0
+        self.size: int = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getitem__(self, i: int):
+        if i < 0:
+            i += self.size
+        if not 0 <= i < self.size:
+            raise IndexError('ring buffer index out of range')
+        return self.items[(self.start + i) % self.capacity]
+
+    def append(self, item):
+        if self.size < self.capacity:
+            self.items[(self.start + self.size) % self.capacity] = item
+            self.size += 1
+        else:
+            self.items[self.start] = item
+            self.start = (self.start + 1) % self.capacity
+
+    def slice(self, start: int, end: int) -> typing.List:
+        return [self[i] for i in range(max(start, 0), min(end, self.size))]
+
+    def clear(self):
+        self.items = [None] * self.capacity
+        self.start = 0
+        self.size = 0
+
+
+class RedisHistoryBackend:
+    """
+    Durable history of every room in a sorted set scored by message sequence number,
+    the sequence number comes from INCR so it is unique across processes.
+    """
+    def __init__(self, conn_args: typing.Dict = None, max_length: int = 10000,
+                 namespace: typing.AnyStr = 'default', redis=None):
+        self.conn_args: typing.Dict = conn_args
+        self.max_length: int = max_length
+        self.prefix: typing.AnyStr = f'{namespace}:history'
+        self.redis = redis
+
+    async def get_redis(self):
+        if self.redis is None:
+            import aioredis
+            self.redis = await aioredis.create_redis_pool(**self.conn_args)
+        return self.redis
+
+    def key(self, room) -> typing.AnyStr:
+        return f'{self.prefix}:{room}'
+
+    async def next_seq(self, room) -> int:
+        redis = await self.get_redis()
+        return await redis.incr(f'{self.key(room)}:seq')
+
+    async def append(self, room, entry: typing.Dict):
+        redis = await self.get_redis()
+        pipeline = redis.pipeline()
+        pipeline.zadd(self.key(room), entry['seq'], json.dumps(entry))
+        # keep the newest max_length entries only
+        pipeline.zremrangebyrank(self.key(room), 0, -(self.max_length + 1))
+        await pipeline.execute()
+
+    async def before(self, room, before: typing.Optional[int], limit: int) -> typing.List[typing.Dict]:
+        """newest `limit` entries with seq < before, oldest first"""
+        import aioredis
+        redis = await self.get_redis()
+        kwargs = {'offset': 0, 'count': limit}
+        if before is None:
+            max_score = float('inf')
+        else:
+            max_score = before
+            kwargs['exclude'] = aioredis.Redis.ZSET_EXCLUDE_MAX
+        members = await redis.zrevrangebyscore(self.key(room), max_score, float('-inf'), **kwargs)
+        return [json.loads(member) for member in reversed(members)]
+
+
+class RoomHistory:
+    """
+    The last `per_room` messages of every warm room in a ring buffer, so a join is answered
+    from memory. Rooms are kept in LRU order, the coldest rooms are evicted once more than
+    `max_messages` messages are buffered in total. Older pages and cold rooms are read from
+    the backend. Without a backend history only lives in this process.
+
+    Sequence numbers are consecutive per room, so the position of a cursor in a ring is
+    computed, not searched.
+    """
+    def __init__(self, per_room: int = 100, max_messages: int = 100000, backend: RedisHistoryBackend = None):
+        self.per_room: int = per_room
+        self.max_messages: int = max_messages
+        self.backend: typing.Optional[RedisHistoryBackend] = backend
+        self.rooms: collections.OrderedDict = collections.OrderedDict()
+        self.total: int = 0
+        # sequence numbers when there is no backend
+        self.local_seq: typing.Dict[typing.Any, int] = collections.defaultdict(int)
+
+        self.buffered = metrics.gauge('chat.history.buffered')
+        self.evicted = metrics.counter('chat.history.evicted')
+        self.memory_hits = metrics.counter('chat.history.memory_hits')
+        self.backend_reads = metrics.counter('chat.history.backend_reads')
+
+    def touch(self, room) -> RingBuffer:
+        ring = self.rooms.get(room)
+        if ring is None:
+            ring = RingBuffer(self.per_room)
+            self.rooms[room] = ring
+        else:
+            self.rooms.move_to_end(room)
+        return ring
+
+    def drop(self, room):
+        ring = self.rooms.pop(room, None)
+        if ring is not None:
+            self.total -= len(ring)
+            self.buffered.set(self.total)
+
+    def evict(self):
+        while self.total > self.max_messages and len(self.rooms) > 1:
+            room, ring = self.rooms.popitem(last=False)
+            self.total -= len(ring)
+            self.evicted.inc()
+        self.buffered.set(self.total)
+
+    def observe(self, room, entry: typing.Dict):
+        """
+        Record an entry in the ring of a warm room. Every process receives the broadcast of a
+        message, this keeps their rings current without reading the backend.
+        """
+        ring = self.rooms.get(room)
+        if ring is None:
+            # cold room, loaded from the backend on next read
+            return
+        if len(ring):
+            last_seq = ring[-1]['seq']
+            if entry['seq'] <= last_seq:
+                # already recorded, e.g. by another consumer of the same process
+                return
+            if entry['seq'] != last_seq + 1:
+                # a gap, sequence numbers must be consecutive inside a ring, reload on next read
+                self.drop(room)
+                return
+        size = len(ring)
+        ring.append(entry)
+        self.total += len(ring) - size
+        self.rooms.move_to_end(room)
+        self.evict()
+
+    async def append(self, room, message: typing.Any) -> typing.Dict:
+        if self.backend is not None:
+            seq = await self.backend.next_seq(room)
+        else:
+            self.local_seq[room] += 1
+            seq = self.local_seq[room]
+        entry = {'seq': seq, 'ts': time.time(), 'message': message}
+        if self.backend is not None:
+            await self.backend.append(room, entry)
+        else:
+            # without backend the ring is the only copy, make sure the room is warm
+            self.touch(room)
+        self.observe(room, entry)
+        return entry
+
+    async def load(self, room) -> RingBuffer:
+        ring = self.rooms.get(room)
+        if ring is not None or self.backend is None:
+            self.memory_hits.inc()
+            return self.touch(room)
+        self.backend_reads.inc()
+        entries = await self.backend.before(room, None, self.per_room)
+        ring = self.touch(room)
+        if len(ring):
+            # loaded by another coroutine meanwhile
+            return ring
+        for entry in entries:
+            ring.append(entry)
+        self.total += len(ring)
+        self.evict()
+        return ring
+
+    async def recent(self, room, limit: int = None) -> typing.List[typing.Dict]:
+        """last `limit` entries, oldest first, replayed to clients joining the room"""
+        ring = await self.load(room)
+        limit = self.per_room if limit is None else limit
+        return ring.slice(len(ring) - limit, len(ring))
+
+    async def fetch(self, room, before: int = None, limit: int = 50) -> typing.Dict:
+        """
+        One page of history older than cursor `before` (all newest when None), returns
+        {'entries': [...oldest first], 'cursor': seq to pass as `before` for the next page or None}
+        """
+        ring = await self.load(room)
+        entries = None
+        if len(ring):
+            first_seq = ring[0]['seq']
+            end = len(ring) if before is None else before - first_seq
+            start = end - limit
+            if start >= 0 or first_seq == 1 or self.backend is None:
+                # the whole page is in memory, there is nothing older, or nowhere else to look
+                entries = ring.slice(start, end)
+        if entries is None:
+            entries = [] if self.backend is None else await self.backend.before(room, before, limit)
+        cursor = entries[0]['seq'] if entries and entries[0]['seq'] > 1 else None
+        return {'entries': entries, 'cursor': cursor}
+
+
+room_history = RoomHistory(
+    per_room=settings.CHAT_HISTORY['per_room'],
+    max_messages=settings.CHAT_HISTORY['max_messages'],
+    backend=RedisHistoryBackend(
+        settings.CHAT_HISTORY['redis'],
+        max_length=settings.CHAT_HISTORY['max_length'],
+        namespace=settings.PROJECT_TAG,
+    ) if settings.CHAT_HISTORY['redis'] else None,
+)
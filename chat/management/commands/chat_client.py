@@ -10,6 +10,11 @@ import urllib.parse
 
 from django.core.management.base import BaseCommand, CommandError
 
+from core.wire import FORMATS
+from core.wire import DEFAULT_FORMAT
+from core.wire import WireFormat
+from core.timer_wheel import PONG_FRAME
+
 
 def get_stdin_data(q):
     """data from stdin"""
@@ -22,15 +27,22 @@ async def simple_ws(
         on_message: typing.Callable = None,
         on_error: typing.Callable = None,
         q: asyncio.Queue = None,
+        wire_format: WireFormat = DEFAULT_FORMAT,
+        stats: typing.Dict = None,
 ):
     """a simple WebSocket client"""
     def call_function(f, *args):
         if f:
             f(*args)
 
+    if stats is None:
+        stats = {}
+    stats.update({'frames_in': 0, 'bytes_in': 0, 'frames_out': 0, 'bytes_out': 0})
+
     loop = asyncio.get_event_loop()
     async with websockets.connect(
             uri,
+            subprotocols=[wire_format.subprotocol] if wire_format is not DEFAULT_FORMAT else None,
             extra_headers=[
                 ('Cookie', 'csrftoken=9DWCWzfUyRtyYBbQJSiMhMTCNiR7ndzlu9FmlhPfiv8Sxqb5YhT7qaT8hJhWrbRw; '
                  'sessionid=tn3464k1l3ykp9gi0u0fqokutgdh6bys')]) as client_side_ws:
@@ -48,12 +60,24 @@ async def simple_ws(
                     user_input = user_input.strip()
                     data_dict = dict(urllib.parse.parse_qsl(user_input))
                     print('You enter: ', data_dict)
-                    data = json.dumps(data_dict)
+                    data = wire_format.encode(data_dict)
+                    stats['frames_out'] += 1
+                    stats['bytes_out'] += len(data)
                     await client_side_ws.send(data)
 
                 msg = None
                 if ws_recv_task.done():
-                    msg = ws_recv_task.result()
+                    frame = ws_recv_task.result()
+                    stats['frames_in'] += 1
+                    stats['bytes_in'] += len(frame)
+                    # json text frames, or binary frames of the negotiated format
+                    msg_dict: typing.Dict = json.loads(frame) if isinstance(frame, str) else wire_format.decode(frame)
+                    if 'heartbeat' in msg_dict:
+                        # the server closes sockets it has not heard from in a while
+                        await client_side_ws.send(PONG_FRAME)
+                        stats['frames_out'] += 1
+                        stats['bytes_out'] += len(PONG_FRAME)
+                    msg = json.dumps(msg_dict)
                     call_function(on_message, msg)
 
                 # Cancel remaining tasks so they do not generate errors as we exit without finishing them.
@@ -62,7 +86,6 @@ async def simple_ws(
                         task.cancel()
 
                 if msg is not None:
-                    msg_dict: typing.Dict = json.loads(msg)
                     message: typing.AnyStr = msg_dict.get('message')
                     if message and message.strip() == 'bye':
                         break
@@ -77,9 +100,13 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('ws_url', nargs='?', help='WebSocket url',
                             type=str, default='ws://127.0.0.1:8000/ws/chat/cc/')
+        parser.add_argument('--format', dest='wire_format', choices=sorted(FORMATS), default=DEFAULT_FORMAT.name,
+                            help='wire format to negotiate with the server')
 
     def handle(self, *args, **options):
         ws_url = options['ws_url']
+        wire_format = FORMATS[options['wire_format']]
+        stats = {}
 
         loop = asyncio.get_event_loop()
         q = asyncio.Queue()
@@ -93,10 +120,17 @@ class Command(BaseCommand):
                     on_message=lambda msg: print('Received: ', msg),
                     on_error=lambda e: print('Error: ', e),
                     q=q,
+                    wire_format=wire_format,
+                    stats=stats,
                 )
             )
         except KeyboardInterrupt:
             pass
+        if stats:
+            self.stdout.write(
+                f'{wire_format.name}: received {stats["frames_in"]} frames / {stats["bytes_in"]} bytes, '
+                f'sent {stats["frames_out"]} frames / {stats["bytes_out"]} bytes'
+            )
         self.stdout.write(self.style.SUCCESS("Done"))
 
 
@@ -1,3 +1,487 @@
-from django.test import TestCase
+import os
+import zlib
+import signal
+import asyncio
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase
+from django.test import override_settings
+from django.conf import settings
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from channels.layers import get_channel_layer
+from django.urls import re_path
+from asgiref.sync import async_to_sync
+
+from chat import routing
+from chat import consumers
+from chat.consumers import ChatConsumer
+from chat.history import RingBuffer
+from chat.history import RoomHistory
+from chat.history import RedisHistoryBackend
+from core.wire import FORMATS
+from core.wire import msgpack_dumps
+from core.wire import WireFormatMixin
+from core.timer_wheel import timer_wheel
+from core.timer_wheel import PONG_FRAME
+from core.drain import drainer
+from core.offload import POOLS
+from core.asgi_middleware import Lifespan
+from core.asgi_middleware import AdmissionMiddleware
+from core.asgi_middleware import LifespanFallbackMiddleware
+from core.ratelimit import RateLimiter
+from core.lanes import control_lane
+
+IN_MEMORY_CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+    },
+}
+
+
+def stop_control_lane():
+    """the control lane of a test and the layer queues it used are bound to the test's loop"""
+    async_to_sync(control_lane.stop)()
+    async_to_sync(get_channel_layer().flush)()
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ChatConsumerTestCase(SimpleTestCase):
+    def setUp(self):
+        self.isolate_history()
+
+    def tearDown(self):
+        stop_control_lane()
+
+    def isolate_history(self):
+        """room history from here on in memory only, for this test alone"""
+        patcher = mock.patch.object(consumers, 'room_history', RoomHistory(per_room=100))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_application(self):
+        return URLRouter(routing.websocket_urlpatterns)
+
+    async def test_json_text_frames_by_default(self):
+        communicator = WebsocketCommunicator(self.get_application(), '/ws/chat/room1/')
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertIsNone(subprotocol)
+
+        await communicator.send_json_to({'message': 'hello2'})
+        self.assertEqual(await communicator.receive_json_from(), {'message': 'hello2'})
+        await communicator.disconnect()
+
+    async def test_negotiated_binary_format(self):
+        for name in ('msgpack', 'json.deflate', 'msgpack.deflate'):
+            # each join of room1 starts without history to replay
+            self.isolate_history()
+            wire_format = FORMATS[name]
+            communicator = WebsocketCommunicator(
+                self.get_application(), '/ws/chat/room1/', subprotocols=['unknown', wire_format.subprotocol]
+            )
+            connected, subprotocol = await communicator.connect()
+            self.assertTrue(connected)
+            self.assertEqual(subprotocol, wire_format.subprotocol)
+
+            await communicator.send_to(bytes_data=wire_format.encode({'message': 'hello2'}))
+            response = await communicator.receive_output()
+            self.assertIsNone(response.get('text'), f'{name} should use binary frames')
+            self.assertEqual(wire_format.decode(response['bytes']), {'message': 'hello2'})
+            await communicator.disconnect()
+
+    async def test_undecodable_frames_are_rejected(self):
+        frames = {
+            'json': [{'text_data': '{"message": '}],
+            'msgpack': [{'bytes_data': b'\x91'}, {'bytes_data': msgpack_dumps({'message': 'x'}) + b'\x01'}],
+            'msgpack.deflate': [{'bytes_data': b'not deflate'}, {'bytes_data': zlib.compress(b'\xc1')}],
+        }
+        rejected = WireFormatMixin.rejected.value
+        for name, name_frames in frames.items():
+            wire_format = FORMATS[name]
+            communicator = WebsocketCommunicator(
+                self.get_application(), '/ws/chat/bad_frames_room/', subprotocols=[wire_format.subprotocol]
+            )
+            await communicator.connect()
+            for frame in name_frames:
+                await communicator.send_to(**frame)
+                response = await communicator.receive_output()
+                data = response['bytes'] if wire_format.binary else response['text']
+                self.assertEqual(wire_format.decode(data), {'message': 'invalid data'}, f'{name} {frame}')
+            await communicator.disconnect()
+        self.assertEqual(WireFormatMixin.rejected.value, rejected + 5)
+
+    async def test_handler_timers_cancelled_on_disconnect(self):
+        timers_before = len(timer_wheel)
+        communicator = WebsocketCommunicator(self.get_application(), '/ws/chat/room2/')
+        await communicator.connect()
+        await communicator.send_json_to({'message': 'repeat1'})
+        self.assertEqual(await communicator.receive_json_from(), {'message': 'repeat1'})
+        # heartbeat + repeating chat_message
+        self.assertEqual(len(timer_wheel), timers_before + 2)
+        await communicator.disconnect()
+        self.assertEqual(len(timer_wheel), timers_before, 'timers should be cancelled on disconnect')
+
+    async def test_listening_client_kept_alive_by_pongs(self):
+        timer_settings = dict(settings.TIMER_WHEEL, heartbeat_interval=0.2, idle_timeout=0.5)
+        with self.settings(TIMER_WHEEL=timer_settings):
+            communicator = WebsocketCommunicator(self.get_application(), '/ws/chat/pong_room/')
+            await communicator.connect()
+            # a client that only listens, answering heartbeats
+            for _ in range(5):
+                self.assertIn('heartbeat', await communicator.receive_json_from(timeout=1))
+                await communicator.send_to(text_data=PONG_FRAME)
+            # and one that stopped answering
+            while True:
+                output = await communicator.receive_output(timeout=1)
+                if output['type'] == 'websocket.close':
+                    break
+            await communicator.disconnect()
+
+    async def test_history_replay_and_pagination(self):
+        sender = WebsocketCommunicator(self.get_application(), '/ws/chat/history_room/')
+        await sender.connect()
+        for i in range(3):
+            await sender.send_json_to({'message': f'm{i}2'})
+            await sender.receive_json_from()
+        await sender.disconnect()
+
+        communicator = WebsocketCommunicator(self.get_application(), '/ws/chat/history_room/')
+        await communicator.connect()
+        replay = await communicator.receive_json_from()
+        self.assertEqual([entry['message'] for entry in replay['history']], ['m02', 'm12', 'm22'])
+        self.assertIsNone(replay['cursor'], 'nothing older than the first message')
+
+        await communicator.send_json_to({'message': 'history', 'before': 3})
+        page = await communicator.receive_json_from()
+        self.assertEqual([entry['seq'] for entry in page['history']], [1, 2])
+
+        for before in ('x', 'nan', -1, [3]):
+            await communicator.send_json_to({'message': 'history', 'before': before})
+            self.assertEqual(await communicator.receive_json_from(), {'message': 'invalid cursor'})
+        await communicator.send_json_to({'message': 'history', 'before': '3'})
+        self.assertEqual([entry['seq'] for entry in (await communicator.receive_json_from())['history']], [1, 2])
+        await communicator.disconnect()
+
+    async def test_multiplexed_rooms(self):
+        single = WebsocketCommunicator(self.get_application(), '/ws/chat/mux_a/')
+        await single.connect()
+        communicator = WebsocketCommunicator(self.get_application(), '/ws/chat/')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        await communicator.send_json_to({'message': 'hello2', 'room': 'mux_a'})
+        self.assertEqual(await communicator.receive_json_from(), {'message': 'not subscribed', 'room': 'mux_a'})
+        for room in ('mux_a', 'mux_b'):
+            await communicator.send_json_to({'message': 'subscribe', 'room': room})
+            self.assertEqual(await communicator.receive_json_from(), {'subscribed': room, 'room': room})
+
+        # frames are tagged by room, single room connections of the same group get them untagged
+        await communicator.send_json_to({'message': 'hello2', 'room': 'mux_a'})
+        self.assertEqual(await communicator.receive_json_from(), {'message': 'hello2', 'room': 'mux_a'})
+        self.assertEqual(await single.receive_json_from(), {'message': 'hello2'})
+        await communicator.send_json_to({'message': 'bye2', 'room': 'mux_b'})
+        self.assertEqual(await communicator.receive_json_from(), {'message': 'bye2', 'room': 'mux_b'})
+        self.assertTrue(await single.receive_nothing())
+
+        await communicator.send_json_to({'message': 'unsubscribe', 'room': 'mux_a'})
+        self.assertEqual(await communicator.receive_json_from(), {'unsubscribed': 'mux_a', 'room': 'mux_a'})
+        await single.send_json_to({'message': 'again2'})
+        await single.receive_json_from()
+        self.assertTrue(await communicator.receive_nothing(), 'left rooms should not be delivered')
+
+        await communicator.send_json_to({'message': 'subscribe', 'room': 'mux_a'})
+        self.assertEqual(await communicator.receive_json_from(), {'subscribed': 'mux_a', 'room': 'mux_a'})
+        replay = await communicator.receive_json_from()
+        self.assertEqual(replay['room'], 'mux_a')
+        self.assertEqual([entry['message'] for entry in replay['history']], ['hello2', 'again2'])
+
+        await communicator.send_json_to({'message': 'subscribe', 'room': '../x'})
+        self.assertEqual((await communicator.receive_json_from())['message'], 'invalid room')
+        await communicator.disconnect()
+        await single.disconnect()
+
+    async def test_multiplexed_rooms_are_limited_separately(self):
+        limiter = RateLimiter(dict(settings.RATE_LIMIT, room={'rate': 0, 'burst': 1}))
+        communicator = WebsocketCommunicator(self.get_application(), '/ws/chat/')
+        await communicator.connect()
+        for room in ('limit_a', 'limit_b'):
+            await communicator.send_json_to({'message': 'subscribe', 'room': room})
+            await communicator.receive_json_from()
+
+        with mock.patch.object(consumers, 'get_rate_limiter', return_value=limiter):
+            await communicator.send_json_to({'message': 'hello2', 'room': 'limit_a'})
+            self.assertEqual(await communicator.receive_json_from(), {'message': 'hello2', 'room': 'limit_a'})
+            await communicator.send_json_to({'message': 'again2', 'room': 'limit_a'})
+            self.assertTrue(await communicator.receive_nothing(), 'room burst exhausted')
+            # the other room of the same socket has its own bucket
+            await communicator.send_json_to({'message': 'hello2', 'room': 'limit_b'})
+            self.assertEqual(await communicator.receive_json_from(), {'message': 'hello2', 'room': 'limit_b'})
+
+        for message in (None, 3, ['hello2'], {'text': 'hello2'}):
+            await communicator.send_json_to({'message': message, 'room': 'limit_a'})
+            self.assertEqual(await communicator.receive_json_from(), {'message': 'invalid data'})
+        await communicator.disconnect()
+
+        single = WebsocketCommunicator(self.get_application(), '/ws/chat/limit_c/')
+        await single.connect()
+        await single.send_json_to({'message': 3})
+        self.assertEqual(await single.receive_json_from(), {'message': 'invalid data'})
+        await single.disconnect()
+
+    async def test_resent_message_ids_are_not_fanned_out(self):
+        sender = WebsocketCommunicator(self.get_application(), '/ws/chat/dedup_room/')
+        await sender.connect()
+        listener = WebsocketCommunicator(self.get_application(), '/ws/chat/dedup_room/')
+        await listener.connect()
+
+        await sender.send_json_to({'message': 'hello2', 'id': 'm-1'})
+        self.assertEqual(await sender.receive_json_from(), {'message': 'hello2'})
+        self.assertEqual(await listener.receive_json_from(), {'message': 'hello2'})
+        # resent after a reconnect: acknowledged, not delivered to the room again
+        await sender.send_json_to({'message': 'hello2', 'id': 'm-1'})
+        self.assertEqual(await sender.receive_json_from(), {'duplicate': 'm-1'})
+        self.assertTrue(await listener.receive_nothing())
+        # ids are per room, messages without an id are never deduplicated
+        await sender.send_json_to({'message': 'hello2'})
+        await sender.receive_json_from()
+        self.assertEqual(await listener.receive_json_from(), {'message': 'hello2'})
+        await sender.disconnect()
+        await listener.disconnect()
+
+    async def test_search_runs_in_the_offload_pool(self):
+        communicator = WebsocketCommunicator(self.get_application(), '/ws/chat/search_room/')
+        await communicator.connect()
+        for message in ('Hello there2', 'bye2'):
+            await communicator.send_json_to({'message': message})
+            await communicator.receive_json_from()
+        await communicator.send_json_to({'message': 'search', 'query': 'HELLO'})
+        found = (await communicator.receive_json_from())['found']
+        self.assertEqual([entry['message'] for entry in found], ['Hello there2'])
+        await communicator.send_json_to({'message': 'search', 'query': 3})
+        self.assertEqual(await communicator.receive_json_from(), {'message': 'invalid query'})
+        await communicator.disconnect()
+        POOLS.pop('cpu').shutdown()
+
+    async def test_frames_other_than_objects_are_invalid(self):
+        communicator = WebsocketCommunicator(self.get_application(), '/ws/chat/invalid_room/')
+        await communicator.connect()
+        await communicator.send_json_to(['message'])
+        self.assertEqual(await communicator.receive_json_from(), {'message': 'invalid data'})
+        await communicator.disconnect()
+
+
+class SlowChatConsumer(ChatConsumer):
+    # state changes of finished handlers, waiting for the write behind
+    pending_writes = []
+
+    async def chat_slow(self, event):
+        await asyncio.sleep(event['seconds'])
+        self.pending_writes.append(self.channel_name)
+        await self.send_payload({'slow': 'done'})
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class DrainTestCase(SimpleTestCase):
+    CLIENTS = 20
+    ROOMS = 4
+
+    def setUp(self):
+        self.written = []
+        SlowChatConsumer.pending_writes = []
+        drainer.on_flush(self.flush)
+
+    def tearDown(self):
+        drainer.flush_hooks.remove(self.flush)
+        drainer.resume()
+        stop_control_lane()
+
+    async def flush(self):
+        self.written.extend(SlowChatConsumer.pending_writes)
+        SlowChatConsumer.pending_writes.clear()
+
+    def get_application(self):
+        return AdmissionMiddleware(
+            URLRouter([re_path(r'ws/chat/(?P<room_name>\w+)/$', SlowChatConsumer.as_asgi())]),
+            config={'max_connections': 1000, 'max_loop_lag': 60},
+        )
+
+    async def connect_clients(self, count):
+        # the in memory layer outlives the event loop of a test, its queues do not
+        await get_channel_layer().flush()
+        clients = []
+        for i in range(count):
+            communicator = WebsocketCommunicator(self.get_application(), f'/ws/chat/drain_room{i % self.ROOMS}/')
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            clients.append(communicator)
+        return clients
+
+    async def test_shutdown_sequence_under_load(self):
+        clients = await self.connect_clients(self.CLIENTS)
+        # every connection has a handler in flight when the shutdown starts
+        for i in range(self.ROOMS):
+            await get_channel_layer().group_send(f'chat_drain_room{i}', {'type': 'chat_slow', 'seconds': 0.2})
+        await asyncio.sleep(0.05)
+        drain = asyncio.ensure_future(drainer.drain(timeout=5))
+        await asyncio.sleep(0)
+
+        late = WebsocketCommunicator(self.get_application(), '/ws/chat/drain_room0/')
+        connected, code = await late.connect()
+        self.assertFalse(connected, 'a draining worker should not accept connections')
+        self.assertEqual(code, AdmissionMiddleware.REFUSE_CODE)
+
+        await drain
+        self.assertEqual(len(self.written), self.CLIENTS, 'finished handlers should be written before the hand off')
+        delays = []
+        for communicator in clients:
+            self.assertEqual(await communicator.receive_json_from(), {'slow': 'done'})
+            delays.append((await communicator.receive_json_from())['reconnect']['delay'])
+            self.assertEqual(await communicator.receive_output(), {'type': 'websocket.close', 'code': 1012})
+            await communicator.disconnect()
+        self.assertEqual(drainer.consumers, set())
+
+        # one client per slot of the reconnect range, not all at once
+        slot = (drainer.reconnect_max - drainer.reconnect_min) / self.CLIENTS
+        for i, delay in enumerate(sorted(delays)):
+            self.assertGreaterEqual(delay, drainer.reconnect_min + i * slot)
+            self.assertLessEqual(delay, drainer.reconnect_min + (i + 1) * slot)
+
+    async def test_tasks_past_the_timeout_are_cancelled(self):
+        cancelled = drainer.cancelled.value
+        clients = await self.connect_clients(2)
+        await get_channel_layer().group_send('chat_drain_room0', {'type': 'chat_slow', 'seconds': 60})
+        await asyncio.sleep(0.05)
+        await asyncio.wait_for(drainer.drain(timeout=0.1), timeout=2)
+        self.assertEqual(drainer.cancelled.value, cancelled + 1)
+        self.assertEqual(self.written, [])
+        for communicator in clients:
+            self.assertIn('reconnect', await communicator.receive_json_from())
+            await communicator.disconnect()
+
+    def test_drain_on_signal_without_lifespan(self):
+        # like daphne: no 'lifespan' scope, the loop runs in the main thread
+        self.addCleanup(drainer.uninstall_signal_handler)
+        lifespan = Lifespan(signal_names=())
+        lifespan.on_startup(drainer.install_signal_handler)
+        application = LifespanFallbackMiddleware(self.get_application(), lifespan)
+        self.get_application = lambda: application
+
+        async def serve():
+            clients = await self.connect_clients(2)
+            os.kill(os.getpid(), getattr(signal, settings.DRAIN['signal_name']))
+            for communicator in clients:
+                self.assertIn('reconnect', await communicator.receive_json_from(timeout=2))
+                self.assertEqual(await communicator.receive_output(), {'type': 'websocket.close', 'code': 1012})
+                await communicator.disconnect()
+            late = WebsocketCommunicator(self.get_application(), '/ws/chat/drain_room0/')
+            connected, code = await late.connect()
+            self.assertFalse(connected, 'the worker keeps running, refusing connections')
+            self.assertEqual(code, AdmissionMiddleware.REFUSE_CODE)
+
+        asyncio.run(serve())
+        self.assertTrue(drainer.draining)
+
+
+class FakeHistoryRedis:
+    """INCR and the sorted set commands used by RedisHistoryBackend"""
+    def __init__(self):
+        self.counters = {}
+        self.zsets = {}
+
+    def pipeline(self):
+        redis = self
+
+        class Pipeline:
+            def __init__(self):
+                self.calls = []
+
+            def __getattr__(self, name):
+                return lambda *args, **kwargs: self.calls.append((name, args, kwargs))
+
+            async def execute(self):
+                for name, args, kwargs in self.calls:
+                    await getattr(redis, name)(*args, **kwargs)
+
+        return Pipeline()
+
+    async def incr(self, key):
+        self.counters[key] = self.counters.get(key, 0) + 1
+        return self.counters[key]
+
+    async def zadd(self, key, score, member):
+        self.zsets.setdefault(key, []).append((score, member))
+        self.zsets[key].sort()
+
+    async def zremrangebyrank(self, key, start, stop):
+        items = self.zsets.get(key, [])
+        stop = len(items) + stop if stop < 0 else stop
+        del items[start:stop + 1]
+
+    async def zrevrangebyscore(self, key, max, min, exclude=None, offset=0, count=None):
+        items = [
+            member for score, member in reversed(self.zsets.get(key, []))
+            if min <= score <= max and not (exclude and score == max)
+        ]
+        return items[offset:offset + count]
+
+
+class RoomHistoryTestCase(SimpleTestCase):
+    def test_ring_buffer(self):
+        ring = RingBuffer(3)
+        for i in range(5):
+            ring.append(i)
+        self.assertEqual(len(ring), 3)
+        self.assertEqual(ring.slice(0, 3), [2, 3, 4])
+        self.assertEqual(ring[-1], 4)
+        with self.assertRaises(IndexError):
+            ring[3]
+
+    async def test_pagination_falls_back_to_backend(self):
+        backend = RedisHistoryBackend(redis=FakeHistoryRedis(), max_length=50, namespace='test')
+        history = RoomHistory(per_room=5, max_messages=100, backend=backend)
+        for i in range(20):
+            await history.append('room', f'm{i}')
+
+        recent = await history.recent('room')
+        self.assertEqual([entry['seq'] for entry in recent], [16, 17, 18, 19, 20])
+
+        # metrics are process wide, compare against the count after the room was loaded
+        backend_reads = history.backend_reads.value
+        page = await history.fetch('room', limit=3)
+        self.assertEqual([entry['seq'] for entry in page['entries']], [18, 19, 20])
+        self.assertEqual(history.backend_reads.value, backend_reads, 'newest page should come from memory')
+
+        page = await history.fetch('room', before=page['cursor'], limit=5)
+        self.assertEqual([entry['seq'] for entry in page['entries']], [13, 14, 15, 16, 17])
+        self.assertEqual(page['cursor'], 13)
+
+        pages = []
+        cursor = page['cursor']
+        while cursor is not None:
+            page = await history.fetch('room', before=cursor, limit=5)
+            pages.append([entry['seq'] for entry in page['entries']])
+            cursor = page['cursor']
+        self.assertEqual(pages, [[8, 9, 10, 11, 12], [3, 4, 5, 6, 7], [1, 2]])
+
+    async def test_lru_eviction_of_cold_rooms(self):
+        backend = RedisHistoryBackend(redis=FakeHistoryRedis(), namespace='test')
+        history = RoomHistory(per_room=10, max_messages=25, backend=backend)
+        for room in ('a', 'b', 'c'):
+            await history.recent(room)
+            for i in range(10):
+                await history.append(room, f'{room}{i}')
+        self.assertLessEqual(history.total, 25)
+        self.assertNotIn('a', history.rooms, 'least recently used room should be evicted')
+
+        recent = await history.recent('a')
+        self.assertEqual(len(recent), 10, 'evicted room should be reloaded from the backend')
+        self.assertLessEqual(history.total, 25)
+
+    async def test_observe_broadcast_entries(self):
+        history = RoomHistory(per_room=5)
+        entry = await history.append('room', 'hello')
+        history.observe('room', entry)
+        self.assertEqual(len(history.rooms['room']), 1, 'same entry should be recorded once')
+        history.observe('room', {'seq': entry['seq'] + 2, 'ts': 0, 'message': 'gap'})
+        self.assertNotIn('room', history.rooms, 'a gap should drop the ring')
@@ -1,5 +1,10 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class CoreConfig(AppConfig):
     name = 'core'
+
+    def ready(self):
+        from core.log import queue_logging
+        queue_logging.configure(settings.QUEUE_LOGGING)
@@ -1,5 +1,20 @@
+import signal
+import typing
+import asyncio
+import logging
+import functools
+import threading
+
+from django.conf import settings
 from channels.auth import AuthMiddlewareStack
 
+from core import metrics
+from core.ratelimit import RateLimiter, get_rate_limiter, rate_limit_user_key
+from core.metrics.loop import loop_monitor
+from core.drain import drainer
+
+logger = logging.getLogger(__name__)
+
 
 class TokenAuthMiddleware:
     def __init__(self, app):
@@ -10,6 +25,251 @@ class TokenAuthMiddleware:
         return await self.app(scope, receive, send)
 
 
+class AdmissionMiddleware:
+    """
+    Refuse new websocket connections while the process is overloaded: too many open connections
+    or an event loop lagging behind, or draining. Runs before authentication, refusing is cheap.
+    """
+    # 1013 try again later
+    REFUSE_CODE = 1013
+
+    connections = metrics.gauge('websocket.connections')
+    refused = metrics.counter('websocket.refused')
+
+    def __init__(self, app, config: typing.Dict = None):
+        self.app = app
+        self.config: typing.Dict = config
+
+    def get_config(self) -> typing.Dict:
+        return self.config if self.config is not None else settings.ADMISSION
+
+    def should_admit(self) -> bool:
+        if drainer.draining:
+            return False
+        config = self.get_config()
+        if self.connections.value >= config['max_connections']:
+            return False
+        if loop_monitor.current_lag.value > config['max_loop_lag']:
+            return False
+        return True
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'websocket':
+            return await self.app(scope, receive, send)
+
+        loop_monitor.start()
+        admitted = False
+
+        async def admission_receive():
+            nonlocal admitted
+            message = await receive()
+            if message['type'] == 'websocket.connect':
+                if self.should_admit():
+                    admitted = True
+                    self.connections.set(self.connections.value + 1)
+                else:
+                    self.refused.inc()
+                    # closing before accept rejects the handshake, the app only sees a disconnect
+                    await send({'type': 'websocket.close', 'code': self.REFUSE_CODE})
+                    return {'type': 'websocket.disconnect', 'code': self.REFUSE_CODE}
+            return message
+
+        try:
+            return await self.app(scope, admission_receive, send)
+        finally:
+            if admitted:
+                self.connections.set(self.connections.value - 1)
+
+
+class RateLimitMiddleware:
+    """
+    Token bucket rate limit of inbound websocket frames per user. One socket may carry several rooms,
+    the per room limit is applied by the consumers once a frame's room is known (RateLimiter.allow_room).
+    Frames over the limit are dropped, a client that keeps flooding gets disconnected.
+    Should be placed after authentication so scope['user'] is available.
+    """
+    # 1008 policy violation
+    CLOSE_CODE = 1008
+
+    limiter: typing.Optional[RateLimiter] = None
+
+    def __init__(self, app, limiter: RateLimiter = None):
+        self.app = app
+        if limiter is not None:
+            self.limiter = limiter
+
+    def get_limiter(self) -> RateLimiter:
+        return self.limiter if self.limiter is not None else get_rate_limiter()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'websocket':
+            return await self.app(scope, receive, send)
+
+        limiter = self.get_limiter()
+        max_strikes = settings.RATE_LIMIT['max_strikes']
+        user_key = rate_limit_user_key(scope)
+        strikes = 0
+
+        async def limited_receive():
+            nonlocal strikes
+            while True:
+                message = await receive()
+                if message['type'] != 'websocket.receive' or await limiter.allow(user_key):
+                    strikes = 0
+                    return message
+                strikes += 1
+                if strikes >= max_strikes:
+                    await send({'type': 'websocket.close', 'code': self.CLOSE_CODE})
+                    return {'type': 'websocket.disconnect', 'code': self.CLOSE_CODE}
+
+        return await self.app(scope, limited_receive, send)
+
+
 def TokenAuthMiddlewareStack(app):
-    return TokenAuthMiddleware(AuthMiddlewareStack(app))
+    return AdmissionMiddleware(TokenAuthMiddleware(AuthMiddlewareStack(RateLimitMiddleware(app))))
+
+
+class Lifespan:
+    """
+    ASGI app for the 'lifespan' scope, runs registered hooks on server startup / shutdown.
+
+    Servers without the lifespan protocol (daphne) never send that scope, LifespanFallbackMiddleware
+    runs the startup hooks on the first request instead. The shutdown hooks then only run on the
+    signals opted in to (LIFESPAN_FALLBACK['signal_names']), before the server's own handler of the signal,
+    by default the handlers of the process are left alone.
+    """
+    def __init__(self, signal_names: typing.Iterable[typing.AnyStr] = None):
+        self.startup_hooks: typing.List[typing.Callable] = []
+        self.shutdown_hooks: typing.List[typing.Callable] = []
+        # None reads the setting when the handlers are installed
+        self.signal_names: typing.Optional[typing.Tuple[typing.AnyStr, ...]] = (
+            tuple(signal_names) if signal_names is not None else None)
+        # the server sent a 'lifespan' scope, no fallback needed
+        self.native: bool = False
+        self.started: typing.Optional[asyncio.Task] = None
+        self.stopping: typing.Optional[asyncio.Task] = None
+        # signal number -> handler installed before ours
+        self.previous_handlers: typing.Dict[int, typing.Any] = {}
+
+    def on_startup(self, hook: typing.Callable):
+        self.startup_hooks.append(hook)
+        return hook
+
+    def on_shutdown(self, hook: typing.Callable):
+        self.shutdown_hooks.append(hook)
+        return hook
+
+    async def startup(self):
+        for hook in self.startup_hooks:
+            await hook()
+
+    async def shutdown(self):
+        # run every hook even if one of them fails, pending work should not be dropped
+        errors = []
+        for hook in self.shutdown_hooks:
+            try:
+                await hook()
+            except Exception as e:
+                logger.error('shutdown hook %s failed: %r', hook, e)
+                errors.append(e)
+        if errors:
+            raise errors[0]
+
+    async def ensure_started(self):
+        """fallback startup: run the startup hooks once per event loop and handle the opted in stop signals"""
+        loop = asyncio.get_running_loop()
+        if self.native:
+            return
+        if self.started is None or self.started.get_loop() is not loop:
+            self.started = loop.create_task(self.startup())
+            self.install_signal_handlers(loop)
+        await asyncio.shield(self.started)
+
+    def get_signal_names(self) -> typing.Tuple[typing.AnyStr, ...]:
+        if self.signal_names is not None:
+            return self.signal_names
+        return tuple(settings.LIFESPAN_FALLBACK['signal_names'])
+
+    def install_signal_handlers(self, loop):
+        signal_names = self.get_signal_names()
+        if not signal_names:
+            return
+        if threading.current_thread() is not threading.main_thread():
+            # signal handlers can only be set from the main thread, where servers run their loop
+            logger.warning('not in the main thread, shutdown hooks will not run on %s', signal_names)
+            return
+        self.uninstall_signal_handlers()
+        for name in signal_names:
+            signum = getattr(signal, name)
+            self.previous_handlers[signum] = signal.getsignal(signum)
+            signal.signal(signum, functools.partial(self.on_signal, loop))
+
+    def uninstall_signal_handlers(self):
+        for signum, previous in self.previous_handlers.items():
+            signal.signal(signum, previous)
+        self.previous_handlers.clear()
+
+    def on_signal(self, loop, signum, frame):
+        # runs between two bytecodes of the main thread, the hooks run on the loop
+        loop.call_soon_threadsafe(self.shutdown_on_signal, signum)
+
+    def shutdown_on_signal(self, signum):
+        if self.stopping is not None:
+            # signalled again while the hooks run, stop now
+            self.forward_signal(signum)
+            return
+        self.stopping = asyncio.get_running_loop().create_task(self.shutdown())
+        self.stopping.add_done_callback(functools.partial(self.on_stopped, signum))
+
+    def on_stopped(self, signum, task):
+        if not task.cancelled() and task.exception() is not None:
+            # each failed hook was logged by shutdown()
+            logger.error('shutdown on signal %d failed: %r', signum, task.exception())
+        self.forward_signal(signum)
+
+    def forward_signal(self, signum):
+        """hand the signal to the handler of the server, stopping it"""
+        previous = self.previous_handlers.get(signum, signal.SIG_DFL)
+        self.uninstall_signal_handlers()
+        if callable(previous):
+            previous(signum, None)
+        elif previous == signal.SIG_DFL:
+            signal.raise_signal(signum)
+
+    async def __call__(self, scope, receive, send):
+        self.native = True
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.startup()
+                except Exception as e:
+                    await send({'type': 'lifespan.startup.failed', 'message': repr(e)})
+                else:
+                    await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                try:
+                    await self.shutdown()
+                except Exception as e:
+                    await send({'type': 'lifespan.shutdown.failed', 'message': repr(e)})
+                else:
+                    await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+class LifespanFallbackMiddleware:
+    """Outermost app: the lifespan hooks of `lifespan` run under servers without the lifespan protocol too"""
+    def __init__(self, app, lifespan: Lifespan):
+        self.app = app
+        self.lifespan: Lifespan = lifespan
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'lifespan':
+            await self.lifespan.ensure_started()
+        return await self.app(scope, receive, send)
+
 
+lifespan = Lifespan()
+# registered before any other hook: connections are handed off before what they use is stopped
+lifespan.on_startup(drainer.install_signal_handler)
+lifespan.on_shutdown(drainer.drain)
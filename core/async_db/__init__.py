@@ -1,5 +1,7 @@
 import typing
 
+from django.utils.module_loading import import_string
+
 
 class AsyncDB:
     async def insert(self, value: typing.Dict):
@@ -8,9 +10,35 @@ class AsyncDB:
     async def filter(self, conditions: typing.Dict):
         pass
 
-    async def set(self, key):
+    async def set(self, key, value: typing.Dict):
         pass
 
     async def get(self, key):
         pass
 
+    async def bulk_set(self, items: typing.Dict):
+        # key -> value, backends should override this with a real batched write
+        for key, value in items.items():
+            await self.set(key, value)
+
+    async def bulk_replace(self, items: typing.Dict) -> typing.Set:
+        # key -> (expected, value): value is written where the stored payload still equals expected,
+        # returns the keys written. Backends should override this with an atomic compare and set
+        written = set()
+        for key, (expected, value) in items.items():
+            if await self.get(key) == expected:
+                await self.set(key, value)
+                written.add(key)
+        return written
+
+
+# backends by name, imported on first use so their client libraries (elasticsearch, kafka...)
+# are only loaded by processes that use them
+BACKENDS: typing.Dict[typing.AnyStr, typing.AnyStr] = {
+    'redis': 'core.async_db.db_redis.AsyncDBRedis',
+    'orm': 'core.async_db.db_orm.AsyncDBORM',
+}
+
+
+def get_backend(name: typing.AnyStr) -> typing.Type[AsyncDB]:
+    return import_string(BACKENDS[name])
@@ -0,0 +1,193 @@
+"""
+AsyncDB on the django ORM. Queries run in the 'db' pool of settings.OFFLOAD_POOLS, threads of
+their own: sync_to_async would queue them on the single thread channels runs all sync code on.
+Pool threads live as long as the pool, each keeps its connection across calls (CONN_MAX_AGE).
+
+A payload is one row of `model`, BlueprintRecord by default: the blueprint id goes to the `key`
+column, leaf fields of the field plan having a column of the same name go to that column (to be
+indexed and filtered by the database), everything else to the `data` json column. Models with a
+`kind` column hold several blueprint classes: every query is scoped to the class's kind, a key is
+unique within its kind only.
+"""
+import typing
+
+from django.db import transaction
+from django.db import IntegrityError
+from django.db import close_old_connections
+from django.utils import timezone
+
+from core.async_db import AsyncDB
+from core.blueprint import BlueprintMeta
+from core.models import BlueprintRecord
+from core.offload import get_pool
+
+# model columns never mapped from a blueprint field of the same name
+RESERVED_COLUMNS: typing.Tuple = ('id', 'key', 'kind', 'data')
+# tries of a bulk_set whose new keys are created by concurrent writers meanwhile
+BULK_SET_ATTEMPTS = 3
+
+
+class AsyncDBORM(AsyncDB):
+    def __init__(self, blueprint_class: BlueprintMeta, model=BlueprintRecord, pool_name: typing.AnyStr = 'db',
+                 batch_size: int = 500, using: typing.AnyStr = 'default'):
+        super(AsyncDBORM, self).__init__()
+        self.blueprint_class: BlueprintMeta = blueprint_class
+        self.model = model
+        self.pool_name: typing.AnyStr = pool_name
+        self.batch_size: int = batch_size
+        self.using: typing.AnyStr = using
+        self.id_name: typing.AnyStr = blueprint_class.ID_NAME
+        self.kind: typing.AnyStr = blueprint_class.__name__.lower()
+
+        model_fields = {field.name: field for field in model._meta.concrete_fields}
+        self.has_kind: bool = 'kind' in model_fields
+        self.columns: typing.Tuple[typing.AnyStr, ...] = tuple(
+            field.name for field in blueprint_class.field_plan
+            if field.name in model_fields and field.name not in RESERVED_COLUMNS
+            and not field.multi and not isinstance(field.data_type, BlueprintMeta)
+        )
+        # bulk_update skips auto_now, these are set by hand
+        self.auto_now: typing.Tuple[typing.AnyStr, ...] = tuple(
+            name for name, field in model_fields.items() if getattr(field, 'auto_now', False)
+        )
+        self.update_fields: typing.Tuple[typing.AnyStr, ...] = (
+            self.columns + ('data',) + (('kind',) if self.has_kind else ()) + self.auto_now
+        )
+
+    @property
+    def objects(self):
+        objects = self.model.objects.using(self.using)
+        return objects.filter(kind=self.kind) if self.has_kind else objects
+
+    def records(self, keys: typing.List) -> typing.Dict:
+        """key -> record of the keys stored"""
+        return {record.key: record for record in self.objects.filter(key__in=keys)}
+
+    async def run(self, func: typing.Callable, *args):
+        return await get_pool(self.pool_name).run(self.call, func, *args)
+
+    @staticmethod
+    def call(func: typing.Callable, *args):
+        # on a pool thread: its connection is reused unless broken or older than CONN_MAX_AGE
+        close_old_connections()
+        return func(*args)
+
+    def to_record(self, payload: typing.Dict, record=None):
+        if record is None:
+            record = self.model(key=payload[self.id_name])
+        for name in self.columns:
+            setattr(record, name, payload.get(name))
+        record.data = {k: v for k, v in payload.items() if k != self.id_name and k not in self.columns}
+        if self.has_kind:
+            record.kind = self.kind
+        return record
+
+    def to_payload(self, record) -> typing.Dict:
+        payload = dict(record.data)
+        for name in self.columns:
+            payload[name] = getattr(record, name)
+        payload[self.id_name] = record.key
+        return payload
+
+    def lookups(self, conditions: typing.Dict) -> typing.Dict:
+        lookups = {}
+        for name, value in conditions.items():
+            if name == self.id_name:
+                lookups['key'] = value
+            elif name in self.columns:
+                lookups[name] = value
+            else:
+                lookups[f'data__{name}'] = value
+        return lookups
+
+    def sync_bulk_insert(self, values: typing.List[typing.Dict]):
+        self.objects.bulk_create([self.to_record(value) for value in values], batch_size=self.batch_size)
+
+    def sync_bulk_set(self, items: typing.Dict):
+        for attempt in range(BULK_SET_ATTEMPTS):
+            try:
+                return self.sync_bulk_set_attempt(items)
+            except IntegrityError:
+                # another writer created one of the new keys after our read, the next attempt
+                # finds its row and updates it
+                if attempt == BULK_SET_ATTEMPTS - 1:
+                    raise
+
+    def sync_bulk_set_attempt(self, items: typing.Dict):
+        with transaction.atomic(using=self.using):
+            existing = self.records(list(items))
+            now = timezone.now()
+            updates, creates = [], []
+            for key, payload in items.items():
+                record = existing.get(key)
+                if record is None:
+                    creates.append(self.to_record(dict(payload, **{self.id_name: key})))
+                    continue
+                self.to_record(payload, record)
+                for name in self.auto_now:
+                    setattr(record, name, now)
+                updates.append(record)
+            if updates:
+                self.objects.bulk_update(updates, self.update_fields, batch_size=self.batch_size)
+            if creates:
+                self.objects.bulk_create(creates, batch_size=self.batch_size)
+
+    def sync_bulk_replace(self, items: typing.Dict) -> typing.Set:
+        with transaction.atomic(using=self.using):
+            # rows locked until the transaction ends, no writer can change them between compare and set
+            records = self.objects.select_for_update().filter(key__in=list(items))
+            now = timezone.now()
+            updates = []
+            for record in records:
+                expected, value = items[record.key]
+                if self.to_payload(record) != expected:
+                    continue
+                self.to_record(value, record)
+                for name in self.auto_now:
+                    setattr(record, name, now)
+                updates.append(record)
+            if updates:
+                self.objects.bulk_update(updates, self.update_fields, batch_size=self.batch_size)
+            return {record.key for record in updates}
+
+    def sync_get_many(self, keys: typing.List) -> typing.Dict:
+        return {key: self.to_payload(record) for key, record in self.records(keys).items()}
+
+    def sync_page(self, lookups: typing.Dict, after: int) -> typing.List[typing.Tuple[int, typing.Dict]]:
+        records = self.objects.filter(pk__gt=after, **lookups).order_by('pk')[:self.batch_size]
+        return [(record.pk, self.to_payload(record)) for record in records]
+
+    async def insert(self, value: typing.Dict):
+        await self.run(self.sync_bulk_insert, [value])
+
+    async def bulk_insert(self, values: typing.List[typing.Dict]):
+        await self.run(self.sync_bulk_insert, values)
+
+    async def set(self, key, value: typing.Dict):
+        await self.run(self.sync_bulk_set, {key: value})
+
+    async def bulk_set(self, items: typing.Dict):
+        # one in_bulk read, then bulk_update / bulk_create, in one transaction, retried when
+        # a concurrent writer creates one of the keys first
+        await self.run(self.sync_bulk_set, items)
+
+    async def bulk_replace(self, items: typing.Dict) -> typing.Set:
+        return await self.run(self.sync_bulk_replace, items)
+
+    async def get(self, key):
+        return (await self.run(self.sync_get_many, [key])).get(key)
+
+    async def get_many(self, keys: typing.Iterable) -> typing.Dict:
+        return await self.run(self.sync_get_many, list(keys))
+
+    async def filter(self, conditions: typing.Dict):
+        """payloads matching every condition, fetched in pages of batch_size"""
+        lookups = self.lookups(conditions)
+        after = 0
+        while True:
+            page = await self.run(self.sync_page, lookups, after)
+            for _, payload in page:
+                yield payload
+            if len(page) < self.batch_size:
+                return
+            after = page[-1][0]
@@ -1,12 +1,58 @@
-import aioredis
+import json
+import typing
 
 from core.async_db import AsyncDB
+from core.blueprint import Blueprint
+from core.sharding import ShardedRedis
+from core.sharding import get_shards
 
 
 class AsyncDBRedis(AsyncDB):
-    def __init__(self):
+    """payloads as json strings, sharded over the REDIS_SHARDS nodes by blueprint id"""
+    KIND = 'db'
+
+    def __init__(self, shards: ShardedRedis = None, scan_batch_size: int = 500):
         super(AsyncDBRedis, self).__init__()
+        self.shards: ShardedRedis = shards or get_shards()
+        self.scan_batch_size: int = scan_batch_size
+
+    def key(self, ident) -> typing.AnyStr:
+        return self.shards.key(self.KIND, ident)
+
+    async def insert(self, value: typing.Dict):
+        await self.set(value[Blueprint.ID_NAME], value)
+
+    async def set(self, key, value: typing.Dict):
+        await self.shards.set(self.key(key), json.dumps(value))
+
+    async def get(self, key):
+        raw = await self.shards.get(self.key(key))
+        return None if raw is None else json.loads(raw)
 
+    async def bulk_set(self, items: typing.Dict):
+        # one MSET per node
+        await self.shards.mset({self.key(key): json.dumps(value) for key, value in items.items()})
 
+    async def bulk_replace(self, items: typing.Dict) -> typing.Set:
+        # compared with the stored json string, a payload read from here dumps back to the same string
+        idents = {self.key(key): key for key in items}
+        written = await self.shards.compare_and_set({
+            self.key(key): (json.dumps(expected), json.dumps(value)) for key, (expected, value) in items.items()
+        })
+        return {idents[key] for key in written}
 
+    async def get_many(self, keys: typing.Iterable) -> typing.Dict:
+        idents = {self.key(key): key for key in keys}
+        raw = await self.shards.mget(idents)
+        return {idents[key]: json.loads(value) for key, value in raw.items()}
 
+    async def filter(self, conditions: typing.Dict):
+        """every payload is scanned, conditions are checked here"""
+        for node in self.shards.nodes:
+            keys = await self.shards.scan(node, f'{self.shards.namespace}:{self.KIND}:*')
+            for start in range(0, len(keys), self.scan_batch_size):
+                raw = await self.shards.mget(keys[start:start + self.scan_batch_size])
+                for value in raw.values():
+                    value = json.loads(value)
+                    if all(value.get(k) == v for k, v in conditions.items()):
+                        yield value
@@ -0,0 +1,131 @@
+import time
+import typing
+import asyncio
+import logging
+
+from core import metrics
+from core.async_db import AsyncDB
+from core.drain import drainer
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehind:
+    """
+    Buffer dirty blueprints and write them to an AsyncDB in batches.
+
+    Blueprints are keyed by their id, marking the same key again before it is flushed
+    only keeps the latest instance, so N mutations inside a flush window become one write.
+    Values are serialized at flush time.
+    """
+    def __init__(
+            self,
+            db: AsyncDB,
+            max_batch_size: int = 500,
+            flush_interval: float = 1.0,
+            name: typing.AnyStr = 'write_behind',
+    ):
+        self.db: AsyncDB = db
+        self.max_batch_size: int = max_batch_size
+        self.flush_interval: float = flush_interval
+        self.name: typing.AnyStr = name
+
+        # key -> blueprint, dict keeps the order keys were first marked
+        self.pending: typing.Dict = {}
+        self.flush_lock: typing.Optional[asyncio.Lock] = None
+        self.wakeup: typing.Optional[asyncio.Event] = None
+        self.task: typing.Optional[asyncio.Task] = None
+
+        self.queue_depth = metrics.gauge(f'{name}.queue_depth')
+        self.flush_latency = metrics.timer(f'{name}.flush_latency')
+        self.flushed = metrics.counter(f'{name}.flushed')
+        self.coalesced = metrics.counter(f'{name}.coalesced')
+        self.failures = metrics.counter(f'{name}.failures')
+
+    def mark_dirty(self, blueprint):
+        key = getattr(blueprint, blueprint.ID_NAME)
+        if key in self.pending:
+            self.coalesced.inc()
+        self.pending[key] = blueprint
+        self.queue_depth.set(len(self.pending))
+        if len(self.pending) >= self.max_batch_size and self.wakeup is not None:
+            self.wakeup.set()
+
+    def take_batch(self) -> typing.Dict:
+        batch: typing.Dict = {}
+        for key in list(self.pending)[:self.max_batch_size]:
+            batch[key] = self.pending.pop(key)
+        self.queue_depth.set(len(self.pending))
+        return batch
+
+    def restore_batch(self, batch: typing.Dict):
+        # a key marked again while its batch was in flight holds the newer instance, keep that one
+        for key, blueprint in batch.items():
+            self.pending.setdefault(key, blueprint)
+        self.queue_depth.set(len(self.pending))
+
+    async def flush(self):
+        if self.flush_lock is None:
+            self.flush_lock = asyncio.Lock()
+        async with self.flush_lock:
+            while self.pending:
+                batch = self.take_batch()
+                start = time.perf_counter()
+                try:
+                    # a blueprint failing to serialize keeps its whole batch pending too
+                    items = {key: blueprint.serialize() for key, blueprint in batch.items()}
+                    await self.db.bulk_set(items)
+                except BaseException as e:
+                    # cancellation included, nothing taken from pending may be lost
+                    self.restore_batch(batch)
+                    if isinstance(e, Exception):
+                        self.failures.inc()
+                    raise
+                self.flush_latency.observe(time.perf_counter() - start)
+                self.flushed.inc(len(items))
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # items are back in pending, try again next round
+                logger.error('%s flush failed: %r', self.name, e)
+
+    def start(self):
+        if self.task is None:
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.get_event_loop().create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+            self.wakeup = None
+        await self.flush()
+
+    def bind_lifespan(self, lifespan):
+        """
+        Start with the server and flush what is pending on shutdown, e.g. with the process lifespan
+        of core.asgi_middleware, run under daphne by LifespanFallbackMiddleware (light.asgi).
+        LiveState.bind_lifespan binds the write behind of the state:
+            live_state = LiveState(UserState, db=db)
+            live_state.bind_lifespan(lifespan)
+        """
+        async def on_startup():
+            self.start()
+        lifespan.on_startup(on_startup)
+        lifespan.on_shutdown(self.stop)
+        # written before the clients of a draining worker reconnect elsewhere
+        drainer.on_flush(self.flush)
@@ -1,5 +1,7 @@
 import typing
 
+from django.utils.module_loading import import_string
+
 
 class AsyncQ:
     async def push(self):
@@ -8,3 +10,12 @@ class AsyncQ:
     async def pop(self):
         pass
 
+
+# backends by name, imported on first use like core.async_db.BACKENDS
+BACKENDS: typing.Dict[typing.AnyStr, typing.AnyStr] = {
+    'redis': 'core.async_queue.q_redis.AsyncQRedis',
+}
+
+
+def get_backend(name: typing.AnyStr) -> typing.Type[AsyncQ]:
+    return import_string(BACKENDS[name])
@@ -1,3 +1,4 @@
+import sys
 import typing
 import logging
 import copy
@@ -8,6 +9,45 @@ import string
 from core.blueprint.exceptions import BlueprintException
 from core.blueprint.exceptions import BlueprintTypeException
 
+logger = logging.getLogger(__name__)
+
+
+class ValuePool:
+    """
+    Flyweight pool, equal values share one object. Values are added until max_size is reached
+    (unbounded when None), values pooled by then keep being shared. One pool may be passed to
+    several fields holding the same kind of values, e.g. room names.
+    """
+    __slots__ = ('values', 'max_size')
+
+    def __init__(self, max_size: typing.Optional[int] = None):
+        self.values: typing.Dict = {}
+        self.max_size: typing.Optional[int] = max_size
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __call__(self, value):
+        shared = self.values.get(value)
+        if shared is not None:
+            return shared
+        if self.max_size is None or len(self.values) < self.max_size:
+            self.values[value] = value
+        return value
+
+
+def make_interner(intern: typing.Any, data_type: typing.Any) -> typing.Optional[typing.Callable]:
+    if intern is None or intern is False:
+        return None
+    if isinstance(intern, ValuePool):
+        return intern
+    if intern is True:
+        # interned strings also compare by identity as dict keys
+        return sys.intern if data_type is str else ValuePool()
+    if isinstance(intern, int):
+        return ValuePool(intern)
+    raise BlueprintException(f'intern should be a bool, a pool size or a ValuePool, got {intern!r}')
+
 
 class Field:
     def __init__(
@@ -16,8 +56,14 @@ class Field:
             data_type: typing.Any = str,
             required: bool = True,
             default: typing.Any = None,
-            multi: bool = False
+            multi: bool = False,
+            intern: typing.Union[bool, int, ValuePool] = False,
     ):
+        """
+        intern: share one object between equal values of the field (across instances), True for
+        an unbounded pool, a number for a pool of that many values, or a ValuePool to share.
+        For fields repeating a few values many times: enums, names, referenced ids.
+        """
         self.name: typing.AnyStr = None
         self.fullname: typing.AnyStr = None
         self.internal_name: typing.AnyStr = None
@@ -26,6 +72,7 @@ class Field:
         self.required: bool = required
         self.default: typing.Any = default
         self.multi: bool = multi
+        self.interner: typing.Optional[typing.Callable] = make_interner(intern, data_type)
 
     def check_and_clean_if_possible(self, value) -> typing.Any:
         if self.multi:
@@ -54,7 +101,9 @@ class Field:
                         )
                 else:
                     inner_list.append(item)
-            logging.debug(f'{self.fullname} type check passed!')
+            logger.debug('%s type check passed!', self.fullname)
+            if self.interner is not None:
+                inner_list = [item if item is None else self.interner(item) for item in inner_list]
             return inner_list
         else:
             if isinstance(value, list):
@@ -75,7 +124,9 @@ class Field:
                     raise BlueprintTypeException(
                         f'{self.fullname} should be type {self.data_type}, but got {type(value)}'
                     )
-            logging.debug(f'{self.fullname} type check passed!')
+            logger.debug('%s type check passed!', self.fullname)
+            if self.interner is not None and value is not None:
+                value = self.interner(value)
             return value
 
     def __get__(self, instance, owner):
@@ -95,6 +146,19 @@ class Field:
         setattr(instance, self.internal_name, value)
 
 
+def get_projection(cls, paths: typing.Iterable[typing.AnyStr] = None) -> 'Projection':
+    """compiled projection of the paths, cached on the class"""
+    key = None if paths is None else tuple(sorted(set(paths)))
+    projection = cls.projections.get(key)
+    if projection is None:
+        projection = Projection.compile(cls, key)
+        if len(cls.projections) >= PROJECTION_CACHE_SIZE:
+            # drop the oldest, selections sent by clients are unbounded
+            del cls.projections[next(iter(cls.projections))]
+        cls.projections[key] = projection
+    return projection
+
+
 class BlueprintMeta(type):
     def __new__(mcs, name: typing.AnyStr, bases: typing.Tuple, class_dict: typing.Dict):
         class_dict_copy = class_dict.copy()
@@ -132,6 +196,14 @@ class BlueprintMeta(type):
                     meta_data.update({mk: mv})
         class_dict_copy.update({'meta_data': meta_data})
 
+        # fields of the blueprint in declaration order (_id and _ts last), computed once per class
+        field_plan: typing.Tuple[Field, ...] = tuple(
+            v for v in class_dict_copy.values() if isinstance(v, Field)
+        )
+        class_dict_copy.update({'field_plan': field_plan})
+        # compiled projections of the class by selected paths, see Projection
+        class_dict_copy.update({'projections': {}})
+
         def generate_id(self):
             return 'test'
         class_dict_copy.update({'generate_id': generate_id})
@@ -168,6 +240,9 @@ class BlueprintMeta(type):
                                 v_deserialized = sk_v
                         # set attr value (through descriptor)
                         setattr(self, sk, v_deserialized)
+                        if sv.interner is not None:
+                            # kwargs are kept for copies, hold the shared value not the decoded one
+                            init_data[sk] = getattr(self, sv.internal_name)
                     else:
                         # user not provide value for the field, use default value to initialize the field if possible
                         # default value for multi field should be []
@@ -220,45 +295,11 @@ class BlueprintMeta(type):
             self.initialize_instance(kwargs)
 
         def serialize(self, selected_fields=None):
-            if selected_fields is None:
-                selected_fields = []
-            else:
-                selected_fields = list(selected_fields)
-            cls_dict: typing.Dict = self.__class__.__dict__
-            serialized: typing.Dict = {}
-
-            if not self.should_serialize():
-                return serialized
-            else:
-                for sk, sv in cls_dict.items():
-                    if isinstance(sv, Field):
-                        if selected_fields and sv.name not in selected_fields:
-                            continue
-                        sk_v = getattr(self, sk)
-
-                        # serialize each field according to sv.data_type and sv.multi
-                        data_type: typing.Any = sv.data_type
-                        multi: bool = sv.multi
-                        if multi:
-                            # should serialize each item in the value
-                            assert isinstance(sk_v, list)
-                            if isinstance(data_type, BlueprintMeta):
-                                serialized.update({
-                                    sk: [item.serialize() for item in sk_v]
-                                })
-                            else:
-                                # just create a new list with the same content
-                                serialized.update({
-                                    sk: [item for item in sk_v]
-                                })
-                        else:
-                            assert not isinstance(sk_v, list)
-                            if isinstance(data_type, BlueprintMeta):
-                                if sk_v.should_serialize():
-                                    serialized.update({sk: sk_v.serialize()})
-                            else:
-                                serialized.update({sk: sk_v})
-            return serialized
+            """
+            selected_fields are paths of the fields to include, nested with dots, '*' for every item
+            of a multi field: ['profile.name', 'rooms.*.id']. Everything is serialized when None.
+            """
+            return self.__class__.projection(selected_fields or None).serialize(self)
 
         def should_serialize(self):
             return True
@@ -266,10 +307,13 @@ class BlueprintMeta(type):
         class_dict_copy.update({
             'ID_NAME': '_id',
             'TS_NAME': '_ts',
+            # schema version stored in payloads of classes with Meta.version, see core.blueprint.versioning
+            'VERSION_NAME': '_v',
             '__init__': init,
             'initialize_instance': initialize_instance,
             'serialize': serialize,
             'should_serialize': should_serialize,
+            'projection': classmethod(get_projection),
         })
         cls = type.__new__(mcs, name, bases, class_dict_copy)
         return cls
@@ -280,7 +324,80 @@ class Blueprint(metaclass=BlueprintMeta):
         instance = self.__class__(**self.kwargs)
         return instance
 
+    def freeze(self):
+        """immutable snapshot of the current values, see core.blueprint.frozen"""
+        from core.blueprint.frozen import FrozenBlueprint
+        return FrozenBlueprint.freeze(self)
+
     class Meta:
         id_template = ''
         is_top = False
 
+
+# compiled projections kept per blueprint class
+PROJECTION_CACHE_SIZE = 256
+PATH_SEPARATOR = '.'
+# every item of a multi field
+PATH_WILDCARD = '*'
+
+
+class Projection:
+    """
+    Fields of a blueprint to serialize, compiled once from selected paths. `fields` holds
+    (field, projection of its value or None for the whole value) in declaration order, so
+    serializing only visits the selected subtrees.
+    """
+    __slots__ = ('blueprint_class', 'fields', 'version')
+
+    def __init__(self, blueprint_class: BlueprintMeta, fields: typing.Tuple[typing.Tuple[Field, typing.Any], ...]):
+        self.blueprint_class: BlueprintMeta = blueprint_class
+        self.fields: typing.Tuple[typing.Tuple[Field, typing.Optional[Projection]], ...] = fields
+        # payloads of versioned classes carry their schema version
+        self.version: typing.Optional[int] = blueprint_class.meta_data.get('version')
+
+    @classmethod
+    def compile(cls, blueprint_class: BlueprintMeta, paths: typing.Iterable[typing.AnyStr] = None) -> 'Projection':
+        if paths is None:
+            return cls(blueprint_class, tuple((field, None) for field in blueprint_class.field_plan))
+        # field name -> remaining paths below it, None when the whole field is selected
+        selected: typing.Dict[typing.AnyStr, typing.Optional[typing.List[typing.AnyStr]]] = {}
+        for path in paths:
+            name, _, rest = path.partition(PATH_SEPARATOR)
+            field = getattr(blueprint_class, name, None)
+            if not isinstance(field, Field):
+                raise BlueprintException(f'{blueprint_class.__name__} has no field {name!r} (path {path!r})')
+            if field.multi and rest.partition(PATH_SEPARATOR)[0] == PATH_WILDCARD:
+                rest = rest.partition(PATH_SEPARATOR)[2]
+            if not rest:
+                selected[name] = None
+                continue
+            if not isinstance(field.data_type, BlueprintMeta):
+                raise BlueprintException(f'{field.fullname} is not a blueprint, cannot select {path!r}')
+            if name not in selected or selected[name] is not None:
+                selected.setdefault(name, []).append(rest)
+        return cls(blueprint_class, tuple(
+            (field, None if selected[field.name] is None else field.data_type.projection(selected[field.name]))
+            for field in blueprint_class.field_plan if field.name in selected
+        ))
+
+    def serialize(self, blueprint) -> typing.Dict:
+        serialized: typing.Dict = {}
+        if not blueprint.should_serialize():
+            return serialized
+        for field, projection in self.fields:
+            value = getattr(blueprint, field.name)
+            if isinstance(field.data_type, BlueprintMeta):
+                if field.multi:
+                    serialized[field.name] = [
+                        item.serialize() if projection is None else projection.serialize(item) for item in value
+                    ]
+                elif value.should_serialize():
+                    serialized[field.name] = value.serialize() if projection is None else projection.serialize(value)
+            elif field.multi:
+                # just create a new list with the same content
+                serialized[field.name] = list(value)
+            else:
+                serialized[field.name] = value
+        if self.version is not None:
+            serialized[self.blueprint_class.VERSION_NAME] = self.version
+        return serialized
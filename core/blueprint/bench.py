@@ -0,0 +1,209 @@
+"""
+Benchmark cases of the Blueprint hot paths, run by the bench_blueprint command. Schemas are
+generated, so the same operations are measured as schemas grow wide, deep or hold long lists.
+"""
+import copy
+import json
+import time
+import typing
+import itertools
+import tracemalloc
+
+from core.blueprint import Field
+from core.blueprint import Blueprint
+from core.blueprint import BlueprintMeta
+
+# leaf field types cycled through by the generators, with a value of every type
+LEAF_TYPES: typing.Tuple = (int, str, float, bool)
+LEAF_VALUES: typing.Dict[typing.Any, typing.Any] = {int: 42, str: 'value', float: 4.2, bool: True}
+
+class_counter = itertools.count()
+
+
+def make_blueprint_class(fields: typing.Dict[typing.AnyStr, Field], prefix: typing.AnyStr = 'Bench') -> BlueprintMeta:
+    class Meta:
+        id_template = 'bench'
+
+    attrs = dict(fields, Meta=Meta, __module__=__name__)
+    return BlueprintMeta(f'{prefix}{next(class_counter)}', (Blueprint,), attrs)
+
+
+def leaf_fields(count: int) -> typing.Tuple[typing.Dict, typing.Dict]:
+    """`count` leaf fields of mixed types, with init data"""
+    fields, data = {}, {}
+    for i in range(count):
+        data_type = LEAF_TYPES[i % len(LEAF_TYPES)]
+        fields[f'f{i}'] = Field(data_type=data_type)
+        data[f'f{i}'] = LEAF_VALUES[data_type]
+    return fields, data
+
+
+def flat(fields: int = 10) -> typing.Tuple[BlueprintMeta, typing.Dict]:
+    fields, data = leaf_fields(fields)
+    return make_blueprint_class(fields, 'Flat'), data
+
+
+def nested(depth: int = 5, width: int = 5) -> typing.Tuple[BlueprintMeta, typing.Dict]:
+    """a chain of `depth` blueprints, each with `width` leaf fields and the next one as `child`"""
+    blueprint_class, data = None, None
+    for _ in range(depth):
+        fields, level_data = leaf_fields(width)
+        if blueprint_class is not None:
+            fields['child'] = Field(data_type=blueprint_class)
+            level_data['child'] = data
+        blueprint_class, data = make_blueprint_class(fields, 'Nested'), level_data
+    return blueprint_class, data
+
+
+def multi(items: int = 1000, width: int = 3) -> typing.Tuple[BlueprintMeta, typing.Dict]:
+    """a long list of ints and a long list of small blueprints"""
+    item_fields, item_data = leaf_fields(width)
+    item_class = make_blueprint_class(item_fields, 'Item')
+    blueprint_class = make_blueprint_class({
+        'numbers': Field(data_type=int, multi=True),
+        'items': Field(data_type=item_class, multi=True),
+    }, 'Multi')
+    return blueprint_class, {
+        'numbers': list(range(items)),
+        'items': [dict(item_data) for _ in range(items)],
+    }
+
+
+# name -> schema generator with its parameters
+SCHEMAS: typing.Dict[typing.AnyStr, typing.Callable] = {
+    'flat': lambda: flat(10),
+    'wide': lambda: flat(200),
+    'deep': lambda: nested(depth=20, width=3),
+    'nested': lambda: nested(depth=5, width=20),
+    'multi': lambda: multi(items=1000),
+}
+
+
+def validate(blueprint):
+    """type check every field value again, nested blueprints included"""
+    for field in blueprint.field_plan:
+        value = field.check_and_clean_if_possible(getattr(blueprint, field.name))
+        if isinstance(field.data_type, BlueprintMeta):
+            for item in (value if field.multi else [value]):
+                validate(item)
+
+
+def selected_fields(blueprint_class: BlueprintMeta) -> typing.List[typing.AnyStr]:
+    """first half of the declared fields"""
+    names = [field.name for field in blueprint_class.field_plan]
+    return names[:max(1, len(names) // 2)]
+
+
+def nested_paths(blueprint_class: BlueprintMeta) -> typing.List[typing.AnyStr]:
+    """first half of the declared fields, nested blueprints narrowed down to their first leaf"""
+    paths = []
+    for name in selected_fields(blueprint_class):
+        field = getattr(blueprint_class, name)
+        if isinstance(field.data_type, BlueprintMeta):
+            wildcard = '*.' if field.multi else ''
+            paths.append(f'{name}.{wildcard}{nested_paths(field.data_type)[0]}')
+        else:
+            paths.append(name)
+    return paths
+
+
+def deepest_path(blueprint_class: BlueprintMeta) -> typing.AnyStr:
+    """path of a leaf field at the bottom of the schema, the first item of multi fields"""
+    for field in blueprint_class.field_plan:
+        if isinstance(field.data_type, BlueprintMeta):
+            index = '0.' if field.multi else ''
+            return f'{field.name}.{index}{deepest_path(field.data_type)}'
+    return blueprint_class.field_plan[0].name
+
+
+def operations(blueprint_class: BlueprintMeta, data: typing.Dict) -> typing.Dict[typing.AnyStr, typing.Callable]:
+    instance = blueprint_class(**data)
+    selected = selected_fields(blueprint_class)
+    paths = nested_paths(blueprint_class)
+    frozen = instance.freeze()
+    path = deepest_path(blueprint_class)
+    leaf_value = frozen
+    for segment in path.split('.'):
+        leaf_value = leaf_value[int(segment)] if segment.isdigit() else getattr(leaf_value, segment)
+    return {
+        'construct': lambda: blueprint_class(**data),
+        'validate': lambda: validate(instance),
+        'serialize': lambda: instance.serialize(),
+        'serialize_selected': lambda: instance.serialize(selected_fields=selected),
+        'serialize_paths': lambda: instance.serialize(selected_fields=paths),
+        'copy': lambda: copy.copy(instance),
+        'freeze': lambda: instance.freeze(),
+        # a snapshot with one deep change, the unchanged subtrees are shared
+        'evolve_in': lambda: frozen.evolve_in(path, leaf_value),
+        'frozen_hash': lambda: hash(frozen.evolve_in(path, leaf_value)),
+    }
+
+
+def measure_time(operation: typing.Callable, min_time: float = 0.05, repeat: int = 5) -> float:
+    """best seconds per call over `repeat` rounds, each round runs at least `min_time`"""
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            operation()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2
+    best = elapsed / number
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            operation()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+
+def measure_peak_memory(operation: typing.Callable) -> int:
+    """peak bytes allocated by one call, the result is kept alive until the peak is read"""
+    tracemalloc.start()
+    try:
+        result = operation()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return peak
+
+
+def run(schemas: typing.Iterable[typing.AnyStr] = None, min_time: float = 0.05,
+        repeat: int = 5) -> typing.Dict[typing.AnyStr, typing.Dict]:
+    """'<schema>/<operation>' -> {'seconds': per call, 'peak_bytes': of one call}"""
+    results = {}
+    for schema in (schemas or SCHEMAS):
+        blueprint_class, data = SCHEMAS[schema]()
+        for name, operation in operations(blueprint_class, data).items():
+            results[f'{schema}/{name}'] = {
+                'seconds': measure_time(operation, min_time, repeat),
+                'peak_bytes': measure_peak_memory(operation),
+            }
+    return results
+
+
+def save_baseline(path: typing.AnyStr, results: typing.Dict, meta: typing.Dict = None):
+    with open(path, 'w') as f:
+        json.dump({'meta': meta or {}, 'results': results}, f, indent=2, sort_keys=True)
+
+
+def load_baseline(path: typing.AnyStr) -> typing.Dict:
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def compare(baseline: typing.Dict, results: typing.Dict,
+            threshold: float = 0.1) -> typing.List[typing.Tuple[typing.AnyStr, typing.AnyStr, float]]:
+    """(case, metric, ratio) of every metric more than `threshold` worse than the baseline"""
+    regressions = []
+    for case, metrics in results.items():
+        if case not in baseline:
+            continue
+        for metric, value in metrics.items():
+            base = baseline[case].get(metric)
+            if base and value / base > 1 + threshold:
+                regressions.append((case, metric, value / base))
+    return regressions
@@ -0,0 +1,163 @@
+import typing
+
+from core.blueprint import Field
+from core.blueprint import BlueprintMeta
+from core.blueprint.exceptions import BlueprintException
+
+PATH_SEPARATOR = '.'
+
+# blueprint class -> field name -> index of the field in field_plan
+FIELD_INDEXES: typing.Dict[BlueprintMeta, typing.Dict[typing.AnyStr, int]] = {}
+
+
+def field_index(blueprint_class: BlueprintMeta) -> typing.Dict[typing.AnyStr, int]:
+    index = FIELD_INDEXES.get(blueprint_class)
+    if index is None:
+        index = {field.name: i for i, field in enumerate(blueprint_class.field_plan)}
+        FIELD_INDEXES[blueprint_class] = index
+    return index
+
+
+class FrozenBlueprint:
+    """
+    Immutable blueprint, a persistent structure: values are a tuple in field_plan order, nested
+    blueprints are frozen too and multi fields are tuples. `evolve` / `evolve_in` return a new
+    frozen blueprint sharing every unchanged value with the original, so taking a snapshot of a
+    state tree costs the changed path only. The hash is computed once.
+
+    Fields read like on a blueprint (`frozen.profile.name`), `serialize` works the same.
+    """
+    __slots__ = ('_frozen_class', '_frozen_values', '_frozen_hash')
+
+    def __init__(self, blueprint_class: BlueprintMeta, values: typing.Tuple):
+        object.__setattr__(self, '_frozen_class', blueprint_class)
+        object.__setattr__(self, '_frozen_values', values)
+        object.__setattr__(self, '_frozen_hash', None)
+
+    @classmethod
+    def freeze(cls, blueprint) -> 'FrozenBlueprint':
+        if isinstance(blueprint, FrozenBlueprint):
+            return blueprint
+        return cls(blueprint.__class__, tuple(
+            freeze_value(field, getattr(blueprint, field.name)) for field in blueprint.field_plan
+        ))
+
+    def __getattr__(self, name):
+        index = field_index(self._frozen_class).get(name)
+        if index is not None:
+            return self._frozen_values[index]
+        # ID_NAME, field_plan, meta_data...
+        return getattr(self._frozen_class, name)
+
+    def __setattr__(self, name, value):
+        raise BlueprintException(f'{self._frozen_class.__name__} is frozen, use evolve() to change {name}')
+
+    def __delattr__(self, name):
+        raise BlueprintException(f'{self._frozen_class.__name__} is frozen')
+
+    def __hash__(self) -> int:
+        if self._frozen_hash is None:
+            object.__setattr__(self, '_frozen_hash', hash((self._frozen_class, self._frozen_values)))
+        return self._frozen_hash
+
+    def __eq__(self, other) -> bool:
+        if self is other:
+            return True
+        if not isinstance(other, FrozenBlueprint) or self._frozen_class is not other._frozen_class:
+            return NotImplemented
+        # cached hashes tell most different trees apart without walking them
+        return hash(self) == hash(other) and self._frozen_values == other._frozen_values
+
+    def __repr__(self) -> str:
+        return f'<Frozen {self._frozen_class.__name__} {getattr(self, self._frozen_class.ID_NAME)!r}>'
+
+    def __copy__(self) -> 'FrozenBlueprint':
+        return self
+
+    def __deepcopy__(self, memo) -> 'FrozenBlueprint':
+        return self
+
+    def __reduce__(self):
+        return self.__class__, (self._frozen_class, self._frozen_values)
+
+    def evolve(self, **changes) -> 'FrozenBlueprint':
+        """copy with the given fields changed, values are checked like on assignment"""
+        index = field_index(self._frozen_class)
+        values = list(self._frozen_values)
+        for name, value in changes.items():
+            i = index.get(name)
+            if i is None:
+                raise BlueprintException(f'{self._frozen_class.__name__} has no field {name!r}')
+            values[i] = freeze_value(self._frozen_class.field_plan[i], value)
+        return self.__class__(self._frozen_class, tuple(values))
+
+    def evolve_in(self, path: typing.AnyStr, value) -> 'FrozenBlueprint':
+        """copy with the value at a nested path changed, items of multi fields by index: 'rooms.2.title'"""
+        name, _, rest = path.partition(PATH_SEPARATOR)
+        if not rest:
+            return self.evolve(**{name: value})
+        i = field_index(self._frozen_class).get(name)
+        if i is None:
+            raise BlueprintException(f'{self._frozen_class.__name__} has no field {name!r}')
+        field = self._frozen_class.field_plan[i]
+        current = self._frozen_values[i]
+        if field.multi:
+            position, _, rest = rest.partition(PATH_SEPARATOR)
+            items = list(current)
+            try:
+                position = int(position)
+                if rest:
+                    items[position] = items[position].evolve_in(rest, value)
+                else:
+                    # only the new item is checked, the others are shared as they are
+                    items[position] = freeze_value(field, [value])[0]
+            except (ValueError, IndexError):
+                raise BlueprintException(f'invalid item {position!r} of {field.fullname} in {path!r}')
+            return self.replace(i, tuple(items))
+        if not isinstance(current, FrozenBlueprint):
+            raise BlueprintException(f'{field.fullname} is not a blueprint, cannot change {path!r}')
+        return self.replace(i, current.evolve_in(rest, value))
+
+    def replace(self, i: int, value) -> 'FrozenBlueprint':
+        """copy with the value of field i replaced by an already frozen value"""
+        values = self._frozen_values
+        return self.__class__(self._frozen_class, values[:i] + (value,) + values[i + 1:])
+
+    def should_serialize(self) -> bool:
+        return self._frozen_class.should_serialize(self)
+
+    def serialize(self, selected_fields=None) -> typing.Dict:
+        return self._frozen_class.projection(selected_fields or None).serialize(self)
+
+    def thaw(self):
+        """mutable blueprint with the same values"""
+        return self._frozen_class(**self.serialize())
+
+
+def freeze_value(field: Field, value) -> typing.Any:
+    """value checked and cleaned for the field, nested blueprints frozen and lists turned to tuples"""
+    if isinstance(field.data_type, BlueprintMeta):
+        if field.multi:
+            if isinstance(value, FrozenBlueprint) or not isinstance(value, (list, tuple)):
+                raise BlueprintException(f'{field.fullname} should be a list')
+            return tuple(freeze_item(field, item) for item in value)
+        return freeze_item(field, value)
+    if field.multi and isinstance(value, tuple):
+        value = list(value)
+    value = field.check_and_clean_if_possible(value)
+    return tuple(value) if field.multi else value
+
+
+def freeze_item(field: Field, value) -> typing.Optional[FrozenBlueprint]:
+    if value is None:
+        return None
+    if isinstance(value, FrozenBlueprint):
+        if not issubclass(value._frozen_class, field.data_type):
+            raise BlueprintException(f'{field.fullname} should be type {field.data_type}, got {value._frozen_class}')
+        # shared, not copied
+        return value
+    if isinstance(value, dict):
+        value = field.data_type(**value)
+    if not isinstance(value, field.data_type):
+        raise BlueprintException(f'{field.fullname} should be type {field.data_type}, but got {type(value)}')
+    return FrozenBlueprint.freeze(value)
@@ -0,0 +1,207 @@
+"""
+Schema versions of blueprints. A class declares its current version in Meta.version, serialized
+payloads carry it under VERSION_NAME ('_v', payloads without one are version 1). Upgrade steps
+move a payload from one version to the next, a payload read with an older version is upgraded
+on read through the chain of steps, composed once per (class, from, to) and cached.
+
+    @register_upgrade(Player, 1)
+    def rename_nick(payload):
+        payload['name'] = payload.pop('nick')
+        return payload
+
+Steps get a shallow copy of the payload: they may change its keys, nested values must be
+replaced, not mutated.
+"""
+import typing
+import asyncio
+import logging
+
+from core import metrics
+from core.async_db import AsyncDB
+from core.blueprint import BlueprintMeta
+from core.blueprint.exceptions import BlueprintException
+
+logger = logging.getLogger(__name__)
+
+# version of payloads written before their class was versioned
+INITIAL_VERSION = 1
+
+# class -> from version -> step to from version + 1
+UPGRADE_STEPS: typing.Dict[BlueprintMeta, typing.Dict[int, typing.Callable]] = {}
+# (class, from version, to version) -> composed chain
+UPGRADE_CHAINS: typing.Dict[typing.Tuple[BlueprintMeta, int, int], typing.Callable] = {}
+# class -> fields holding (lists of) blueprints whose payloads may need an upgrade
+VERSIONED_FIELDS: typing.Dict[BlueprintMeta, typing.Tuple] = {}
+
+
+def current_version(blueprint_class: BlueprintMeta) -> int:
+    return blueprint_class.meta_data.get('version', INITIAL_VERSION)
+
+
+def payload_version(blueprint_class: BlueprintMeta, payload: typing.Dict) -> int:
+    return payload.get(blueprint_class.VERSION_NAME, INITIAL_VERSION)
+
+
+def register_upgrade(blueprint_class: BlueprintMeta, from_version: int):
+    """decorator registering the step upgrading payloads of `from_version` to the next version"""
+    def decorator(step: typing.Callable[[typing.Dict], typing.Dict]):
+        UPGRADE_STEPS.setdefault(blueprint_class, {})[from_version] = step
+        # chains composed before may now take another step
+        for key in [key for key in UPGRADE_CHAINS if key[0] is blueprint_class]:
+            del UPGRADE_CHAINS[key]
+        return step
+    return decorator
+
+
+def get_chain(blueprint_class: BlueprintMeta, from_version: int, to_version: int) -> typing.Callable:
+    chain = UPGRADE_CHAINS.get((blueprint_class, from_version, to_version))
+    if chain is not None:
+        return chain
+    if from_version > to_version:
+        raise BlueprintException(f'cannot downgrade {blueprint_class.__name__} payload '
+                                 f'from version {from_version} to {to_version}')
+    steps = UPGRADE_STEPS.get(blueprint_class, {})
+    missing = [version for version in range(from_version, to_version) if version not in steps]
+    if missing:
+        raise BlueprintException(f'no upgrade of {blueprint_class.__name__} from version {missing[0]}')
+    chain_steps = tuple(steps[version] for version in range(from_version, to_version))
+    version_name = blueprint_class.VERSION_NAME
+
+    def chain(payload: typing.Dict) -> typing.Dict:
+        payload = dict(payload)
+        for step in chain_steps:
+            payload = step(payload)
+        payload[version_name] = to_version
+        return payload
+
+    UPGRADE_CHAINS[(blueprint_class, from_version, to_version)] = chain
+    return chain
+
+
+def is_versioned(blueprint_class: BlueprintMeta) -> bool:
+    return 'version' in blueprint_class.meta_data or bool(get_versioned_fields(blueprint_class))
+
+
+def get_versioned_fields(blueprint_class: BlueprintMeta) -> typing.Tuple:
+    fields = VERSIONED_FIELDS.get(blueprint_class)
+    if fields is None:
+        # placeholder while computing, guards self referencing schemas
+        VERSIONED_FIELDS[blueprint_class] = ()
+        fields = tuple(
+            field for field in blueprint_class.field_plan
+            if isinstance(field.data_type, BlueprintMeta) and is_versioned(field.data_type)
+        )
+        VERSIONED_FIELDS[blueprint_class] = fields
+    return fields
+
+
+def upgrade_payload(blueprint_class: BlueprintMeta, payload: typing.Dict) -> typing.Tuple[typing.Dict, bool]:
+    """payload at the current version of the class (nested blueprints included), and whether it changed"""
+    upgraded = False
+    version = payload_version(blueprint_class, payload)
+    target = current_version(blueprint_class)
+    if version != target:
+        payload = get_chain(blueprint_class, version, target)(payload)
+        upgraded = True
+    for field in get_versioned_fields(blueprint_class):
+        value = payload.get(field.name)
+        if value is None:
+            continue
+        if field.multi:
+            items = [upgrade_payload(field.data_type, item) for item in value]
+            if any(changed for _, changed in items):
+                payload = payload if upgraded else dict(payload)
+                payload[field.name] = [item for item, _ in items]
+                upgraded = True
+        else:
+            value, changed = upgrade_payload(field.data_type, value)
+            if changed:
+                payload = payload if upgraded else dict(payload)
+                payload[field.name] = value
+                upgraded = True
+    return payload, upgraded
+
+
+class Migration:
+    """
+    Background rewrite of every stored payload of a blueprint class at an old version, so reads
+    stop paying for upgrades. The db is walked with `filter`, upgraded payloads are written in
+    batches, at most `concurrency` batches in flight.
+
+    A batch is written with `bulk_replace`, compared with the payloads read: a key written since it
+    was read, e.g. by the write behind of a state loaded meanwhile, keeps the newer payload. Keys live
+    in `live_state` when scanned are skipped, their newer in-memory version is written by the write behind.
+    """
+    def __init__(self, db: AsyncDB, blueprint_class: BlueprintMeta, batch_size: int = 500,
+                 concurrency: int = 4, conditions: typing.Dict = None, live_state=None,
+                 name: typing.AnyStr = None):
+        self.db: AsyncDB = db
+        self.blueprint_class: BlueprintMeta = blueprint_class
+        self.batch_size: int = batch_size
+        self.concurrency: int = concurrency
+        self.conditions: typing.Dict = conditions or {}
+        self.live_state = live_state
+        self.name: typing.AnyStr = name or blueprint_class.__name__.lower()
+        self.task: typing.Optional[asyncio.Task] = None
+
+        self.scanned = metrics.counter(f'migration.{self.name}.scanned')
+        self.upgraded = metrics.counter(f'migration.{self.name}.upgraded')
+        # written by another writer between read and write, left as they are
+        self.skipped = metrics.counter(f'migration.{self.name}.skipped')
+        self.failures = metrics.counter(f'migration.{self.name}.failures')
+
+    def is_live(self, key) -> bool:
+        return self.live_state is not None and key in self.live_state
+
+    async def write(self, batch: typing.Dict, semaphore: asyncio.Semaphore):
+        # key -> (payload read, upgraded payload)
+        try:
+            written = await self.db.bulk_replace(batch)
+            self.upgraded.inc(len(written))
+            self.skipped.inc(len(batch) - len(written))
+        except Exception as e:
+            # the payloads stay old and are still upgraded on read, a later run retries them
+            self.failures.inc()
+            logger.error('migration of %s batch failed: %r', self.name, e)
+        finally:
+            semaphore.release()
+
+    async def run(self) -> int:
+        """rewrite every outdated payload, returns the number of payloads scanned"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        writes: typing.Set[asyncio.Future] = set()
+
+        async def submit(batch: typing.Dict):
+            # waits while `concurrency` batches are being written
+            await semaphore.acquire()
+            future = asyncio.ensure_future(self.write(batch, semaphore))
+            writes.add(future)
+            future.add_done_callback(writes.discard)
+
+        batch: typing.Dict = {}
+        scanned = 0
+        id_name = self.blueprint_class.ID_NAME
+        async for payload in self.db.filter(self.conditions):
+            scanned += 1
+            self.scanned.inc()
+            key = payload.get(id_name)
+            if not self.is_live(key):
+                upgraded_payload, upgraded = upgrade_payload(self.blueprint_class, payload)
+                if upgraded:
+                    batch[key] = (payload, upgraded_payload)
+            if len(batch) >= self.batch_size:
+                await submit(batch)
+                batch = {}
+            if scanned % self.batch_size == 0:
+                # upgrading is cpu work, let other coroutines run between batches
+                await asyncio.sleep(0)
+        if batch:
+            await submit(batch)
+        if writes:
+            await asyncio.gather(*writes)
+        return scanned
+
+    def start(self) -> asyncio.Task:
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+        return self.task
@@ -1,42 +1,85 @@
 import json
-import asyncio
 import logging
-import aioredis
+import threading
+import urllib.parse
 
+from channels.generic.http import AsyncHttpConsumer
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.exceptions import StopConsumer
+from django.conf import settings
 
+from core.wire import WireFormatMixin
+from core.drain import DrainMixin
+from core.lanes import user_group
+from core.lanes import PriorityLanesMixin
+from core.wire import new_payload_id
+from core.timer_wheel import timer_wheel
+from core.timer_wheel import ConnectionTimersMixin
+from core.presence import presence
+from core.topics import topic_hub
+from core.topics import can_subscribe
+from core.export import EXPORT_FORMATS
+from core.export import EXPORT_SOURCES
+from core.offload import get_pool
+from core.metrics.loop import loop_monitor
+from core.metrics.sampling import SamplingProfiler
+from core.metrics.sampling import profile_lock
 
-class StateConsumer(AsyncWebsocketConsumer):
+logger = logging.getLogger(__name__)
+
+
+class StateConsumer(DrainMixin, PriorityLanesMixin, ConnectionTimersMixin, WireFormatMixin, AsyncWebsocketConsumer):
     def __init__(self, *args, **kwargs):
         super(StateConsumer, self).__init__(*args, **kwargs)
         # user's mailbox group,
         self.mailbox_group = None
         self.disconnected = True
+        self.refresh_timer = None
 
     async def connect(self):
         user = self.scope['user']
         if user.is_authenticated:
             self.mailbox_group = f'mailbox_{user.id}'
-            await self.channel_layer.group_add(self.mailbox_group, self.channel_name)
-            await self.accept()
+            await self.lane_group_add(self.mailbox_group)
+            # the user's connections are closed at once when its access is revoked
+            await self.control_group_add(user_group(user.id))
+            await self.accept_with_wire_format()
             self.disconnected = False
+            self.drain_register()
+            self.start_heartbeat()
+            await presence.connect(user.id)
+            await topic_hub.ensure_listening()
         else:
             # refuse connection for not logged in
             await self.close()
             self.disconnected = True
 
     async def disconnect(self, code):
-        logging.error('disconnect called !!!!')
+        logger.debug('disconnect %s, code %s', self.channel_name, code)
+        self.drain_unregister()
+        if not self.disconnected:
+            await presence.disconnect(self.scope['user'].id)
+        self.disconnected = True
+        self.cancel_timers()
+        topic_hub.unsubscribe_all(self)
         if self.mailbox_group:
-            await self.channel_layer.group_discard(self.mailbox_group, self.channel_name)
+            await self.lane_group_discard(self.mailbox_group)
+        await self.close_lanes()
+
+    async def send_reconnect(self, delay):
+        await self.send_payload({'reconnect': {'delay': delay}})
 
     async def receive(self, text_data=None, bytes_data=None):
-        text_json = json.loads(text_data)
-        message = text_json['message']
-        print(message, '!!!!')
+        text_json = await self.decode_frame(text_data, bytes_data)
+        message = text_json.get('message') if isinstance(text_json, dict) else None
+        if not isinstance(message, str):
+            await self.send_payload({'error': 'invalid data'})
+            return
+        logger.debug('received %s', message)
         message = message.strip()
-        if message.strip() == 'init':
+        if message in ('subscribe', 'unsubscribe'):
+            await self.handle_subscription(message, text_json.get('path'))
+        elif message.strip() == 'init':
             await self.channel_layer.group_send(self.mailbox_group, {
                 'type': 'message_init',
             })
@@ -44,25 +87,124 @@ class StateConsumer(AsyncWebsocketConsumer):
             await self.channel_layer.group_send(self.mailbox_group, {
                 'type': 'message_chat',
                 'message': message,
+                'payload_id': new_payload_id(),
             })
         else:
-            print('DUMMY')
+            logger.debug('unknown message %s', message)
+
+    async def handle_subscription(self, action, pattern):
+        try:
+            allowed = isinstance(pattern, str) and can_subscribe(self.scope['user'], pattern)
+        except ValueError:
+            allowed = False
+        if not allowed:
+            await self.send_payload({'error': f'cannot {action} {pattern!r}'})
+            return
+        if action == 'subscribe':
+            patterns = topic_hub.patterns.get(self, ())
+            if pattern not in patterns and len(patterns) >= settings.STATE_TOPICS['max_subscriptions']:
+                await self.send_payload({'error': 'too many subscriptions'})
+                return
+            topic_hub.subscribe(self, pattern)
+            await self.send_payload({'subscribed': pattern})
+        else:
+            topic_hub.unsubscribe(self, pattern)
+            await self.send_payload({'unsubscribed': pattern})
 
     async def message_chat(self, event):
         message = event['message']
-        await self.send(text_data=json.dumps({
+        await self.send_payload({
             'message': message
-        }))
+        }, payload_id=event.get('payload_id'))
 
     async def message_init(self, event):
-        await asyncio.sleep(1)
-        await self.send(text_data=json.dumps({
+        # init requests within a second are answered with a single push
+        self.debounce('init', 1, self.push_init)
+
+    async def push_init(self):
+        if self.disconnected:
+            return
+        await self.send_payload({
             'message': 'init state of user'
-        }))
-        while not self.disconnected:
-            await asyncio.sleep(1)
-            await self.send(text_data=json.dumps({
-                'message': 'most updated state refresh!'
-            }))
-            print('one round...')
+        })
+        if self.refresh_timer is None:
+            self.refresh_timer = self.add_timer(timer_wheel.call_every(1, self.push_refresh))
+
+    async def push_refresh(self):
+        await self.send_payload({
+            'message': 'most updated state refresh!'
+        })
+
+
+class ExportConsumer(AsyncHttpConsumer):
+    """stream a registered export source as csv / xlsx, rows are written as they are produced"""
+    async def handle(self, body):
+        user = self.scope.get('user')
+        if user is None or not user.is_staff:
+            await self.send_response(403, b'Forbidden', headers=[(b'Content-Type', b'text/plain')])
+            return
+
+        kwargs = self.scope['url_route']['kwargs']
+        name, file_format = kwargs['name'], kwargs['file_format']
+        if name not in EXPORT_SOURCES or file_format not in EXPORT_FORMATS:
+            await self.send_response(404, b'Not Found', headers=[(b'Content-Type', b'text/plain')])
+            return
+
+        blueprint_class, source = EXPORT_SOURCES[name]
+        iter_export, content_type = EXPORT_FORMATS[file_format]
+        await self.send_headers(headers=[
+            (b'Content-Type', content_type),
+            (b'Content-Disposition', f'attachment; filename="{name}.{file_format}"'.encode('utf-8')),
+        ])
+        async for chunk in iter_export(blueprint_class, source()):
+            await self.send_body(chunk, more_body=True)
+        await self.send_body(b'')
+
+
+class LoopProfileConsumer(AsyncHttpConsumer):
+    """
+    Sample the event loop thread of this process for ?seconds=N and return the collapsed stacks,
+    for flamegraph.pl or speedscope. Staff only, one profile at a time (409 while one runs).
+    """
+    async def handle(self, body):
+        user = self.scope.get('user')
+        if user is None or not user.is_staff:
+            await self.send_response(403, b'Forbidden', headers=[(b'Content-Type', b'text/plain')])
+            return
+
+        query = urllib.parse.parse_qs(self.scope.get('query_string', b'').decode('latin-1'))
+        try:
+            seconds = float(query.get('seconds', ['10'])[0])
+        except ValueError:
+            seconds = -1
+        if not 0 < seconds <= settings.LOOP_PROFILER['max_seconds']:
+            await self.send_response(400, f'seconds should be in (0, {settings.LOOP_PROFILER["max_seconds"]}]'.encode(
+                'utf-8'), headers=[(b'Content-Type', b'text/plain')])
+            return
+        if not profile_lock.acquire(blocking=False):
+            await self.send_response(409, b'A profile is running', headers=[(b'Content-Type', b'text/plain')])
+            return
+        try:
+            # this handler runs on the event loop thread, the one to profile
+            profiler = SamplingProfiler(threading.get_ident(), settings.LOOP_PROFILER['interval'])
+            await get_pool('io').run(profiler.run, seconds)
+        finally:
+            profile_lock.release()
+        logger.info('profiled the event loop for %.1fs, %d samples', seconds, profiler.samples)
+        await self.send_response(200, profiler.collapsed().encode('utf-8'), headers=[
+            (b'Content-Type', b'text/plain; charset=utf-8'),
+            (b'Content-Disposition', b'attachment; filename="loop.collapsed"'),
+        ])
+
 
+class SlowCallbacksConsumer(AsyncHttpConsumer):
+    """recent event loop blocks recorded by the loop monitor, staff only"""
+    async def handle(self, body):
+        user = self.scope.get('user')
+        if user is None or not user.is_staff:
+            await self.send_response(403, b'Forbidden', headers=[(b'Content-Type', b'text/plain')])
+            return
+        await self.send_response(200, json.dumps({
+            'lag': loop_monitor.lag.snapshot(),
+            'slow_callbacks': list(loop_monitor.slow_callbacks),
+        }).encode('utf-8'), headers=[(b'Content-Type', b'application/json')])
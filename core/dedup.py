@@ -0,0 +1,229 @@
+"""
+Deduplication of client supplied message ids. Clients resend after a reconnect, a message id
+seen within the window is not processed (fanned out to a room) again.
+
+The fast path is a rolling Bloom filter of the ids this process has seen: most ids are new and
+the filter says so for a couple of bytes per id, without asking the id store. A possible hit (a
+duplicate, or a false positive at the configured rate) is confirmed by the store:
+    - RedisIdStore (MESSAGE_DEDUP['redis']): SET NX with the window as ttl, shared by every
+      process, ids are recorded without waiting for the reply. Memory is the filter alone.
+    - LocalIdStore otherwise: the last ids of the process (MESSAGE_DEDUP['exact_size'], about 140
+      bytes each, see bench_dedup). While it holds the whole window a hit is confirmed exactly,
+      past that the filter is trusted: a false positive drops a new message at the error rate.
+Either way the filter is per process: a resend reaching another worker (e.g. after a drain)
+misses its filter and is accepted again.
+"""
+import math
+import time
+import typing
+import asyncio
+import hashlib
+import logging
+import collections
+
+from django.conf import settings
+
+from core import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        # optimal bits and hash count for `capacity` items at `error_rate`
+        self.size: int = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes: int = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count: int = 0
+
+    def positions(self, item: typing.AnyStr) -> typing.Iterator[int]:
+        # double hashing, k positions out of two 64 bit hashes
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, item: typing.AnyStr):
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: typing.AnyStr) -> bool:
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self.positions(item))
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.bits)
+
+
+class RollingBloomFilter:
+    """
+    Bloom filters of consecutive time slices covering `window` seconds: items are added to the
+    current one, looked up in all, the oldest is dropped as a new slice starts. `capacity` is the
+    items expected per slice, the error rate holds as long as it is not exceeded.
+    """
+    def __init__(self, capacity: int, error_rate: float, window: float, generations: int = 2,
+                 clock: typing.Callable[[], float] = time.monotonic):
+        self.capacity: int = capacity
+        # a lookup may hit in any slice, each gets its share of the error rate
+        self.slice_error_rate: float = error_rate / generations
+        self.slice: float = window / generations
+        self.clock = clock
+        self.generations: typing.Deque[BloomFilter] = collections.deque(
+            (self.new_filter() for _ in range(generations)), maxlen=generations
+        )
+        self.slice_started: float = clock()
+
+    def new_filter(self) -> BloomFilter:
+        return BloomFilter(self.capacity, self.slice_error_rate)
+
+    def rotate(self):
+        now = self.clock()
+        if now - self.slice_started < self.slice:
+            return
+        if now - self.slice_started >= self.slice * len(self.generations):
+            # idle for the whole window, every slice is stale
+            for _ in range(len(self.generations)):
+                self.generations.append(self.new_filter())
+            self.slice_started = now
+            return
+        while now - self.slice_started >= self.slice:
+            self.generations.append(self.new_filter())
+            self.slice_started += self.slice
+
+    def add(self, item: typing.AnyStr):
+        self.rotate()
+        self.generations[-1].add(item)
+
+    def __contains__(self, item: typing.AnyStr) -> bool:
+        self.rotate()
+        return any(item in generation for generation in self.generations)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(generation.nbytes for generation in self.generations)
+
+
+class LocalIdStore:
+    """the last `size` ids seen by this process within `window` seconds"""
+    def __init__(self, window: float, size: int, clock: typing.Callable[[], float] = time.monotonic):
+        self.window: float = window
+        self.size: int = size
+        self.clock = clock
+        # item -> seen at, oldest first
+        self.items: typing.OrderedDict = collections.OrderedDict()
+        # seen at of the last id pushed out, the store misses ids of the window until it is older
+        self.evicted_at: float = -math.inf
+        self.unconfirmed = metrics.counter('dedup.unconfirmed')
+
+    def record(self, item: typing.AnyStr):
+        self.items[item] = self.clock()
+        self.items.move_to_end(item)
+        while len(self.items) > self.size:
+            _, self.evicted_at = self.items.popitem(last=False)
+
+    def complete(self) -> bool:
+        """True while every id of the window is kept"""
+        return self.clock() - self.evicted_at >= self.window
+
+    async def add(self, item: typing.AnyStr) -> bool:
+        """record the item, False if it was already there or may have been pushed out"""
+        seen_at = self.items.get(item)
+        if seen_at is not None:
+            if self.clock() - seen_at < self.window:
+                return False
+        elif not self.complete():
+            # the filter hit cannot be confirmed, it is trusted
+            self.unconfirmed.inc()
+            return False
+        self.record(item)
+        return True
+
+
+class RedisIdStore:
+    """ids seen by every process within `window` seconds, one key with a ttl per id"""
+    def __init__(self, conn_args: typing.Dict, prefix: typing.AnyStr, window: float):
+        self.conn_args: typing.Dict = conn_args
+        self.prefix: typing.AnyStr = prefix
+        self.ttl: int = max(1, int(math.ceil(window)))
+        self.redis = None
+        # items whose SET is in flight
+        self.recording: typing.Dict[typing.AnyStr, asyncio.Future] = {}
+        self.failures = metrics.counter('dedup.store_failures')
+
+    async def get_redis(self):
+        if self.redis is None:
+            import aioredis
+            self.redis = await aioredis.create_redis_pool(**self.conn_args)
+        return self.redis
+
+    async def set(self, item: typing.AnyStr, if_new: bool = False) -> bool:
+        redis = await self.get_redis()
+        exist = redis.SET_IF_NOT_EXIST if if_new else None
+        return await redis.set(f'{self.prefix}:{item}', 1, expire=self.ttl, exist=exist)
+
+    async def write(self, item: typing.AnyStr):
+        try:
+            await self.set(item)
+        except Exception as e:
+            self.failures.inc()
+            logger.error('dedup: recording %s failed: %r', item, e)
+        finally:
+            self.recording.pop(item, None)
+
+    def record(self, item: typing.AnyStr):
+        # the answer is known (a new id), only a later hit needs the key: not waited for
+        self.recording[item] = asyncio.ensure_future(self.write(item))
+
+    async def add(self, item: typing.AnyStr) -> bool:
+        if item in self.recording:
+            # resent before its first SET was done
+            return False
+        try:
+            return await self.set(item, if_new=True)
+        except Exception as e:
+            # delivering a message twice beats dropping it
+            self.failures.inc()
+            logger.error('dedup: confirming %s failed: %r', item, e)
+            return True
+
+
+class Deduplicator:
+    """
+    Message ids seen per scope key (a room or a user) within `window` seconds. One rolling filter
+    and one id store for the process, items are '<key> <message id>'. `exact_size` bounds the
+    local store, the ids of the window past it are answered by the filter alone.
+    """
+    def __init__(self, window: float = 60, capacity: int = 100000, error_rate: float = 0.001,
+                 exact_size: int = 10000, redis: typing.Dict = None, project_tag: typing.AnyStr = '',
+                 clock: typing.Callable[[], float] = time.monotonic):
+        self.window: float = window
+        self.clock = clock
+        self.filter = RollingBloomFilter(capacity, error_rate, window, clock=clock)
+        if redis:
+            self.store = RedisIdStore(redis['conn_args'], f'{project_tag}:dedup', window)
+        else:
+            self.store = LocalIdStore(window, exact_size, clock)
+
+        self.checked = metrics.counter('dedup.checked')
+        self.possible = metrics.counter('dedup.possible_duplicates')
+        self.duplicates = metrics.counter('dedup.duplicates')
+
+    async def seen(self, key: typing.AnyStr, message_id: typing.AnyStr) -> bool:
+        """True for an id already seen for the key within the window, the id is recorded otherwise"""
+        self.checked.inc()
+        item = f'{key} {message_id}'
+        if item not in self.filter:
+            self.filter.add(item)
+            self.store.record(item)
+            return False
+        self.possible.inc()
+        if await self.store.add(item):
+            # a false positive of the filter
+            return False
+        self.duplicates.inc()
+        return True
+
+
+message_deduplicator = Deduplicator(**settings.MESSAGE_DEDUP, project_tag=settings.PROJECT_TAG)
@@ -0,0 +1,188 @@
+"""
+Drain mode of a worker going away (deploy, scale in). Connections are handed off to the other
+workers instead of dropped at once:
+    1. new websocket connections are refused (AdmissionMiddleware, 1013 try again later)
+    2. in-flight handler tasks of the open connections get `timeout` seconds to finish,
+       the ones still running are cancelled
+    3. pending state writes are flushed (write behinds), so the next worker reads them
+    4. every client is sent {"reconnect": {"delay": seconds}} and closed with 1012 service restart,
+       the delays spread over [reconnect_min, reconnect_max] so the clients do not all come
+       back in the same second
+
+Runs as the first lifespan shutdown hook, or on a signal (DRAIN['signal_name']) sent ahead of the
+shutdown, e.g. by the deploy tooling. The signal handler is installed once at startup, by a lifespan
+startup hook, run from the first request under servers without the lifespan protocol.
+"""
+import json
+import random
+import signal
+import typing
+import asyncio
+import logging
+import functools
+import threading
+
+from django.conf import settings
+
+from core import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Drainer:
+    def __init__(self, timeout: float = 10, reconnect_min: float = 1, reconnect_max: float = 30,
+                 close_code: int = 1012, signal_name: typing.AnyStr = None, rng: random.Random = None):
+        self.timeout: float = timeout
+        self.reconnect_min: float = reconnect_min
+        self.reconnect_max: float = reconnect_max
+        self.close_code: int = close_code
+        self.signal_name: typing.Optional[typing.AnyStr] = signal_name
+        self.rng: random.Random = rng or random.Random()
+
+        self.draining: bool = False
+        self.task: typing.Optional[asyncio.Task] = None
+        # open connections of the process, DrainMixin consumers
+        self.consumers: typing.Set = set()
+        self.flush_hooks: typing.List[typing.Callable] = []
+        # loop the signal handler drains, the handler installed before ours
+        self.signal_loop: typing.Optional[asyncio.AbstractEventLoop] = None
+        self.previous_handler: typing.Any = None
+        self.warned: bool = False
+
+        self.finished = metrics.counter('drain.finished_tasks')
+        self.cancelled = metrics.counter('drain.cancelled_tasks')
+        self.reconnects = metrics.counter('drain.reconnects')
+        self.duration = metrics.timer('drain.duration')
+
+    def register(self, consumer):
+        self.consumers.add(consumer)
+
+    def unregister(self, consumer):
+        self.consumers.discard(consumer)
+
+    def on_flush(self, hook: typing.Callable):
+        """coroutine function run once in-flight tasks are done, before clients are told to reconnect"""
+        self.flush_hooks.append(hook)
+        return hook
+
+    def reconnect_delays(self, count: int) -> typing.List[float]:
+        """one delay per client: [min, max] cut in `count` slots, a random point of each slot"""
+        slot = (self.reconnect_max - self.reconnect_min) / max(count, 1)
+        return [round(self.reconnect_min + (i + self.rng.random()) * slot, 3) for i in range(count)]
+
+    async def finish_tasks(self, consumers: typing.List, timeout: float):
+        tasks = [task for consumer in consumers for task in consumer.drain_tasks() if not task.done()]
+        if not tasks:
+            return
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+        self.finished.inc(len(done))
+        self.cancelled.inc(len(pending))
+        logger.info('drain: %d handler tasks finished, %d cancelled', len(done), len(pending))
+
+    async def flush(self):
+        # every hook runs even if one fails, like lifespan shutdown hooks
+        for hook in self.flush_hooks:
+            try:
+                await hook()
+            except Exception as e:
+                logger.error('drain flush hook %s failed: %r', hook, e)
+
+    async def hand_off(self, consumer, delay: float):
+        try:
+            await consumer.send_reconnect(delay)
+            await consumer.close(code=self.close_code)
+        except Exception as e:
+            # the client went away meanwhile
+            logger.debug('drain: hand off of %s failed: %r', consumer, e)
+            return
+        self.reconnects.inc()
+
+    async def run(self, timeout: float):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        consumers = list(self.consumers)
+        logger.info('drain: %d connections', len(consumers))
+        await self.finish_tasks(consumers, timeout)
+        await self.flush()
+        # connections closed while their tasks were finishing are not handed off
+        consumers = [consumer for consumer in consumers if consumer in self.consumers]
+        self.rng.shuffle(consumers)
+        await asyncio.gather(*(
+            self.hand_off(consumer, delay) for consumer, delay in zip(consumers, self.reconnect_delays(len(consumers)))
+        ))
+        self.duration.observe(loop.time() - started)
+
+    async def drain(self, timeout: float = None):
+        """enter drain mode and hand off the open connections, callers while it runs wait for the same run"""
+        self.draining = True
+        if self.task is None or self.task.get_loop() is not asyncio.get_running_loop():
+            self.task = asyncio.ensure_future(self.run(self.timeout if timeout is None else timeout))
+        await asyncio.shield(self.task)
+
+    def resume(self):
+        """leave drain mode, e.g. after a drain started by mistake"""
+        self.draining = False
+        self.task = None
+
+    def ensure_signal_handler(self):
+        """drain on DRAIN['signal_name'], the worker keeps running refusing connections; once per event loop"""
+        if not self.signal_name:
+            return
+        loop = asyncio.get_running_loop()
+        if self.signal_loop is loop:
+            return
+        if threading.current_thread() is not threading.main_thread():
+            # signal handlers can only be set from the main thread, where servers run their loop
+            if not self.warned:
+                logger.warning('not in the main thread, no drain on %s', self.signal_name)
+                self.warned = True
+            return
+        self.uninstall_signal_handler()
+        signum = getattr(signal, self.signal_name)
+        # signal.signal rather than loop.add_signal_handler, which servers running their loop
+        # through another reactor (daphne, twisted) do not expect
+        self.previous_handler = signal.signal(signum, functools.partial(self.on_signal, loop))
+        self.signal_loop = loop
+
+    def uninstall_signal_handler(self):
+        if self.signal_loop is not None:
+            signal.signal(getattr(signal, self.signal_name), self.previous_handler)
+            self.signal_loop = self.previous_handler = None
+
+    def on_signal(self, loop, signum, frame):
+        # runs between two bytecodes of the main thread, the drain runs on the loop
+        logger.info('drain: signal %d received', signum)
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(self.start_drain)
+
+    def start_drain(self):
+        asyncio.ensure_future(self.drain())
+
+    async def install_signal_handler(self):
+        """lifespan startup hook, for servers that run one"""
+        self.ensure_signal_handler()
+
+
+class DrainMixin:
+    """
+    Consumer handed off when the worker drains. Call `drain_register` once accepted and
+    `drain_unregister` on disconnect, override `drain_tasks` with the handler tasks to wait for.
+    """
+    def drain_register(self):
+        drainer.register(self)
+
+    def drain_unregister(self):
+        drainer.unregister(self)
+
+    def drain_tasks(self) -> typing.List[asyncio.Task]:
+        return []
+
+    async def send_reconnect(self, delay: float):
+        await self.send(text_data=json.dumps({'reconnect': {'delay': delay}}))
+
+
+drainer = Drainer(**settings.DRAIN)
@@ -0,0 +1,139 @@
+import io
+import os
+import csv
+import typing
+import asyncio
+import tempfile
+
+from core.blueprint import BlueprintMeta
+
+# values of a multi field (or of any field below one) share one cell
+MULTI_SEPARATOR = '|'
+# rows buffered before a chunk is handed to the response
+CHUNK_ROWS = 500
+# size of the chunks a finished xlsx file is streamed with
+FILE_CHUNK_SIZE = 64 * 1024
+
+
+class Column:
+    """one flattened leaf field, path is the chain of fields from the top blueprint to the leaf"""
+    def __init__(self, path: typing.Tuple):
+        self.path: typing.Tuple = path
+        self.header: typing.AnyStr = '.'.join(field.name for field in path)
+        self.multi: bool = any(field.multi for field in path)
+
+    def values(self, value, depth: int = 0) -> typing.List:
+        field = self.path[depth]
+        v = getattr(value, field.name)
+        items = v if field.multi else [v]
+        if depth == len(self.path) - 1:
+            return items
+        values = []
+        for item in items:
+            if item is not None:
+                values.extend(self.values(item, depth + 1))
+        return values
+
+    def cell(self, blueprint) -> typing.Any:
+        values = self.values(blueprint)
+        if self.multi:
+            return MULTI_SEPARATOR.join('' if v is None else str(v) for v in values)
+        return values[0] if values else None
+
+
+COLUMNS_CACHE: typing.Dict[BlueprintMeta, typing.List[Column]] = {}
+
+
+def build_columns(blueprint_class: BlueprintMeta, prefix: typing.Tuple = ()) -> typing.List[Column]:
+    columns = []
+    for field in blueprint_class.field_plan:
+        path = prefix + (field,)
+        if isinstance(field.data_type, BlueprintMeta):
+            columns.extend(build_columns(field.data_type, path))
+        else:
+            columns.append(Column(path))
+    return columns
+
+
+def get_columns(blueprint_class: BlueprintMeta) -> typing.List[Column]:
+    columns = COLUMNS_CACHE.get(blueprint_class)
+    if columns is None:
+        columns = build_columns(blueprint_class)
+        COLUMNS_CACHE[blueprint_class] = columns
+    return columns
+
+
+def flatten(blueprint, columns: typing.List[Column]) -> typing.List:
+    return [column.cell(blueprint) for column in columns]
+
+
+async def iter_blueprints(blueprint_class: BlueprintMeta, serialized_items: typing.AsyncIterable):
+    """turn serialized items, e.g. from AsyncDB.filter, into blueprint instances"""
+    async for serialized in serialized_items:
+        yield blueprint_class(**serialized)
+
+
+async def iter_csv(blueprint_class: BlueprintMeta, blueprints: typing.AsyncIterable,
+                   chunk_rows: int = CHUNK_ROWS) -> typing.AsyncIterator[bytes]:
+    columns = get_columns(blueprint_class)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([column.header for column in columns])
+    rows = 0
+    async for blueprint in blueprints:
+        writer.writerow(flatten(blueprint, columns))
+        rows += 1
+        if rows % chunk_rows == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def save_workbook(workbook, path: typing.AnyStr):
+    workbook.save(path)
+
+
+async def iter_xlsx(blueprint_class: BlueprintMeta, blueprints: typing.AsyncIterable,
+                    file_chunk_size: int = FILE_CHUNK_SIZE) -> typing.AsyncIterator[bytes]:
+    """
+    xlsx is a zip archive, it can only be sent once complete. Write-only mode spools rows
+    to a temporary file instead of keeping cells in memory, then the file is streamed in chunks.
+    """
+    # openpyxl is slow to import and only needed here, keep it out of worker startup
+    import openpyxl
+
+    columns = get_columns(blueprint_class)
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet(title=blueprint_class.__name__[:31])
+    sheet.append([column.header for column in columns])
+    async for blueprint in blueprints:
+        sheet.append(flatten(blueprint, columns))
+
+    loop = asyncio.get_event_loop()
+    fd, path = tempfile.mkstemp(suffix='.xlsx')
+    os.close(fd)
+    try:
+        await loop.run_in_executor(None, save_workbook, workbook, path)
+        with open(path, 'rb') as f:
+            while True:
+                chunk = await loop.run_in_executor(None, f.read, file_chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        os.remove(path)
+
+
+EXPORT_FORMATS: typing.Dict[typing.AnyStr, typing.Tuple[typing.Callable, bytes]] = {
+    'csv': (iter_csv, b'text/csv; charset=utf-8'),
+    'xlsx': (iter_xlsx, b'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+}
+
+# name -> (blueprint class, callable returning an async iterable of blueprint instances)
+EXPORT_SOURCES: typing.Dict[typing.AnyStr, typing.Tuple[BlueprintMeta, typing.Callable]] = {}
+
+
+def register_export(name: typing.AnyStr, blueprint_class: BlueprintMeta, source: typing.Callable):
+    EXPORT_SOURCES[name] = (blueprint_class, source)
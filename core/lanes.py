@@ -0,0 +1,265 @@
+"""
+Priority lanes of channel layer messages. A message with 'priority': 'control' (auth revocation,
+disconnects, subscription changes) does not travel through the channel of its consumer, where it
+would queue behind, or be dropped with, bulk chat and state traffic, but through the control
+channel of the consumer's process, '<process>!control'. Like the consumers' channels it is process
+local: channels_redis keeps it on the process's own list, read by the receive loop the consumers
+share, on the host of the process whatever the number of hosts. Its capacity (CHANNEL_LAYERS
+channel_capacity, pattern '*!control') is above the default one, control messages still get in
+once bulk traffic filled the process's queue. The process delivers it to the consumer's control
+inbox, which PriorityLanesMixin reads before the buffered bulk messages of the consumer.
+
+    await lanes.group_send(channel_layer, 'chat_room1', {'type': 'control.close', 'priority': 'control'})
+    await lanes.send(channel_layer, channel_name, {...})
+
+Messages without a priority go through the layer as usual.
+"""
+import typing
+import asyncio
+import logging
+
+from channels.layers import get_channel_layer
+
+from core import metrics
+from core.asgi_middleware import lifespan
+from core.membership import keep_groups
+from core.membership import LISTENER_RETRY_DELAY
+
+logger = logging.getLogger(__name__)
+
+CONTROL = 'control'
+PRIORITY_KEY = 'priority'
+LANE_PREFIX = f'{CONTROL}.'
+# routing of a lane message inside the receiving process, removed before delivery
+TARGET_KEY = '__lane_target__'
+GROUP_KEY = '__lane_group__'
+
+
+def lane_channel(channel_name: typing.AnyStr) -> typing.AnyStr:
+    """control channel of the process owning a channel: 'specific.<process>!<id>' -> 'specific.<process>!control'"""
+    return f'{channel_name.split("!", 1)[0]}!{CONTROL}'
+
+
+def lane_group(group: typing.AnyStr) -> typing.AnyStr:
+    return f'{LANE_PREFIX}{group}'
+
+
+def user_group(user_id) -> typing.AnyStr:
+    """control group of every connection of a user"""
+    return f'user_{user_id}'
+
+
+def is_control(message: typing.Dict) -> bool:
+    return message.get(PRIORITY_KEY) == CONTROL
+
+
+async def send(channel_layer, channel_name: typing.AnyStr, message: typing.Dict):
+    if is_control(message):
+        await channel_layer.send(lane_channel(channel_name), dict(message, **{TARGET_KEY: channel_name}))
+    else:
+        await channel_layer.send(channel_name, message)
+
+
+async def group_send(channel_layer, group: typing.AnyStr, message: typing.Dict):
+    if is_control(message):
+        # one message per process with members, fanned out locally
+        await channel_layer.group_send(lane_group(group), dict(message, **{GROUP_KEY: group}))
+    else:
+        await channel_layer.group_send(group, message)
+
+
+class ControlLane:
+    """
+    The control channel of this process: members are registered with an inbox, lane groups are
+    joined once per process while a local member is in the group, and joined again before
+    the layer expires them (keep_groups).
+    """
+    def __init__(self):
+        self.channel_name: typing.Optional[typing.AnyStr] = None
+        self.task: typing.Optional[asyncio.Task] = None
+        self.renew_task: typing.Optional[asyncio.Task] = None
+        # (loop, lock), members of one loop start the listener one at a time
+        self.listen_lock: typing.Optional[typing.Tuple[asyncio.AbstractEventLoop, asyncio.Lock]] = None
+        # member channel -> inbox
+        self.inboxes: typing.Dict[typing.AnyStr, asyncio.Queue] = {}
+        # group -> local member channels
+        self.groups: typing.Dict[typing.AnyStr, typing.Set[typing.AnyStr]] = {}
+
+        self.delivered = metrics.counter('lanes.control.delivered')
+        self.undeliverable = metrics.counter('lanes.control.undeliverable')
+        self.listener_failures = metrics.counter('lanes.control.listener_failures')
+
+    def deliver(self, message: typing.Dict):
+        target = message.pop(TARGET_KEY, None)
+        group = message.pop(GROUP_KEY, None)
+        members = [target] if target is not None else self.groups.get(group, ())
+        for member in members:
+            inbox = self.inboxes.get(member)
+            if inbox is None:
+                # gone since the message was sent
+                self.undeliverable.inc()
+                continue
+            inbox.put_nowait(message)
+            self.delivered.inc()
+
+    async def listen(self):
+        channel_layer = get_channel_layer()
+        while True:
+            try:
+                self.deliver(await channel_layer.receive(self.channel_name))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # e.g. redis unreachable, the process keeps its control lane and tries again
+                self.listener_failures.inc()
+                logger.error('control lane listener failed: %r', e)
+                await asyncio.sleep(LISTENER_RETRY_DELAY)
+
+    def lane_groups(self) -> typing.List[typing.AnyStr]:
+        return [lane_group(group) for group in self.groups]
+
+    def is_listening(self, loop) -> bool:
+        return self.task is not None and not self.task.done() and self.task.get_loop() is loop
+
+    async def ensure_listening(self):
+        loop = asyncio.get_running_loop()
+        if self.is_listening(loop):
+            return
+        if self.listen_lock is None or self.listen_lock[0] is not loop:
+            self.listen_lock = (loop, asyncio.Lock())
+        async with self.listen_lock[1]:
+            # another member may have started it while this one waited
+            if not self.is_listening(loop):
+                await self.start_listening(loop)
+
+    async def start_listening(self, loop):
+        if self.task is not None:
+            # the listener of a previous loop, its members are gone with it
+            await self.stop()
+        channel_layer = get_channel_layer()
+        self.channel_name = lane_channel(await channel_layer.new_channel())
+        self.task = loop.create_task(self.listen())
+        self.renew_task = loop.create_task(keep_groups(self.channel_name, self.lane_groups))
+
+    async def register(self, channel_name: typing.AnyStr) -> asyncio.Queue:
+        await self.ensure_listening()
+        return self.inboxes.setdefault(channel_name, asyncio.Queue())
+
+    async def unregister(self, channel_name: typing.AnyStr):
+        for group in [group for group, members in self.groups.items() if channel_name in members]:
+            await self.group_discard(group, channel_name)
+        self.inboxes.pop(channel_name, None)
+
+    async def group_add(self, group: typing.AnyStr, channel_name: typing.AnyStr):
+        members = self.groups.setdefault(group, set())
+        if not members:
+            await get_channel_layer().group_add(lane_group(group), self.channel_name)
+        members.add(channel_name)
+
+    async def group_discard(self, group: typing.AnyStr, channel_name: typing.AnyStr):
+        members = self.groups.get(group)
+        if members is None or channel_name not in members:
+            return
+        members.discard(channel_name)
+        if not members:
+            del self.groups[group]
+            await get_channel_layer().group_discard(lane_group(group), self.channel_name)
+
+    async def stop(self):
+        for task in (self.task, self.renew_task):
+            if task is None or task.done() or task.get_loop().is_closed():
+                continue
+            task.cancel()
+            if task.get_loop() is asyncio.get_running_loop():
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self.task = self.renew_task = None
+        if self.channel_name is not None:
+            for group in self.lane_groups():
+                await get_channel_layer().group_discard(group, self.channel_name)
+            self.channel_name = None
+        self.groups.clear()
+        self.inboxes.clear()
+
+
+class PriorityLanesMixin:
+    """
+    Consumer reading its control inbox before its channel. Channels' receive loop calls
+    `channel_receive`, here a property merging both lanes: a waiting control message always
+    wins, a bulk receive in flight is kept for the next call, not cancelled.
+    Join groups with `lane_group_add` to get their control messages too.
+    """
+    control_inbox: typing.Optional[asyncio.Queue] = None
+    bulk_receive: typing.Optional[typing.Callable] = None
+    pending_bulk: typing.Optional[asyncio.Future] = None
+
+    @property
+    def channel_receive(self):
+        return self.lanes_receive
+
+    @channel_receive.setter
+    def channel_receive(self, receive):
+        self.bulk_receive = receive
+
+    async def lanes_receive(self):
+        if self.control_inbox is None:
+            self.control_inbox = await control_lane.register(self.channel_name)
+        inbox = self.control_inbox
+        if not inbox.empty():
+            return inbox.get_nowait()
+        bulk = self.pending_bulk
+        if bulk is None:
+            bulk = self.pending_bulk = asyncio.ensure_future(self.bulk_receive())
+        control = asyncio.ensure_future(inbox.get())
+        try:
+            await asyncio.wait([control, bulk], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            if not control.done():
+                control.cancel()
+        if control.done() and not control.cancelled():
+            return control.result()
+        if self.pending_bulk is bulk:
+            self.pending_bulk = None
+        if bulk.cancelled():
+            # close_lanes ran meanwhile, the lanes are gone: the channel is read alone
+            return await self.bulk_receive()
+        return bulk.result()
+
+    async def lane_group_add(self, group: typing.AnyStr):
+        await self.channel_layer.group_add(group, self.channel_name)
+        await self.control_group_add(group)
+
+    async def control_group_add(self, group: typing.AnyStr):
+        """control messages of the group only, its bulk traffic is not received"""
+        if self.control_inbox is None:
+            self.control_inbox = await control_lane.register(self.channel_name)
+        await control_lane.group_add(group, self.channel_name)
+
+    async def lane_group_discard(self, group: typing.AnyStr):
+        await self.channel_layer.group_discard(group, self.channel_name)
+        await control_lane.group_discard(group, self.channel_name)
+
+    async def close_lanes(self):
+        if self.pending_bulk is not None:
+            self.pending_bulk.cancel()
+            self.pending_bulk = None
+        if self.control_inbox is not None:
+            await control_lane.unregister(self.channel_name)
+            self.control_inbox = None
+
+    async def control_close(self, event):
+        """{'type': 'control.close', 'priority': 'control', 'code': 4003}: auth revoked, kicked..."""
+        await self.close(code=event.get('code', 4003))
+
+
+async def revoke_user(user_id, code: int = 4003):
+    """close every connection of the user, ahead of whatever bulk traffic they have queued"""
+    await group_send(get_channel_layer(), user_group(user_id), {
+        'type': 'control.close', PRIORITY_KEY: CONTROL, 'code': code,
+    })
+
+
+control_lane = ControlLane()
+lifespan.on_shutdown(control_lane.stop)
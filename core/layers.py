@@ -0,0 +1,24 @@
+"""
+Channel layer spreading groups and channels over several redis hosts with the hash ring of
+core.sharding, instead of channels_redis' crc32 modulo the number of hosts, which moves almost
+every group when a host is added.
+"""
+import typing
+
+from channels_redis.core import RedisChannelLayer
+
+from core.sharding import HashRing
+
+
+class ShardedRedisChannelLayer(RedisChannelLayer):
+    def __init__(self, hosts=None, vnodes: int = 160, **kwargs):
+        super(ShardedRedisChannelLayer, self).__init__(hosts=hosts, **kwargs)
+        # hosts are named by address, a host added to the list keeps the others' points
+        names = [host['address'] if isinstance(host['address'], str) else repr(host['address']) for host in self.hosts]
+        self.ring = HashRing(names, vnodes)
+        self.host_indexes: typing.Dict[typing.AnyStr, int] = {name: i for i, name in enumerate(names)}
+
+    def consistent_hash(self, value) -> int:
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+        return self.host_indexes[self.ring.node_for(value)]
@@ -0,0 +1,152 @@
+import sys
+import copy
+import json
+import queue
+import typing
+import atexit
+import logging
+import logging.handlers
+
+from core import metrics
+
+# attributes every LogRecord has, anything else was passed through `extra`
+RECORD_ATTRIBUTES = frozenset(logging.makeLogRecord({}).__dict__) | {'message', 'asctime'}
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keep one in `rate` records of the configured loggers (and their children) below
+    `max_level`, e.g. per message debug records of the consumers. Sampling is a counter per
+    call site, so every call site is still represented. Warnings and errors always pass.
+    """
+    def __init__(self, rates: typing.Dict[typing.AnyStr, int], max_level: int = logging.INFO):
+        super(SamplingFilter, self).__init__()
+        self.rates: typing.Dict[typing.AnyStr, int] = rates
+        self.max_level: int = max_level
+        self.counts: typing.Dict[typing.Tuple, int] = {}
+        self.sampled_out = metrics.counter('log.sampled_out')
+
+    def rate_of(self, name: typing.AnyStr) -> int:
+        while name:
+            rate = self.rates.get(name)
+            if rate is not None:
+                return rate
+            name = name.rpartition('.')[0]
+        return 1
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > self.max_level:
+            return True
+        rate = self.rate_of(record.name)
+        if rate <= 1:
+            return True
+        key = (record.name, record.lineno)
+        count = self.counts.get(key, 0)
+        self.counts[key] = count + 1
+        if count % rate == 0:
+            record.sample_rate = rate
+            return True
+        self.sampled_out.inc()
+        return False
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the listener thread, the caller only merges the message with its args and
+    renders the exception traceback, the handlers' formatting is left to the listener.
+    Once `max_size` records are waiting new ones are dropped instead of blocking the event loop.
+    """
+    def __init__(self, log_queue: queue.SimpleQueue, max_size: int = 10000):
+        super(NonBlockingQueueHandler, self).__init__(log_queue)
+        self.max_size: int = max_size
+        self.exception_formatter = logging.Formatter()
+        self.dropped = metrics.counter('log.dropped')
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # like QueueHandler.prepare: args may be mutated and exc_info keeps frames alive while the
+        # record waits in the queue, extra fields stay on the copy for the listener's formatters
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self.exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        if self.queue.qsize() >= self.max_size:
+            self.dropped.inc()
+        else:
+            self.queue.put_nowait(record)
+
+
+class JsonFormatter(logging.Formatter):
+    """one json object per line, fields passed through `extra` are included"""
+    def format(self, record: logging.LogRecord) -> typing.AnyStr:
+        data = {
+            'ts': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in RECORD_ATTRIBUTES:
+                data[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            # rendered by NonBlockingQueueHandler.prepare for queued records
+            data['exc_info'] = record.exc_text
+        return json.dumps(data, default=repr)
+
+
+class QueueLogging:
+    """QueueHandler on the configured loggers, drained to the real handlers by a background thread"""
+    def __init__(self):
+        self.handler: typing.Optional[NonBlockingQueueHandler] = None
+        self.listener: typing.Optional[logging.handlers.QueueListener] = None
+        self.loggers: typing.List[logging.Logger] = []
+
+    def configure(self, config: typing.Dict, handlers: typing.List[logging.Handler] = None):
+        self.stop()
+        if handlers is None:
+            handler = logging.StreamHandler(sys.stderr)
+            if config.get('json'):
+                handler.setFormatter(JsonFormatter())
+            else:
+                handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s'))
+            handlers = [handler]
+
+        # unbounded, the handler enforces the size so the listener's stop sentinel always fits
+        log_queue = queue.SimpleQueue()
+        self.handler = NonBlockingQueueHandler(log_queue, config['max_queue_size'])
+        if config.get('sample_rates'):
+            self.handler.addFilter(SamplingFilter(config['sample_rates']))
+        self.listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+
+        level = logging.getLevelName(config['level']) if isinstance(config['level'], str) else config['level']
+        for name in config['loggers']:
+            logger = logging.getLogger(name)
+            logger.setLevel(level)
+            logger.addHandler(self.handler)
+            # records are written by the listener only, not again by the root handlers
+            logger.propagate = False
+            self.loggers.append(logger)
+        self.listener.start()
+
+    def stop(self):
+        """flush queued records and detach the handler"""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+        for logger in self.loggers:
+            logger.removeHandler(self.handler)
+            logger.propagate = True
+        self.loggers = []
+        self.handler = None
+
+
+queue_logging = QueueLogging()
+atexit.register(queue_logging.stop)
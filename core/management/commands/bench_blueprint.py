@@ -0,0 +1,59 @@
+import sys
+import platform
+import subprocess
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from core.blueprint import bench
+
+
+def current_commit() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+class Command(BaseCommand):
+    help = 'Measure time and peak memory of blueprint construction, validation, serialization and copy'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--schema', action='append', choices=list(bench.SCHEMAS),
+                            help='schema to run, repeat for several, all by default')
+        parser.add_argument('--min-time', type=float, default=0.05, help='seconds every timing round runs at least')
+        parser.add_argument('--repeat', type=int, default=5, help='timing rounds, the best one is kept')
+        parser.add_argument('--save', help='write the results as a baseline json file')
+        parser.add_argument('--compare', help='baseline json file to compare the results with')
+        parser.add_argument('--threshold', type=float, default=0.1,
+                            help='relative slow down / memory growth reported as a regression')
+        parser.add_argument('--fail-on-regression', action='store_true', help='exit with an error on regressions')
+
+    def handle(self, *args, **options):
+        results = bench.run(options['schema'], options['min_time'], options['repeat'])
+        baseline = bench.load_baseline(options['compare']) if options['compare'] else {}
+
+        self.stdout.write(f'{"case":<28}{"time/op":>12}{"peak":>12}{"vs baseline":>14}')
+        for case, result in results.items():
+            line = f'{case:<28}{result["seconds"] * 1e6:>10.1f}us{result["peak_bytes"] / 1024:>10.1f}KB'
+            if case in baseline:
+                line += f'{result["seconds"] / baseline[case]["seconds"]:>13.2f}x'
+            self.stdout.write(line)
+
+        if options['save']:
+            bench.save_baseline(options['save'], results, meta={
+                'commit': current_commit(),
+                'python': sys.version.split()[0],
+                'platform': platform.platform(),
+            })
+            self.stdout.write(f'baseline saved to {options["save"]}')
+
+        if baseline:
+            regressions = bench.compare(baseline, results, options['threshold'])
+            for case, metric, ratio in regressions:
+                self.stderr.write(f'regression: {case} {metric} {ratio:.2f}x the baseline')
+            if regressions and options['fail_on_regression']:
+                raise CommandError(f'{len(regressions)} regressions over {options["threshold"]:.0%}')
@@ -0,0 +1,65 @@
+import time
+import asyncio
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+
+from core.dedup import Deduplicator
+from core.dedup import LocalIdStore
+from core.dedup import RollingBloomFilter
+
+
+def frozen() -> float:
+    # the window never rolls during a measure
+    return 0.0
+
+
+def local_store_bytes(count: int) -> int:
+    """memory of a LocalIdStore holding `count` ids"""
+    tracemalloc.start()
+    try:
+        store = LocalIdStore(window=60, size=count, clock=frozen)
+        for i in range(count):
+            store.record(f'chat_room{i % 100} id-{i}')
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del store
+    return current
+
+
+async def check_rate(deduplicator: Deduplicator, count: int) -> float:
+    start = time.perf_counter()
+    for i in range(count):
+        await deduplicator.seen(f'chat_room{i % 100}', f'id-{i}')
+    return count / (time.perf_counter() - start)
+
+
+class Command(BaseCommand):
+    help = 'Measure false positive rate, memory and speed of the message id deduplication'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--capacity', type=int, default=100000, help='ids per half window')
+        parser.add_argument('--exact-size', type=int, default=10000, help='ids kept by the local store')
+        parser.add_argument('--error-rate', type=float, action='append',
+                            help='configured false positive rate, repeat for several, 1%%, 0.1%% and 0.01%% by default')
+
+    def handle(self, *args, **options):
+        capacity, exact_size = options['capacity'], options['exact_size']
+        # the local store holds the last ids only, whatever the capacity
+        local_bytes = local_store_bytes(exact_size)
+        self.stdout.write(f'local id store of {exact_size} ids: {local_bytes / 1024:.0f}KB')
+        self.stdout.write(f'{"error rate":>12}{"measured":>12}{"filter":>12}{"local total":>14}{"checks/s":>12}')
+        for error_rate in options['error_rate'] or [0.01, 0.001, 0.0001]:
+            bloom = RollingBloomFilter(capacity, error_rate, window=60, clock=frozen)
+            for i in range(capacity):
+                bloom.add(f'chat_room{i % 100} id-{i}')
+            false_positives = sum(f'chat_room{i % 100} other-{i}' in bloom for i in range(capacity))
+
+            deduplicator = Deduplicator(capacity=capacity, error_rate=error_rate, exact_size=exact_size, clock=frozen)
+            rate = asyncio.run(check_rate(deduplicator, capacity))
+
+            # with the redis store the filter is all the process keeps
+            self.stdout.write(f'{error_rate:>12.4%}{false_positives / capacity:>12.4%}'
+                              f'{bloom.nbytes / 1024:>10.0f}KB{(bloom.nbytes + local_bytes) / 1024:>12.0f}KB'
+                              f'{rate:>12.0f}')
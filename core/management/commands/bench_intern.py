@@ -0,0 +1,69 @@
+import gc
+import json
+import time
+import random
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+
+from core.blueprint import Field
+from core.blueprint import bench
+
+STATUSES = ('online', 'away', 'busy', 'offline', 'invisible')
+
+
+def make_class(intern: bool):
+    return bench.make_blueprint_class({
+        'name': Field(),
+        'status': Field(intern=intern),
+        'room': Field(intern=intern),
+        'country': Field(intern=intern),
+        'score': Field(data_type=int),
+    }, 'Interned' if intern else 'Plain')
+
+
+def make_payloads(count: int, rooms: int, countries: int):
+    """json lines like a snapshot read from the db: few distinct values but unique names"""
+    rng = random.Random(0)
+    return [json.dumps({
+        'name': f'user {i}',
+        'status': rng.choice(STATUSES),
+        'room': f'room {rng.randrange(rooms)}',
+        'country': f'country {rng.randrange(countries)}',
+        'score': rng.randrange(1000),
+    }) for i in range(count)]
+
+
+def run_round(blueprint_class, payloads):
+    """(bytes held by the decoded instances, seconds to build them)"""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        instances = [blueprint_class(**json.loads(payload)) for payload in payloads]
+        elapsed = time.perf_counter() - start
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del instances
+    return current, elapsed
+
+
+class Command(BaseCommand):
+    help = 'Measure memory held by blueprints decoded from json with and without interned fields'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--instances', type=int, default=1000000, help='blueprints decoded per round')
+        parser.add_argument('--rooms', type=int, default=1000, help='distinct room values')
+        parser.add_argument('--countries', type=int, default=200, help='distinct country values')
+
+    def handle(self, *args, **options):
+        payloads = make_payloads(options['instances'], options['rooms'], options['countries'])
+        results = {}
+        for name, intern in (('plain', False), ('interned', True)):
+            results[name] = run_round(make_class(intern), payloads)
+            held, elapsed = results[name]
+            self.stdout.write(f'{name:>10}: {held / 2 ** 20:10.1f}MB {elapsed:8.2f}s')
+        saved = results['plain'][0] - results['interned'][0]
+        self.stdout.write(f'{"saved":>10}: {saved / 2 ** 20:10.1f}MB '
+                          f'({saved / results["plain"][0]:.0%}, {saved / options["instances"]:.0f} bytes/instance)')
@@ -0,0 +1,70 @@
+import time
+import asyncio
+import logging
+import tempfile
+
+from django.conf import settings
+from django.test import override_settings
+from django.core.management.base import BaseCommand
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+
+from chat import routing
+from core.log import queue_logging
+
+
+async def run_round(messages: int) -> float:
+    """messages per second through a ChatConsumer (receive, group send, handler, send)"""
+    communicator = WebsocketCommunicator(URLRouter(routing.websocket_urlpatterns), '/ws/chat/bench_logging/')
+    await communicator.connect()
+    start = time.perf_counter()
+    for i in range(messages):
+        await communicator.send_json_to({'message': f'message {i} 2'})
+        await communicator.receive_json_from()
+    elapsed = time.perf_counter() - start
+    await communicator.disconnect()
+    return messages / elapsed
+
+
+class Command(BaseCommand):
+    help = 'Measure chat messages per second with logging off, queued or written synchronously'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=2000, help='messages sent per round')
+        parser.add_argument('--repeat', type=int, default=3, help='rounds per setup, the best one is reported')
+
+    def handle(self, *args, **options):
+        config = dict(settings.QUEUE_LOGGING)
+        loggers = config['loggers']
+        # a real file, like a worker writing its log, not a terminal
+        log_file = tempfile.NamedTemporaryFile('w', suffix='.log')
+        rounds = (
+            ('off', dict(config, level='WARNING')),
+            ('queued', dict(config, level='DEBUG')),
+            ('queued, not sampled', dict(config, level='DEBUG', sample_rates={})),
+            ('synchronous', None),
+        )
+        with override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}):
+            queue_logging.stop()
+            # warm up imports and caches so the first setup is not penalized
+            asyncio.run(run_round(min(options['messages'], 200)))
+            for name, round_config in rounds:
+                queue_logging.stop()
+                handler = logging.StreamHandler(log_file)
+                handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s'))
+                if round_config is not None:
+                    queue_logging.configure(round_config, handlers=[handler])
+                else:
+                    # every record formatted and written on the event loop
+                    for logger_name in loggers:
+                        logger = logging.getLogger(logger_name)
+                        logger.setLevel(logging.DEBUG)
+                        logger.addHandler(handler)
+                        logger.propagate = False
+                rate = max(asyncio.run(run_round(options['messages'])) for _ in range(options['repeat']))
+                if round_config is None:
+                    for logger_name in loggers:
+                        logging.getLogger(logger_name).removeHandler(handler)
+                self.stdout.write(f'{name:>20}: {rate:10.0f} messages/s')
+        queue_logging.configure(config)
+        log_file.close()
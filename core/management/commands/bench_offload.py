@@ -0,0 +1,71 @@
+import json
+import time
+import typing
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from core.offload import offload
+from core.offload import get_pool
+from core.offload import shutdown_pools
+from core.metrics.loop import LoopLagMonitor
+
+
+def make_frame(size: int) -> typing.AnyStr:
+    return json.dumps({'message': 'state', 'items': [{'id': i, 'name': f'item_{i}'} for i in range(size)]})
+
+
+def heavy_handler(text_data: typing.AnyStr) -> int:
+    """parse a big frame and do some work on it, result is small"""
+    data = json.loads(text_data)
+    return sum(len(item['name']) * item['id'] % 7 for item in data['items'])
+
+
+heavy_handler_offloaded = offload('cpu')(heavy_handler)
+
+
+async def run_round(handler: typing.Callable, frame: typing.AnyStr, messages: int, offloaded: bool):
+    monitor = LoopLagMonitor(interval=0.005, name=f'bench_offload.{"offloaded" if offloaded else "inline"}')
+    monitor.start()
+    # let the monitor take a first sample before the load starts
+    await asyncio.sleep(0.02)
+    start = time.perf_counter()
+    if offloaded:
+        await asyncio.gather(*(handler(frame) for _ in range(messages)))
+    else:
+        for _ in range(messages):
+            handler(frame)
+            # yield like a consumer would between two messages
+            await asyncio.sleep(0)
+    elapsed = time.perf_counter() - start
+    await monitor.stop()
+    return elapsed, monitor.lag
+
+
+class Command(BaseCommand):
+    help = 'Measure event loop lag while cpu heavy handlers run inline or in the offload pool'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=50, help='number of messages to handle')
+        parser.add_argument('--items', type=int, default=20000, help='items in every frame')
+
+    def handle(self, *args, **options):
+        frame = make_frame(options['items'])
+        self.stdout.write(f'frame size: {len(frame)} bytes, messages: {options["messages"]}')
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        # warm up every worker of the pool so process start up is not measured
+        small_frame = make_frame(1)
+        loop.run_until_complete(asyncio.gather(
+            *(heavy_handler_offloaded(small_frame) for _ in range(get_pool('cpu').max_workers * 4))
+        ))
+
+        for offloaded, handler in ((False, heavy_handler), (True, heavy_handler_offloaded)):
+            elapsed, lag = loop.run_until_complete(run_round(handler, frame, options['messages'], offloaded))
+            self.stdout.write(
+                f'{"offloaded" if offloaded else "inline":>10}: total {elapsed:.3f}s, '
+                f'loop lag mean {lag.mean * 1000:.2f}ms, max {lag.max * 1000:.2f}ms'
+            )
+        loop.run_until_complete(shutdown_pools())
+        loop.close()
@@ -0,0 +1,35 @@
+import statistics
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.startup import check_budget
+from core.startup import profile_import
+
+
+class Command(BaseCommand):
+    help = 'Import the ASGI application in fresh interpreters with -X importtime and report the slowest imports'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--module', default=settings.STARTUP_BUDGET['module'], help='module to import')
+        parser.add_argument('--runs', type=int, default=5, help='fresh interpreters to import the module in')
+        parser.add_argument('--top', type=int, default=15, help='slowest modules to list')
+        parser.add_argument('--cumulative', action='store_true', help='rank modules by cumulative import time')
+
+    def handle(self, *args, **options):
+        profiles = [profile_import(options['module']) for _ in range(options['runs'])]
+        totals = [profile.total for profile in profiles]
+        # the median run is the least noisy one to list
+        profile = sorted(profiles, key=lambda p: p.total)[len(profiles) // 2]
+        self.stdout.write(
+            f'{options["module"]}: median {statistics.median(totals):.3f}s, min {min(totals):.3f}s, '
+            f'max {max(totals):.3f}s, {len(profile.modules)} modules'
+        )
+        for name, seconds in profile.heaviest(options['top'], cumulative=options['cumulative']):
+            self.stdout.write(f'{seconds * 1000:10.2f}ms  {name}')
+
+        violations = check_budget(profile)
+        for violation in violations:
+            self.stderr.write(violation)
+        if not violations:
+            self.stdout.write('within budget')
@@ -0,0 +1,38 @@
+import asyncio
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from core.sharding import get_shards
+from core.sharding import rebalance
+
+
+class Command(BaseCommand):
+    help = ('Move the keys of the REDIS_SHARDS nodes to their owner after the nodes changed. Run it once every '
+            'worker is deployed with the new nodes in REDIS_SHARDS["nodes"] and the old ones in '
+            'REDIS_SHARDS["previous_nodes"] (keys not moved yet are read from their old node, writes only go '
+            'to the new one), then deploy without "previous_nodes". Channel layer keys expire on their own '
+            'and are not moved.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='keys per DUMP / RESTORE pipeline')
+        parser.add_argument('--dry-run', action='store_true', help='only count the keys to move')
+
+    def handle(self, *args, **options):
+        if not settings.REDIS_SHARDS.get('previous_nodes'):
+            # nothing to read from meanwhile, a moved key would be missing for workers on the old ring
+            raise CommandError('set REDIS_SHARDS["previous_nodes"] to the nodes before the change and deploy first')
+        shards = get_shards()
+
+        async def run():
+            try:
+                return await rebalance(shards, dry_run=options['dry_run'], batch_size=options['batch_size'])
+            finally:
+                await shards.close()
+
+        moves = asyncio.run(run())
+        verb = 'to move' if options['dry_run'] else 'moved'
+        for (source, target), count in sorted(moves.items()):
+            self.stdout.write(f'{source} -> {target}: {count} keys {verb}')
+        self.stdout.write(f'{sum(moves.values())} keys {verb} in total')
@@ -0,0 +1,41 @@
+"""
+Process level listeners (state topics, control lanes) join their groups once and live longer
+than channels_redis keeps group members (group_expiry, a day by default): `keep_groups` joins
+them again well before they expire.
+"""
+import typing
+import asyncio
+import logging
+
+from django.conf import settings
+from channels.layers import get_channel_layer
+
+logger = logging.getLogger(__name__)
+
+# channels_redis' default
+DEFAULT_GROUP_EXPIRY = 86400
+# group memberships are renewed this many times per group_expiry
+GROUP_RENEWALS = 4
+# seconds a failed listener waits before receiving again
+LISTENER_RETRY_DELAY = 1.0
+
+
+def group_refresh_interval(alias: typing.AnyStr = 'default') -> float:
+    config = settings.CHANNEL_LAYERS[alias].get('CONFIG', {})
+    return config.get('group_expiry', DEFAULT_GROUP_EXPIRY) / GROUP_RENEWALS
+
+
+async def keep_groups(channel_name: typing.AnyStr, groups: typing.Callable[[], typing.Iterable[typing.AnyStr]],
+                      interval: float = None):
+    """group_add the channel to `groups()` every `interval` seconds, run as a task next to its listener"""
+    if interval is None:
+        interval = group_refresh_interval()
+    channel_layer = get_channel_layer()
+    while True:
+        await asyncio.sleep(interval)
+        for group in list(groups()):
+            try:
+                await channel_layer.group_add(group, channel_name)
+            except Exception as e:
+                # tried again next round, still well before the membership expires
+                logger.error('renewing %s in group %s failed: %r', channel_name, group, e)
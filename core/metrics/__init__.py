@@ -0,0 +1,95 @@
+import time
+import typing
+import contextlib
+
+
+class Counter:
+    def __init__(self, name: typing.AnyStr):
+        self.name: typing.AnyStr = name
+        self.value: int = 0
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+    def snapshot(self) -> typing.Dict:
+        return {'value': self.value}
+
+
+class Gauge:
+    def __init__(self, name: typing.AnyStr):
+        self.name: typing.AnyStr = name
+        self.value: typing.Any = 0
+
+    def set(self, value: typing.Any):
+        self.value = value
+
+    def snapshot(self) -> typing.Dict:
+        return {'value': self.value}
+
+
+class Timer:
+    """count / total / max / last of observed durations, in seconds"""
+    def __init__(self, name: typing.AnyStr):
+        self.name: typing.AnyStr = name
+        self.count: int = 0
+        self.total: float = 0.0
+        self.max: float = 0.0
+        self.last: float = 0.0
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.last = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    @contextlib.contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def snapshot(self) -> typing.Dict:
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.mean,
+            'max': self.max,
+            'last': self.last,
+        }
+
+
+# process wide registry, name -> metric instance
+METRICS: typing.Dict[typing.AnyStr, typing.Any] = {}
+
+
+def _get_or_create(metric_class, name: typing.AnyStr):
+    metric = METRICS.get(name)
+    if metric is None:
+        metric = metric_class(name)
+        METRICS[name] = metric
+    elif not isinstance(metric, metric_class):
+        raise TypeError(f'metric {name} already registered as {type(metric).__name__}')
+    return metric
+
+
+def counter(name: typing.AnyStr) -> Counter:
+    return _get_or_create(Counter, name)
+
+
+def gauge(name: typing.AnyStr) -> Gauge:
+    return _get_or_create(Gauge, name)
+
+
+def timer(name: typing.AnyStr) -> Timer:
+    return _get_or_create(Timer, name)
+
+
+def snapshot() -> typing.Dict:
+    return {name: metric.snapshot() for name, metric in METRICS.items()}
@@ -0,0 +1,105 @@
+import sys
+import time
+import typing
+import asyncio
+import logging
+import threading
+import collections
+
+from django.conf import settings
+
+from core import metrics
+from core.metrics.sampling import frame_stack
+from core.metrics.sampling import handler_name
+
+logger = logging.getLogger(__name__)
+
+
+class LoopLagMonitor:
+    """
+    Measure event loop lag: how late a sleep(interval) wakes up compared to when it was due.
+    Anything that blocks the loop (cpu heavy handlers, synchronous io) shows up as lag.
+
+    With a slow_threshold, a watchdog thread looks at the loop thread while it is blocked for
+    longer than that, so the block is recorded with the stack that caused it and the consumer
+    handler it ran in (chat_message, message_init...), see `slow_callbacks`.
+    """
+    def __init__(self, interval: float = 0.1, name: typing.AnyStr = 'loop',
+                 slow_threshold: typing.Optional[float] = None, max_records: int = 100):
+        self.interval: float = interval
+        self.name: typing.AnyStr = name
+        self.slow_threshold: typing.Optional[float] = slow_threshold
+        self.task: typing.Optional[asyncio.Task] = None
+
+        # set by the loop, read by the watchdog
+        self.loop_thread: typing.Optional[int] = None
+        self.last_tick: typing.Optional[float] = None
+        # set by the watchdog: the tick it caught blocked and what the loop was running
+        self.stall_tick: typing.Optional[float] = None
+        self.stall: typing.Optional[typing.Dict] = None
+        self.watchdog: typing.Optional[threading.Thread] = None
+        self.stopping = threading.Event()
+        self.slow_callbacks: typing.Deque[typing.Dict] = collections.deque(maxlen=max_records)
+
+        self.lag = metrics.timer(f'{name}.lag')
+        self.current_lag = metrics.gauge(f'{name}.current_lag')
+        self.slow = metrics.counter(f'{name}.slow_callbacks')
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        self.loop_thread = threading.get_ident()
+        while True:
+            expected = loop.time() + self.interval
+            tick = self.last_tick = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            self.lag.observe(lag)
+            self.current_lag.set(lag)
+            if self.slow_threshold is not None and lag > self.slow_threshold:
+                self.record_slow(lag, self.stall if self.stall_tick == tick else None)
+
+    def record_slow(self, lag: float, stall: typing.Optional[typing.Dict]):
+        stall = stall or {'handler': None, 'stack': []}
+        self.slow.inc()
+        self.slow_callbacks.append(dict(stall, lag=lag, at=time.time()))
+        logger.warning('event loop blocked for %.3fs in %s', lag, stall['handler'] or 'unknown handler')
+
+    def watch(self):
+        while not self.stopping.wait(min(self.interval, self.slow_threshold) / 2):
+            tick = self.last_tick
+            if tick is None or tick == self.stall_tick:
+                continue
+            if time.monotonic() - tick > self.interval + self.slow_threshold:
+                frame = sys._current_frames().get(self.loop_thread)
+                if frame is not None:
+                    self.stall = {'handler': handler_name(frame), 'stack': frame_stack(frame)}
+                    self.stall_tick = tick
+                del frame
+
+    def start(self):
+        loop = asyncio.get_event_loop()
+        # restart when the previous task died or belongs to another (e.g. closed) event loop
+        if self.task is None or self.task.done() or self.task.get_loop() is not loop:
+            self.task = loop.create_task(self.run())
+        if self.slow_threshold is not None and (self.watchdog is None or not self.watchdog.is_alive()):
+            self.stopping.clear()
+            self.watchdog = threading.Thread(target=self.watch, name=f'{self.name}_watchdog', daemon=True)
+            self.watchdog.start()
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        if self.watchdog is not None:
+            self.stopping.set()
+            self.watchdog.join()
+            self.watchdog = None
+        self.last_tick = None
+
+
+# process wide monitor, started by the first component that needs it
+loop_monitor = LoopLagMonitor(**settings.LOOP_MONITOR)
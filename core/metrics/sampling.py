@@ -0,0 +1,71 @@
+"""
+Stacks of another thread (the event loop thread) read with sys._current_frames, as folded
+"caller;callee" labels: the collapsed stack format of flamegraph.pl / speedscope.
+"""
+import sys
+import time
+import typing
+import threading
+import collections
+
+# innermost frame of a module with this suffix names the handler a stack ran in
+HANDLER_MODULE_SUFFIX = 'consumers'
+
+
+def frame_label(frame) -> typing.AnyStr:
+    code = frame.f_code
+    # co_qualname is 3.11+, it carries the class name
+    return f'{frame.f_globals.get("__name__", "?")}:{getattr(code, "co_qualname", code.co_name)}'
+
+
+def frame_stack(frame) -> typing.List[typing.AnyStr]:
+    """labels of the frame and its callers, outermost first"""
+    stack = []
+    while frame is not None:
+        stack.append(frame_label(frame))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+def handler_name(frame) -> typing.Optional[typing.AnyStr]:
+    """name of the innermost consumer method in the stack: chat_message, receive..."""
+    while frame is not None:
+        if frame.f_globals.get('__name__', '').endswith(HANDLER_MODULE_SUFFIX):
+            return frame.f_code.co_name
+        frame = frame.f_back
+    return None
+
+
+class SamplingProfiler:
+    """
+    Sample the stack of one thread every `interval` seconds and count identical stacks.
+    Runs in a thread of its own, the profiled thread does not pay for it besides the GIL switch.
+    """
+    def __init__(self, thread_id: int, interval: float = 0.005):
+        self.thread_id: int = thread_id
+        self.interval: float = interval
+        self.counts: typing.Counter = collections.Counter()
+        self.samples: int = 0
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is not None:
+            self.counts[';'.join(frame_stack(frame))] += 1
+            self.samples += 1
+        del frame
+
+    def run(self, seconds: float) -> 'SamplingProfiler':
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            self.sample()
+            time.sleep(self.interval)
+        return self
+
+    def collapsed(self) -> typing.AnyStr:
+        """one 'frame;frame;frame count' line per distinct stack, hottest first"""
+        return ''.join(f'{stack} {count}\n' for stack, count in self.counts.most_common())
+
+
+# one profile at a time per process, profiles of a busy loop are only meaningful alone
+profile_lock = threading.Lock()
@@ -0,0 +1,22 @@
+# Generated by Django 3.1.5 on 2026-10-19 12:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='blueprintrecord',
+            name='key',
+            field=models.CharField(max_length=255),
+        ),
+        migrations.AddConstraint(
+            model_name='blueprintrecord',
+            constraint=models.UniqueConstraint(fields=('kind', 'key'), name='core_blueprintrecord_kind_key'),
+        ),
+    ]
@@ -1,3 +1,18 @@
 from django.db import models
 
-# Create your models here.
+
+class BlueprintRecord(models.Model):
+    """stored blueprint payload of core.async_db.db_orm, leaf fields may be mapped to columns of other models"""
+    key = models.CharField(max_length=255)
+    kind = models.CharField(max_length=64, db_index=True)
+    data = models.JSONField(default=dict)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        # blueprint ids are unique within their class only
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'key'], name='core_blueprintrecord_kind_key'),
+        ]
+
+    def __str__(self):
+        return self.key
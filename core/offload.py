@@ -0,0 +1,196 @@
+import json
+import pickle
+import typing
+import asyncio
+import inspect
+import importlib
+import functools
+import concurrent.futures
+
+from django.conf import settings
+from channels.consumer import get_handler_name
+
+from core import metrics
+from core.asgi_middleware import lifespan
+
+
+class Pool:
+    """an executor plus a limit of calls in flight, waiting callers queue on the event loop"""
+    def __init__(self, name: typing.AnyStr, kind: typing.AnyStr = 'process', max_workers: int = 2,
+                 max_pending: int = 64):
+        if kind not in ('process', 'thread'):
+            raise ValueError(f'unknown kind {kind} of offload pool {name}')
+        self.name: typing.AnyStr = name
+        self.kind: typing.AnyStr = kind
+        self.max_workers: int = max_workers
+        self.max_pending: int = max_pending
+        self.executor: typing.Optional[concurrent.futures.Executor] = None
+        # the limit of calls in flight, one per event loop
+        self.semaphores: typing.Dict[asyncio.AbstractEventLoop, asyncio.Semaphore] = {}
+        self.running: int = 0
+
+        self.in_flight = metrics.gauge(f'offload.{name}.in_flight')
+        self.latency = metrics.timer(f'offload.{name}.latency')
+        self.payload_bytes = metrics.counter(f'offload.{name}.payload_bytes')
+
+    def get_executor(self) -> concurrent.futures.Executor:
+        if self.executor is None:
+            if self.kind == 'process':
+                self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers)
+            else:
+                self.executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix=f'offload_{self.name}'
+                )
+        return self.executor
+
+    def get_semaphore(self, loop: asyncio.AbstractEventLoop) -> asyncio.Semaphore:
+        semaphore = self.semaphores.get(loop)
+        if semaphore is None:
+            # the ones of closed loops have no waiter left
+            for closed in [other for other in self.semaphores if other.is_closed()]:
+                del self.semaphores[closed]
+            semaphore = self.semaphores[loop] = asyncio.Semaphore(self.max_pending)
+        return semaphore
+
+    async def run(self, func: typing.Callable, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        async with self.get_semaphore(loop):
+            self.running += 1
+            self.in_flight.set(self.running)
+            try:
+                with self.latency.time():
+                    if self.kind == 'process':
+                        packed = pickle.dumps((args, kwargs), protocol=pickle.HIGHEST_PROTOCOL)
+                        self.payload_bytes.inc(len(packed))
+                        packed_result = await loop.run_in_executor(
+                            self.get_executor(), call_packed, func.__module__, func.__qualname__, packed
+                        )
+                        self.payload_bytes.inc(len(packed_result))
+                        result = pickle.loads(packed_result)
+                    else:
+                        # same process, nothing to serialize
+                        result = await loop.run_in_executor(
+                            self.get_executor(), functools.partial(func, *args, **kwargs)
+                        )
+            finally:
+                self.running -= 1
+                self.in_flight.set(self.running)
+        return result
+
+    def shutdown(self, wait: bool = True):
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait)
+            self.executor = None
+
+
+def call_packed(module_name: typing.AnyStr, qualname: typing.AnyStr, packed: bytes) -> bytes:
+    """runs in the worker process, resolve the offloaded function by name and call it"""
+    target = importlib.import_module(module_name)
+    for attr in qualname.split('.'):
+        target = getattr(target, attr)
+    # the module attribute is the async wrapper created by @offload, call the wrapped function
+    func = getattr(target, '__wrapped__', target)
+    args, kwargs = pickle.loads(packed)
+    return pickle.dumps(func(*args, **kwargs), protocol=pickle.HIGHEST_PROTOCOL)
+
+
+POOLS: typing.Dict[typing.AnyStr, Pool] = {}
+
+
+def get_pool(name: typing.AnyStr) -> Pool:
+    pool = POOLS.get(name)
+    if pool is None:
+        if name not in settings.OFFLOAD_POOLS:
+            raise KeyError(f'offload pool {name} not configured in settings.OFFLOAD_POOLS')
+        pool = Pool(name, **settings.OFFLOAD_POOLS[name])
+        POOLS[name] = pool
+    return pool
+
+
+@lifespan.on_shutdown
+async def shutdown_pools():
+    for pool in POOLS.values():
+        pool.shutdown(wait=False)
+    POOLS.clear()
+
+
+def offload(pool_name: typing.AnyStr = 'cpu'):
+    """
+    Run a synchronous function in the named pool of settings.OFFLOAD_POOLS, callers await the result.
+    Functions offloaded to a process pool must be defined at module level,
+    arguments and results must be picklable.
+    """
+    def decorator(func: typing.Callable):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await get_pool(pool_name).run(func, *args, **kwargs)
+        wrapper.pool_name = pool_name
+        return wrapper
+    return decorator
+
+
+@offload('cpu')
+def loads_offloaded(text_data: typing.AnyStr) -> typing.Any:
+    return json.loads(text_data)
+
+
+async def loads_frame(text_data: typing.Optional[typing.AnyStr]) -> typing.Any:
+    """json.loads an inbound websocket frame, frames above OFFLOAD_FRAME_THRESHOLD are parsed in the cpu pool"""
+    if text_data is None:
+        # a frame without text nor bytes
+        return None
+    if len(text_data) < settings.OFFLOAD_FRAME_THRESHOLD:
+        return json.loads(text_data)
+    return await loads_offloaded(text_data)
+
+
+OFFLOAD_HANDLER_PREFIX = 'offload_'
+
+
+def handler_pool(pool_name: typing.AnyStr):
+    """pool of an offload_ handler other than the consumer's `offload_pool`"""
+    def decorator(func: typing.Callable):
+        func.pool_name = pool_name
+        return func
+    return decorator
+
+
+class OffloadHandlersMixin:
+    """
+    Handlers named offload_<name> run in an offload pool instead of the event loop, like chat_
+    handlers run as tasks: a message {'type': 'offload.<name>', ...} calls the static method
+    `offload_<name>(event)` in `offload_pool` (or the one set with @handler_pool), the returned
+    payload, if any, is sent to the client with send_payload (WireFormatMixin). The event and the
+    payload are pickled, in one piece.
+
+        @staticmethod
+        def offload_search(event):
+            return {'found': [...]}
+
+    Consumers overriding dispatch call `dispatch_offloaded` for these handler names.
+    """
+    offload_pool: typing.AnyStr = 'cpu'
+
+    @classmethod
+    def is_offloaded(cls, handler_name: typing.AnyStr) -> bool:
+        return handler_name.startswith(OFFLOAD_HANDLER_PREFIX)
+
+    async def run_offloaded(self, handler_name: typing.AnyStr, event: typing.Dict) -> typing.Any:
+        handler = inspect.getattr_static(type(self), handler_name, None)
+        if not isinstance(handler, staticmethod):
+            # a bound method would pickle the whole consumer
+            raise ValueError(f'offloaded handler {handler_name} of {type(self).__name__} must be a static method')
+        func = handler.__func__
+        return await get_pool(getattr(func, 'pool_name', self.offload_pool)).run(func, event)
+
+    async def dispatch_offloaded(self, handler_name: typing.AnyStr, message: typing.Dict):
+        payload = await self.run_offloaded(handler_name, message)
+        if payload is not None:
+            await self.send_payload(payload)
+
+    async def dispatch(self, message):
+        handler_name = get_handler_name(message)
+        if self.is_offloaded(handler_name):
+            await self.dispatch_offloaded(handler_name, message)
+        else:
+            await super(OffloadHandlersMixin, self).dispatch(message)
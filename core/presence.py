@@ -0,0 +1,228 @@
+import time
+import typing
+import logging
+import collections
+
+from django.conf import settings
+
+from core import metrics
+from core.timer_wheel import timer_wheel
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceIndex:
+    """
+    Who is connected to this process and in which rooms, with connection reference counts
+    (a user may have several sockets in the same room). Every query is O(1) or O(result).
+    """
+    def __init__(self):
+        # user -> number of open connections
+        self.users: typing.Dict[typing.Any, int] = {}
+        # room -> user -> number of connections of the user in the room
+        self.rooms: typing.Dict[typing.AnyStr, typing.Dict[typing.Any, int]] = collections.defaultdict(dict)
+        # user -> rooms, kept so that a user's rooms can be refreshed / listed without a scan
+        self.user_rooms: typing.Dict[typing.Any, typing.Set[typing.AnyStr]] = collections.defaultdict(set)
+
+    def connect(self, user) -> bool:
+        """returns True when this is the first connection of the user"""
+        self.users[user] = self.users.get(user, 0) + 1
+        return self.users[user] == 1
+
+    def disconnect(self, user) -> bool:
+        """returns True when the last connection of the user is gone"""
+        count = self.users.get(user, 0) - 1
+        if count > 0:
+            self.users[user] = count
+            return False
+        self.users.pop(user, None)
+        return True
+
+    def join(self, user, room) -> bool:
+        members = self.rooms[room]
+        members[user] = members.get(user, 0) + 1
+        self.user_rooms[user].add(room)
+        return members[user] == 1
+
+    def leave(self, user, room) -> bool:
+        members = self.rooms.get(room)
+        if members is None or user not in members:
+            return False
+        members[user] -= 1
+        if members[user] > 0:
+            return False
+        del members[user]
+        if not members:
+            del self.rooms[room]
+        rooms = self.user_rooms.get(user)
+        if rooms is not None:
+            rooms.discard(room)
+            if not rooms:
+                del self.user_rooms[user]
+        return True
+
+    def is_online(self, user) -> bool:
+        return user in self.users
+
+    def online_users(self, room) -> typing.List:
+        return list(self.rooms.get(room, ()))
+
+    def count(self, room) -> int:
+        return len(self.rooms.get(room, ()))
+
+    def room_counts(self) -> typing.Dict[typing.AnyStr, int]:
+        return {room: len(members) for room, members in self.rooms.items()}
+
+
+class Presence:
+    """
+    Local PresenceIndex mirrored to redis sorted sets scored by expiry time. Every process
+    refreshes the scores of its own users and rooms on a heartbeat, so entries of a crashed
+    process simply expire. Cluster queries only look at scores in the future.
+
+    Keys, namespaced by PROJECT_TAG:
+        <tag>:presence:online          user -> expires at
+        <tag>:presence:rooms           room -> expires at
+        <tag>:presence:room:<room>     user -> expires at
+    """
+    def __init__(self, redis=None, ttl: float = 30, heartbeat_interval: float = 10,
+                 namespace: typing.AnyStr = 'default'):
+        self.index = PresenceIndex()
+        self.redis = redis
+        self.ttl: float = ttl
+        self.heartbeat_interval: float = heartbeat_interval
+        self.prefix: typing.AnyStr = f'{namespace}:presence'
+        self.heartbeat_timer = None
+
+        self.online = metrics.gauge('presence.online')
+        self.heartbeat_latency = metrics.timer('presence.heartbeat_latency')
+
+    def online_key(self) -> typing.AnyStr:
+        return f'{self.prefix}:online'
+
+    def rooms_key(self) -> typing.AnyStr:
+        return f'{self.prefix}:rooms'
+
+    def room_key(self, room) -> typing.AnyStr:
+        return f'{self.prefix}:room:{room}'
+
+    async def get_redis(self):
+        if self.redis is None and settings.PRESENCE['redis']:
+            import aioredis
+            self.redis = await aioredis.create_redis_pool(**settings.PRESENCE['redis'])
+        return self.redis
+
+    def ensure_heartbeat(self):
+        if self.heartbeat_timer is None:
+            self.heartbeat_timer = timer_wheel.call_every(self.heartbeat_interval, self.heartbeat)
+
+    async def connect(self, user):
+        first = self.index.connect(user)
+        self.online.set(len(self.index.users))
+        redis = await self.get_redis()
+        if first and redis is not None:
+            self.ensure_heartbeat()
+            await redis.zadd(self.online_key(), time.time() + self.ttl, str(user))
+
+    async def disconnect(self, user):
+        # rooms still joined by the connection are left by the consumer before this is called
+        last = self.index.disconnect(user)
+        self.online.set(len(self.index.users))
+        redis = await self.get_redis()
+        if last and redis is not None:
+            await redis.zrem(self.online_key(), str(user))
+
+    async def join(self, user, room):
+        first = self.index.join(user, room)
+        redis = await self.get_redis()
+        if first and redis is not None:
+            self.ensure_heartbeat()
+            expires_at = time.time() + self.ttl
+            pipeline = redis.pipeline()
+            pipeline.zadd(self.room_key(room), expires_at, str(user))
+            pipeline.zadd(self.rooms_key(), expires_at, room)
+            await pipeline.execute()
+
+    async def leave(self, user, room):
+        last = self.index.leave(user, room)
+        redis = await self.get_redis()
+        if last and redis is not None:
+            # another process may still hold the user in the room, its next heartbeat adds it back
+            await redis.zrem(self.room_key(room), str(user))
+
+    async def heartbeat(self):
+        redis = await self.get_redis()
+        if redis is None:
+            return
+        now = time.time()
+        expires_at = now + self.ttl
+        start = time.perf_counter()
+        pipeline = redis.pipeline()
+        for user in self.index.users:
+            pipeline.zadd(self.online_key(), expires_at, str(user))
+        for room, members in self.index.rooms.items():
+            room_key = self.room_key(room)
+            for user in members:
+                pipeline.zadd(room_key, expires_at, str(user))
+            pipeline.zadd(self.rooms_key(), expires_at, room)
+            pipeline.zremrangebyscore(room_key, float('-inf'), now)
+        pipeline.zremrangebyscore(self.online_key(), float('-inf'), now)
+        pipeline.zremrangebyscore(self.rooms_key(), float('-inf'), now)
+        try:
+            await pipeline.execute()
+        except Exception as e:
+            logger.error('presence heartbeat failed: %r', e)
+        self.heartbeat_latency.observe(time.perf_counter() - start)
+
+    # cluster wide queries, entries whose expiry passed are ignored
+
+    async def cluster_online_users(self, room) -> typing.List[typing.AnyStr]:
+        redis = await self.get_redis()
+        if redis is None:
+            return [str(user) for user in self.index.online_users(room)]
+        members = await redis.zrangebyscore(self.room_key(room), time.time(), float('inf'), encoding='utf-8')
+        return list(members)
+
+    async def cluster_count(self, room) -> int:
+        redis = await self.get_redis()
+        if redis is None:
+            return self.index.count(room)
+        return await redis.zcount(self.room_key(room), time.time(), float('inf'))
+
+    async def cluster_is_online(self, user) -> bool:
+        redis = await self.get_redis()
+        if redis is None:
+            return self.index.is_online(user)
+        score = await redis.zscore(self.online_key(), str(user))
+        return score is not None and score > time.time()
+
+    async def cluster_room_counts(self) -> typing.Dict[typing.AnyStr, int]:
+        redis = await self.get_redis()
+        if redis is None:
+            return self.index.room_counts()
+        now = time.time()
+        rooms = await redis.zrangebyscore(self.rooms_key(), now, float('inf'), encoding='utf-8')
+        pipeline = redis.pipeline()
+        futures = [pipeline.zcount(self.room_key(room), now, float('inf')) for room in rooms]
+        await pipeline.execute()
+        counts = {}
+        for room, future in zip(rooms, futures):
+            count = await future
+            if count:
+                counts[room] = count
+        return counts
+
+
+def get_presence_user(scope) -> typing.Optional[typing.Any]:
+    """user id tracked by presence, anonymous connections are not tracked"""
+    user = scope.get('user')
+    if user is not None and user.is_authenticated:
+        return user.id
+    return None
+
+
+presence = Presence(
+    ttl=settings.PRESENCE['ttl'],
+    heartbeat_interval=settings.PRESENCE['heartbeat_interval'],
+    namespace=settings.PROJECT_TAG,
+)
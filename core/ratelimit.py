@@ -0,0 +1,161 @@
+import time
+import typing
+import collections
+
+from django.conf import settings
+
+from core import metrics
+
+
+class TokenBucket:
+    """refilled lazily on consume, so every operation is O(1) and idle buckets cost nothing"""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float, now: float = None):
+        self.rate: float = rate
+        self.capacity: float = capacity
+        self.tokens: float = capacity
+        self.updated: float = time.monotonic() if now is None else now
+
+    def refill(self, now: float = None):
+        if now is None:
+            now = time.monotonic()
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated = now
+
+    def refund(self, amount: float = 1):
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def consume(self, amount: float = 1, now: float = None) -> bool:
+        self.refill(now)
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+
+class BucketRegistry:
+    """token buckets by key, the least recently used bucket is dropped when max_size is reached"""
+    def __init__(self, rate: float, capacity: float, max_size: int = 100000):
+        self.rate: float = rate
+        self.capacity: float = capacity
+        self.max_size: int = max_size
+        self.buckets: collections.OrderedDict = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.buckets)
+
+    def get(self, key, now: float = None) -> TokenBucket:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.capacity, now)
+            self.buckets[key] = bucket
+            if len(self.buckets) > self.max_size:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+        return bucket
+
+    def consume(self, key, amount: float = 1, now: float = None) -> bool:
+        return self.get(key, now).consume(amount, now)
+
+
+def consume_all(buckets: typing.Iterable[TokenBucket], amount: float = 1, now: float = None) -> bool:
+    """take `amount` from every bucket if each of them has it, from none otherwise"""
+    buckets = list(buckets)
+    for bucket in buckets:
+        bucket.refill(now)
+        if bucket.tokens < amount:
+            return False
+    for bucket in buckets:
+        bucket.tokens -= amount
+    return True
+
+
+class RedisRateCounter:
+    """fixed window counters shared by every process, INCR + EXPIRE in one pipeline per check"""
+    def __init__(self, conn_args: typing.Dict, prefix: typing.AnyStr, window: int = 1):
+        self.conn_args: typing.Dict = conn_args
+        self.prefix: typing.AnyStr = prefix
+        self.window: int = window
+        self.redis = None
+
+    async def get_redis(self):
+        if self.redis is None:
+            import aioredis
+            self.redis = await aioredis.create_redis_pool(**self.conn_args)
+        return self.redis
+
+    async def allow(self, key, limit: int) -> bool:
+        redis = await self.get_redis()
+        window_key = f'{self.prefix}:{key}:{int(time.time()) // self.window}'
+        pipeline = redis.pipeline()
+        count_future = pipeline.incr(window_key)
+        pipeline.expire(window_key, self.window * 2)
+        await pipeline.execute()
+        return await count_future <= limit
+
+
+class RateLimiter:
+    """
+    per user and per room buckets, optionally backed by cluster wide redis counters.
+    Frames are limited per user where they arrive (RateLimitMiddleware), per room where their room
+    is known: one socket may carry several rooms (MultiplexChatConsumer).
+    """
+    def __init__(self, config: typing.Dict, project_tag: typing.AnyStr = ''):
+        self.user_buckets = BucketRegistry(
+            config['user']['rate'], config['user']['burst'], config['max_buckets']
+        )
+        self.room_buckets = BucketRegistry(
+            config['room']['rate'], config['room']['burst'], config['max_buckets']
+        )
+        self.redis_config: typing.Optional[typing.Dict] = config.get('redis')
+        self.redis_counter: typing.Optional[RedisRateCounter] = None
+        if self.redis_config:
+            self.redis_counter = RedisRateCounter(
+                self.redis_config['conn_args'], f'{project_tag}:ratelimit', self.redis_config.get('window', 1)
+            )
+        self.limited = metrics.counter('ratelimit.limited')
+
+    async def allow(self, user_key, room_key=None) -> bool:
+        buckets = [self.user_buckets.get(user_key)]
+        if room_key is not None:
+            buckets.append(self.room_buckets.get(room_key))
+        # a frame refused by the room bucket does not cost the user a token, nor the other way round
+        allowed = consume_all(buckets)
+        if allowed and self.redis_counter is not None:
+            allowed = await self.redis_counter.allow(f'user:{user_key}', self.redis_config['user_limit'])
+        if not allowed:
+            self.limited.inc()
+        return allowed
+
+    def allow_room(self, room_key, user_key=None) -> bool:
+        """a frame already let through for its user, the user's token is given back when the room refuses it"""
+        if self.room_buckets.consume(room_key):
+            return True
+        if user_key is not None:
+            self.user_buckets.get(user_key).refund()
+        self.limited.inc()
+        return False
+
+
+def rate_limit_user_key(scope):
+    """the user id, the client address for anonymous connections"""
+    user = scope.get('user')
+    if user is not None and user.is_authenticated:
+        return user.id
+    client = scope.get('client')
+    return client[0] if client else None
+
+
+rate_limiter: typing.Optional[RateLimiter] = None
+
+
+def get_rate_limiter() -> RateLimiter:
+    """shared by every connection of the process"""
+    global rate_limiter
+    if rate_limiter is None:
+        rate_limiter = RateLimiter(settings.RATE_LIMIT, settings.PROJECT_TAG)
+    return rate_limiter
@@ -1,7 +1,17 @@
 from django.urls import re_path
+from channels.auth import AuthMiddlewareStack
 
 from . import consumers
 
 websocket_urlpatterns = [
     re_path(r'ws/core/state/$', consumers.StateConsumer.as_asgi())
 ]
+
+http_urlpatterns = [
+    re_path(
+        r'export/(?P<name>\w+)\.(?P<file_format>\w+)$',
+        AuthMiddlewareStack(consumers.ExportConsumer.as_asgi())
+    ),
+    re_path(r'debug/loop/profile$', AuthMiddlewareStack(consumers.LoopProfileConsumer.as_asgi())),
+    re_path(r'debug/loop/slow$', AuthMiddlewareStack(consumers.SlowCallbacksConsumer.as_asgi())),
+]
@@ -0,0 +1,327 @@
+"""
+Client side sharding of redis keys over several nodes with a consistent hash ring. Every node
+owns `vnodes` points of the ring, a key belongs to the node of the first point after its hash:
+adding a node to N moves about 1/(N+1) of the keys, all of them to the new node.
+
+Keys are namespaced by PROJECT_TAG and routed by the part between braces, like redis cluster
+hash tags, so the keys of one user or room live together: 'default_project:db:{player.42}'.
+
+Changing the nodes takes three steps, no worker writes through a stale ring while keys move:
+    1. deploy every worker with the new nodes in REDIS_SHARDS['nodes'] and the old ones in
+       REDIS_SHARDS['previous_nodes']: writes go to the new owner, a key missing there is read
+       from its previous owner, it was not moved yet
+    2. run `manage.py rebalance_redis`, moving the keys to their new owner
+    3. deploy without 'previous_nodes'
+"""
+import bisect
+import typing
+import asyncio
+import hashlib
+import logging
+
+from django.conf import settings
+
+from core import metrics
+
+logger = logging.getLogger(__name__)
+
+
+# KEYS the keys, ARGV expected and new value of each key in turn, returns the keys set
+COMPARE_AND_SET_SCRIPT = """
+local written = {}
+for i, key in ipairs(KEYS) do
+    if redis.call('GET', key) == ARGV[2 * i - 1] then
+        redis.call('SET', key, ARGV[2 * i])
+        written[#written + 1] = key
+    end
+end
+return written
+"""
+
+
+def ring_hash(value: typing.AnyStr) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def routing_key(key: typing.AnyStr) -> typing.AnyStr:
+    """the hash tag of the key if it has one, the whole key otherwise"""
+    start = key.find('{')
+    if start != -1:
+        end = key.find('}', start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+
+class HashRing:
+    def __init__(self, nodes: typing.Iterable[typing.AnyStr] = (), vnodes: int = 160):
+        self.vnodes: int = vnodes
+        self.nodes: typing.Set[typing.AnyStr] = set()
+        # sorted points and the node owning each
+        self.points: typing.List[int] = []
+        self.owners: typing.List[typing.AnyStr] = []
+        for node in nodes:
+            self.add_node(node)
+
+    def add_node(self, node: typing.AnyStr):
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for i in range(self.vnodes):
+            point = ring_hash(f'{node}#{i}')
+            index = bisect.bisect(self.points, point)
+            self.points.insert(index, point)
+            self.owners.insert(index, node)
+
+    def remove_node(self, node: typing.AnyStr):
+        if node not in self.nodes:
+            return
+        self.nodes.discard(node)
+        kept = [(point, owner) for point, owner in zip(self.points, self.owners) if owner != node]
+        self.points = [point for point, _ in kept]
+        self.owners = [owner for _, owner in kept]
+
+    def node_for(self, key: typing.AnyStr) -> typing.AnyStr:
+        if not self.points:
+            raise KeyError('hash ring without nodes')
+        index = bisect.bisect(self.points, ring_hash(routing_key(key)))
+        return self.owners[index % len(self.points)]
+
+    def split(self, keys: typing.Iterable[typing.AnyStr]) -> typing.Dict[typing.AnyStr, typing.List[typing.AnyStr]]:
+        """node -> its keys, in the given order"""
+        by_node: typing.Dict[typing.AnyStr, typing.List[typing.AnyStr]] = {}
+        for key in keys:
+            by_node.setdefault(self.node_for(key), []).append(key)
+        return by_node
+
+
+def plan_moves(ring: HashRing, located: typing.Dict[typing.AnyStr, typing.Iterable[typing.AnyStr]]
+               ) -> typing.Dict[typing.Tuple[typing.AnyStr, typing.AnyStr], typing.List[typing.AnyStr]]:
+    """(from node, to node) -> keys, for the keys found on a node the ring does not assign them to"""
+    moves: typing.Dict[typing.Tuple[typing.AnyStr, typing.AnyStr], typing.List[typing.AnyStr]] = {}
+    for node, keys in located.items():
+        for key in keys:
+            owner = ring.node_for(key)
+            if owner != node:
+                moves.setdefault((node, owner), []).append(key)
+    return moves
+
+
+class ShardedRedis:
+    """
+    aioredis clients of the nodes (name -> conn args), one connection pool per node created on
+    first use. Multi key operations are split per node and sent as one command or pipeline per
+    node, the nodes concurrently.
+    """
+    def __init__(self, nodes: typing.Dict[typing.AnyStr, typing.Dict], vnodes: int = 160,
+                 namespace: typing.AnyStr = None, clients: typing.Dict = None,
+                 previous_nodes: typing.Dict[typing.AnyStr, typing.Dict] = None):
+        # nodes of both rings, those of the previous one only are still read and emptied by rebalance
+        self.nodes: typing.Dict[typing.AnyStr, typing.Dict] = dict(previous_nodes or {}, **nodes)
+        self.ring = HashRing(nodes, vnodes)
+        # the ring before the last change of nodes, while its keys are being moved
+        self.previous_ring: typing.Optional[HashRing] = HashRing(previous_nodes, vnodes) if previous_nodes else None
+        self.namespace: typing.AnyStr = namespace or settings.PROJECT_TAG
+        # node -> connected client, injected clients are used as they are
+        self.clients: typing.Dict = dict(clients or {})
+        self.connect_lock: typing.Optional[asyncio.Lock] = None
+
+        self.moved = metrics.counter('sharding.moved')
+        # keys found on both nodes of a move, the target's copy written through the new ring is kept
+        self.kept_target = metrics.counter('sharding.kept_target')
+        # reads of keys not moved yet, from their previous owner
+        self.previous_reads = metrics.counter('sharding.previous_reads')
+        self.failures = metrics.counter('sharding.move_failures')
+
+    def key(self, kind: typing.AnyStr, ident, suffix: typing.AnyStr = '') -> typing.AnyStr:
+        """namespaced key routed by `ident`: '<tag>:<kind>:{<ident>}<suffix>'"""
+        return f'{self.namespace}:{kind}:{{{ident}}}{suffix}'
+
+    async def client(self, node: typing.AnyStr):
+        client = self.clients.get(node)
+        if client is None:
+            if self.connect_lock is None:
+                self.connect_lock = asyncio.Lock()
+            async with self.connect_lock:
+                client = self.clients.get(node)
+                if client is None:
+                    import aioredis
+                    client = self.clients[node] = await aioredis.create_redis_pool(**self.nodes[node])
+        return client
+
+    async def client_for(self, key: typing.AnyStr):
+        return await self.client(self.ring.node_for(key))
+
+    def previous_owner(self, key: typing.AnyStr) -> typing.Optional[typing.AnyStr]:
+        """owner of the key in the previous ring if another node, the key may still be there"""
+        if self.previous_ring is None:
+            return None
+        node = self.previous_ring.node_for(key)
+        return None if node == self.ring.node_for(key) else node
+
+    async def per_node(self, keys: typing.Iterable[typing.AnyStr], operation: typing.Callable,
+                       ring: HashRing = None) -> typing.List:
+        """await operation(client, node keys) for every node holding some of the keys, concurrently"""
+        by_node = (ring or self.ring).split(keys)
+        clients = [await self.client(node) for node in by_node]
+        return await asyncio.gather(*(
+            operation(client, node_keys) for client, node_keys in zip(clients, by_node.values())
+        ))
+
+    async def get(self, key: typing.AnyStr):
+        value = await (await self.client_for(key)).get(key)
+        previous = self.previous_owner(key)
+        if value is None and previous is not None:
+            value = await (await self.client(previous)).get(key)
+            if value is None:
+                # moved between the two reads
+                value = await (await self.client_for(key)).get(key)
+            else:
+                self.previous_reads.inc()
+        return value
+
+    async def set(self, key: typing.AnyStr, value):
+        return await (await self.client_for(key)).set(key, value)
+
+    async def mget(self, keys: typing.Iterable[typing.AnyStr]) -> typing.Dict:
+        """key -> value of the keys that exist, one MGET per node"""
+        keys = list(keys)
+        found = await self.mget_from(keys, self.ring)
+        if self.previous_ring is not None:
+            moving = [key for key in keys if key not in found and self.previous_owner(key) is not None]
+            if moving:
+                previous = await self.mget_from(moving, self.previous_ring)
+                self.previous_reads.inc(len(previous))
+                found.update(previous)
+                # moved between the two reads
+                missing = [key for key in moving if key not in previous]
+                if missing:
+                    found.update(await self.mget_from(missing, self.ring))
+        return found
+
+    async def mget_from(self, keys: typing.List[typing.AnyStr], ring: HashRing) -> typing.Dict:
+        async def node_mget(client, node_keys):
+            return zip(node_keys, await client.mget(*node_keys))
+        found = {}
+        for pairs in await self.per_node(keys, node_mget, ring):
+            found.update((key, value) for key, value in pairs if value is not None)
+        return found
+
+    async def mset(self, items: typing.Dict):
+        """one MSET per node"""
+        async def node_mset(client, node_keys):
+            pairs = []
+            for key in node_keys:
+                pairs.extend((key, items[key]))
+            await client.mset(*pairs)
+        await self.per_node(items, node_mset)
+
+    async def compare_and_set(self, items: typing.Dict) -> typing.List[typing.AnyStr]:
+        """key -> (expected, value): set the keys still holding their expected value, one script per node"""
+        async def node_compare_and_set(client, node_keys):
+            args = []
+            for key in node_keys:
+                args.extend(items[key])
+            return await client.eval(COMPARE_AND_SET_SCRIPT, keys=node_keys, args=args)
+        written = []
+        for keys in await self.per_node(items, node_compare_and_set):
+            written.extend(key.decode('utf-8') if isinstance(key, bytes) else key for key in keys)
+        return written
+
+    async def pipeline(self, keys: typing.Iterable[typing.AnyStr], command: typing.AnyStr, *args) -> typing.Dict:
+        """key -> result of `command key *args`, one pipeline per node"""
+        async def node_pipeline(client, node_keys):
+            pipe = client.pipeline()
+            futures = [getattr(pipe, command)(key, *args) for key in node_keys]
+            await pipe.execute()
+            return zip(node_keys, [future.result() for future in futures])
+        results = {}
+        for pairs in await self.per_node(keys, node_pipeline):
+            results.update(pairs)
+        return results
+
+    async def delete(self, keys: typing.Iterable[typing.AnyStr]):
+        """on the previous owners too, a key not moved yet would be read from there"""
+        async def node_delete(client, node_keys):
+            await client.delete(*node_keys)
+        keys = list(keys)
+        await self.per_node(keys, node_delete)
+        moving = [key for key in keys if self.previous_owner(key) is not None]
+        if moving:
+            await self.per_node(moving, node_delete, self.previous_ring)
+
+    async def scan(self, node: typing.AnyStr, match: typing.AnyStr = None) -> typing.List[typing.AnyStr]:
+        """
+        keys of one node matching the pattern, by default the keys of the 'db' kind (AsyncDBRedis):
+        other keys of the namespace, e.g. the channel layer's, are not routed by this ring
+        """
+        client = await self.client(node)
+        keys = []
+        async for key in client.iscan(match=match or f'{self.namespace}:db:*'):
+            keys.append(key.decode('utf-8') if isinstance(key, bytes) else key)
+        return keys
+
+    async def move(self, keys: typing.List[typing.AnyStr], source: typing.AnyStr, target: typing.AnyStr):
+        """
+        copy the keys with their ttl from source to target (DUMP / RESTORE), then delete them on source.
+        Only once every worker runs with the ring owning them to target (step 1 of the module doc): then
+        the source is only read from, a copy the target already has was written after the source's one.
+        RESTORE fails on it with BUSYKEY, the target's copy is kept and the source's dropped.
+        """
+        source_client, target_client = await self.client(source), await self.client(target)
+        pipe = source_client.pipeline()
+        dumps = [(pipe.dump(key), pipe.pttl(key)) for key in keys]
+        await pipe.execute()
+        pipe = target_client.pipeline()
+        restoring = []
+        for key, (dump, pttl) in zip(keys, dumps):
+            if dump.result() is None:
+                # expired or deleted meanwhile
+                continue
+            pipe.restore(key, max(pttl.result(), 0), dump.result())
+            restoring.append(key)
+        results = await pipe.execute(return_exceptions=True) if restoring else []
+        restored, done = 0, []
+        for key, result in zip(restoring, results):
+            if not isinstance(result, Exception):
+                restored += 1
+            elif str(result).startswith('BUSYKEY'):
+                self.kept_target.inc()
+            else:
+                # left on the source, a later rebalance tries again
+                self.failures.inc()
+                logger.error('moving %s from %s to %s failed: %r', key, source, target, result)
+                continue
+            done.append(key)
+        if done:
+            await source_client.delete(*done)
+        self.moved.inc(restored)
+        return restored
+
+    async def close(self):
+        for client in self.clients.values():
+            client.close()
+            await client.wait_closed()
+        self.clients.clear()
+
+
+async def rebalance(shards: ShardedRedis, dry_run: bool = False, batch_size: int = 500
+                    ) -> typing.Dict[typing.Tuple[typing.AnyStr, typing.AnyStr], int]:
+    """
+    Move the keys of the namespace found on a node other than their owner in `shards.ring`, once
+    every worker writes through that ring (see the module doc). Nodes of the previous ring only are
+    scanned and emptied. Returns (from node, to node) -> keys moved (to move when dry_run).
+    """
+    located = {node: await shards.scan(node) for node in shards.nodes}
+    moves = plan_moves(shards.ring, located)
+    for (source, target), keys in moves.items():
+        logger.debug('%s %d keys from %s to %s', 'would move' if dry_run else 'moving', len(keys), source, target)
+        if not dry_run:
+            for start in range(0, len(keys), batch_size):
+                await shards.move(keys[start:start + batch_size], source, target)
+    return {pair: len(keys) for pair, keys in moves.items()}
+
+
+def get_shards(config: typing.Dict = None) -> ShardedRedis:
+    config = config or settings.REDIS_SHARDS
+    return ShardedRedis(config['nodes'], vnodes=config['vnodes'], previous_nodes=config.get('previous_nodes'))
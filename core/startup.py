@@ -0,0 +1,70 @@
+import os
+import sys
+import typing
+import subprocess
+
+from django.conf import settings
+
+
+class ImportProfile:
+    """result of importing a module in a fresh interpreter with -X importtime"""
+    def __init__(self, module: typing.AnyStr, total: float, self_times: typing.Dict[typing.AnyStr, float],
+                 cumulative_times: typing.Dict[typing.AnyStr, float]):
+        self.module: typing.AnyStr = module
+        # seconds spent importing `module`, including everything it imports
+        self.total: float = total
+        self.self_times: typing.Dict[typing.AnyStr, float] = self_times
+        self.cumulative_times: typing.Dict[typing.AnyStr, float] = cumulative_times
+
+    @property
+    def modules(self) -> typing.List[typing.AnyStr]:
+        return list(self.self_times)
+
+    def heaviest(self, count: int = 20, cumulative: bool = False) -> typing.List[typing.Tuple[typing.AnyStr, float]]:
+        times = self.cumulative_times if cumulative else self.self_times
+        return sorted(times.items(), key=lambda item: item[1], reverse=True)[:count]
+
+
+def parse_importtime(output: typing.AnyStr) -> typing.Tuple[typing.Dict, typing.Dict]:
+    """
+    `import time: self [us] | cumulative | imported package` lines -> self and cumulative seconds by module,
+    every module appears once, imports of the interpreter start up included
+    """
+    self_times, cumulative_times = {}, {}
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            # header line
+            continue
+        name = parts[2].strip()
+        self_times[name] = int(parts[0]) / 1e6
+        cumulative_times[name] = int(parts[1]) / 1e6
+    return self_times, cumulative_times
+
+
+def profile_import(module: typing.AnyStr) -> ImportProfile:
+    env = dict(os.environ)
+    env.setdefault('DJANGO_SETTINGS_MODULE', 'light.settings')
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=settings.BASE_DIR, env=env, capture_output=True, text=True, check=True,
+    )
+    self_times, cumulative_times = parse_importtime(result.stderr)
+    return ImportProfile(module, cumulative_times.get(module, 0.0), self_times, cumulative_times)
+
+
+def check_budget(profile: ImportProfile, budget: typing.Dict = None) -> typing.List[typing.AnyStr]:
+    """violations of settings.STARTUP_BUDGET, empty when the import is within budget"""
+    budget = settings.STARTUP_BUDGET if budget is None else budget
+    violations = []
+    if profile.total > budget['seconds']:
+        violations.append(f'importing {profile.module} took {profile.total:.3f}s, budget {budget["seconds"]}s')
+    if len(profile.modules) > budget['modules']:
+        violations.append(f'importing {profile.module} loaded {len(profile.modules)} modules, '
+                          f'budget {budget["modules"]}')
+    for lazy_module in budget['lazy']:
+        if lazy_module in profile.self_times:
+            violations.append(f'{lazy_module} should be imported lazily, on first use')
+    return violations
@@ -0,0 +1,243 @@
+import os
+import time
+import typing
+import asyncio
+import logging
+import itertools
+
+from django.conf import settings
+
+from core import metrics
+from core.async_db import AsyncDB
+from core.async_db.write_behind import WriteBehind
+from core.blueprint.versioning import is_versioned
+from core.blueprint.versioning import upgrade_payload
+from core.state.exceptions import SnapshotException
+from core.state.snapshot import SnapshotReader
+from core.state.snapshot import write_snapshot
+
+logger = logging.getLogger(__name__)
+
+
+class LiveState:
+    """
+    In-memory blueprints of one blueprint class, keyed by id.
+
+    Lookup order on get(): live instances, then the memory mapped snapshot of the last run,
+    then the backing AsyncDB. A record loaded from the snapshot or the db becomes live.
+
+    The snapshot never holds a record older than the db: the first write marked dirty after a
+    snapshot was written removes its file (the open reader keeps its mapping), so a restart
+    after a crash reads the db instead of records the write behind has since overwritten.
+    Untouched records are carried over to the next snapshot, a key loaded or discarded since
+    the snapshot was opened is not.
+
+    Mutations go through save(): the blueprint becomes live and is written to the db by the write behind,
+    one is created for the db unless given.
+
+    Records stored with an older schema version are upgraded when loaded, with
+    `write_back_upgrades` the upgraded blueprint is also marked dirty so the write behind
+    stores it and the next load skips the upgrade.
+    """
+    # serialize this many blueprints before yielding back to the event loop
+    SERIALIZE_CHUNK_SIZE = 1000
+
+    def __init__(self, blueprint_class, db: AsyncDB = None, write_behind=None, name: typing.AnyStr = None,
+                 write_back_upgrades: bool = True):
+        self.blueprint_class = blueprint_class
+        self.db: AsyncDB = db
+        self.write_back_upgrades: bool = write_back_upgrades
+        # checked once, unversioned classes skip the upgrade step on every load
+        self.versioned: bool = is_versioned(blueprint_class)
+        self.name: typing.AnyStr = name or blueprint_class.__name__.lower()
+        if write_behind is None and db is not None:
+            write_behind = WriteBehind(db, name=f'state.{self.name}.write_behind', **settings.WRITE_BEHIND)
+        self.write_behind: typing.Optional[WriteBehind] = write_behind
+        self.instances: typing.Dict = {}
+        self.snapshot: typing.Optional[SnapshotReader] = None
+        # keys put or discarded since the snapshot was opened, their snapshot record is stale
+        self.touched: typing.Set = set()
+        # snapshot file on disk that no write came after yet
+        self.snapshot_file: typing.Optional[typing.AnyStr] = None
+        # writes marked dirty so far, a snapshot written meanwhile is stale
+        self.writes: int = 0
+        self.snapshot_task: typing.Optional[asyncio.Task] = None
+        # one snapshot written at a time, the last one started is the one left on disk
+        self.snapshot_lock: typing.Optional[asyncio.Lock] = None
+
+        self.size = metrics.gauge(f'state.{self.name}.size')
+        self.snapshot_latency = metrics.timer(f'state.{self.name}.snapshot_latency')
+        self.snapshot_hits = metrics.counter(f'state.{self.name}.snapshot_hits')
+        self.db_hits = metrics.counter(f'state.{self.name}.db_hits')
+        self.upgrades = metrics.counter(f'state.{self.name}.upgrades')
+
+    def __len__(self) -> int:
+        return len(self.instances)
+
+    def __contains__(self, key) -> bool:
+        return key in self.instances
+
+    def put(self, blueprint):
+        key = getattr(blueprint, blueprint.ID_NAME)
+        self.instances[key] = blueprint
+        self.touched.add(key)
+        self.size.set(len(self.instances))
+
+    def save(self, blueprint):
+        """a mutated (or new) blueprint: live from now on and written to the db"""
+        self.put(blueprint)
+        self.mark_dirty(blueprint)
+
+    def discard(self, key):
+        self.instances.pop(key, None)
+        self.touched.add(key)
+        self.size.set(len(self.instances))
+
+    def mark_dirty(self, blueprint):
+        # the snapshot record of the key is older than this write, even for a key that was never put
+        self.touched.add(getattr(blueprint, blueprint.ID_NAME))
+        self.writes += 1
+        if self.snapshot_file is not None:
+            self.invalidate_snapshot_file()
+        if self.write_behind is not None:
+            self.write_behind.mark_dirty(blueprint)
+
+    def invalidate_snapshot_file(self):
+        try:
+            os.unlink(self.snapshot_file)
+        except FileNotFoundError:
+            pass
+        logger.debug('snapshot %s of %s is stale, removed', self.snapshot_file, self.name)
+        self.snapshot_file = None
+
+    def deserialize(self, serialized: typing.Dict):
+        return self.blueprint_class(**serialized)
+
+    async def get(self, key):
+        blueprint = self.instances.get(key)
+        if blueprint is not None:
+            return blueprint
+
+        serialized = None
+        if self.snapshot is not None:
+            serialized = self.snapshot.get(key)
+            if serialized is not None:
+                self.snapshot_hits.inc()
+        if serialized is None and self.db is not None:
+            serialized = await self.db.get(key)
+            if serialized is not None:
+                self.db_hits.inc()
+            # another coroutine may have loaded the same key while we were waiting
+            blueprint = self.instances.get(key)
+            if blueprint is not None:
+                return blueprint
+        if serialized is None:
+            return None
+
+        upgraded = False
+        if self.versioned:
+            serialized, upgraded = upgrade_payload(self.blueprint_class, serialized)
+        blueprint = self.deserialize(serialized)
+        self.put(blueprint)
+        if upgraded:
+            self.upgrades.inc()
+            if self.write_back_upgrades:
+                self.mark_dirty(blueprint)
+        return blueprint
+
+    def open_snapshot(self, path: typing.AnyStr) -> bool:
+        if not os.path.exists(path):
+            return False
+        try:
+            snapshot = SnapshotReader(path)
+        except SnapshotException as e:
+            logger.error('ignore snapshot of %s: %s', self.name, e)
+            return False
+        if self.snapshot is not None:
+            self.snapshot.close()
+        self.snapshot = snapshot
+        self.snapshot_file = path
+        self.touched = set(self.instances)
+        return True
+
+    async def serialize_all(self) -> typing.List[typing.Tuple[str, typing.Dict]]:
+        serialized = []
+        for i, (key, blueprint) in enumerate(list(self.instances.items())):
+            serialized.append((key, blueprint.serialize()))
+            if (i + 1) % self.SERIALIZE_CHUNK_SIZE == 0:
+                await asyncio.sleep(0)
+        return serialized
+
+    async def write_snapshot(self, path: typing.AnyStr) -> int:
+        if self.snapshot_lock is None:
+            self.snapshot_lock = asyncio.Lock()
+        async with self.snapshot_lock:
+            return await self.write_snapshot_locked(path)
+
+    async def write_snapshot_locked(self, path: typing.AnyStr) -> int:
+        start = time.perf_counter()
+        writes = self.writes
+        items = await self.serialize_all()
+        records: typing.Iterable = items
+        if self.snapshot is not None:
+            # records of the previous run that were never loaded are still valid,
+            # carry them over as raw bytes without decoding them
+            snapshot = self.snapshot
+            carried = [key for key in snapshot.keys() if key not in self.touched]
+            records = itertools.chain(items, ((key, snapshot.get_raw(key)) for key in carried))
+        loop = asyncio.get_event_loop()
+        # encoding and disk io happen in the default executor, off the event loop
+        write = loop.run_in_executor(None, write_snapshot, path, records)
+        try:
+            count = await asyncio.shield(write)
+        except asyncio.CancelledError:
+            # the executor keeps writing, the lock is held until it is done
+            await asyncio.wait({write})
+            raise
+        self.snapshot_file = path
+        if self.writes != writes:
+            # written while the snapshot was being taken
+            self.invalidate_snapshot_file()
+        self.snapshot_latency.observe(time.perf_counter() - start)
+        return count
+
+    async def run_snapshots(self, path: typing.AnyStr, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.write_snapshot(path)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error('snapshot of %s failed: %r', self.name, e)
+
+    def snapshot_path(self) -> typing.AnyStr:
+        return os.path.join(settings.STATE_SNAPSHOT['dir'], f'{self.name}.snapshot')
+
+    def bind_lifespan(self, lifespan, path: typing.AnyStr = None, interval: float = None):
+        if path is None:
+            path = self.snapshot_path()
+        if interval is None:
+            interval = settings.STATE_SNAPSHOT['interval']
+
+        async def on_startup():
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.open_snapshot(path)
+            self.snapshot_task = asyncio.get_event_loop().create_task(self.run_snapshots(path, interval))
+
+        async def on_shutdown():
+            if self.snapshot_task is not None:
+                task, self.snapshot_task = self.snapshot_task, None
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+            # after a periodic snapshot still being written, this one is left on disk
+            await self.write_snapshot(path)
+
+        if self.write_behind is not None:
+            # pending writes are flushed on shutdown ahead of the last snapshot
+            self.write_behind.bind_lifespan(lifespan)
+        lifespan.on_startup(on_startup)
+        lifespan.on_shutdown(on_shutdown)
@@ -0,0 +1,6 @@
+class StateException(Exception):
+    pass
+
+
+class SnapshotException(StateException):
+    pass
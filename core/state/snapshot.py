@@ -0,0 +1,119 @@
+import os
+import json
+import mmap
+import struct
+import typing
+import tempfile
+
+from core.state.exceptions import SnapshotException
+
+# file layout:
+#   header   MAGIC, format version, record count, index offset
+#   records  compact json of every serialized blueprint, back to back
+#   index    per record: key length, key (utf-8), record offset, record length
+MAGIC = b'LSNP'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sHIQ')
+INDEX_ENTRY = struct.Struct('<HQI')
+
+
+def write_snapshot(path: typing.AnyStr, items: typing.Iterable[typing.Tuple[str, typing.Dict]]) -> int:
+    """
+    write (key, serialized) pairs to path atomically, return the number of records,
+    serialized may also be the already encoded bytes of a record (see SnapshotReader.get_raw)
+    """
+    # a file of its own per write, a write still running can not interleave with this one
+    fd, tmp_path = tempfile.mkstemp(prefix=f'{os.path.basename(path)}.', suffix='.tmp', dir=os.path.dirname(path) or '.')
+    try:
+        index = write_records(fd, items)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    # readers holding a map of the old file keep working, they still reference the old inode
+    os.replace(tmp_path, path)
+    return len(index)
+
+
+def write_records(fd: int, items: typing.Iterable[typing.Tuple[str, typing.Dict]]) -> typing.List:
+    index: typing.List[typing.Tuple[bytes, int, int]] = []
+    with os.fdopen(fd, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, 0, 0))
+        offset = HEADER.size
+        for key, serialized in items:
+            if isinstance(serialized, bytes):
+                record = serialized
+            else:
+                record = json.dumps(serialized, separators=(',', ':')).encode('utf-8')
+            f.write(record)
+            index.append((str(key).encode('utf-8'), offset, len(record)))
+            offset += len(record)
+        index_offset = offset
+        for key, record_offset, record_length in index:
+            f.write(INDEX_ENTRY.pack(len(key), record_offset, record_length))
+            f.write(key)
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(index), index_offset))
+        f.flush()
+        os.fsync(f.fileno())
+    return index
+
+
+class SnapshotReader:
+    """memory mapped snapshot, records are decoded on first access only"""
+    def __init__(self, path: typing.AnyStr):
+        self.path: typing.AnyStr = path
+        self.file = open(path, 'rb')
+        try:
+            self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file can not be mapped
+            self.file.close()
+            raise SnapshotException(f'snapshot {path} is empty')
+        self.index: typing.Dict[str, typing.Tuple[int, int]] = {}
+        try:
+            self.load_index()
+        except (SnapshotException, struct.error, UnicodeDecodeError) as e:
+            self.close()
+            if isinstance(e, SnapshotException):
+                raise
+            raise SnapshotException(f'snapshot {path} is corrupted: {e}')
+
+    def load_index(self):
+        if len(self.mm) < HEADER.size:
+            raise SnapshotException(f'snapshot {self.path} is truncated')
+        magic, version, count, index_offset = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise SnapshotException(f'{self.path} is not a snapshot of format version {FORMAT_VERSION}')
+        position = index_offset
+        for _ in range(count):
+            key_length, record_offset, record_length = INDEX_ENTRY.unpack_from(self.mm, position)
+            position += INDEX_ENTRY.size
+            key = self.mm[position:position + key_length].decode('utf-8')
+            position += key_length
+            self.index[key] = (record_offset, record_length)
+
+    def __contains__(self, key) -> bool:
+        return key in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def keys(self) -> typing.Iterable[str]:
+        return self.index.keys()
+
+    def get_raw(self, key) -> typing.Optional[bytes]:
+        position = self.index.get(key)
+        if position is None:
+            return None
+        record_offset, record_length = position
+        return self.mm[record_offset:record_offset + record_length]
+
+    def get(self, key) -> typing.Optional[typing.Dict]:
+        raw = self.get_raw(key)
+        if raw is None:
+            return None
+        return json.loads(raw)
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
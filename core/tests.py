@@ -1,11 +1,118 @@
+import os
+import sys
+import copy
+import collections
+import json
+import time
+import queue
 import typing
+import asyncio
+import logging
+import io
+import csv
+import random
+import zlib
+import signal
+import tempfile
+import threading
+from unittest import mock
 
 from django.test import TestCase
+from django.test import TransactionTestCase
+from django.test import SimpleTestCase
+from django.test import override_settings
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from asgiref.sync import async_to_sync
+from channels.testing import ApplicationCommunicator
+from channels.testing import WebsocketCommunicator
+from channels.layers import get_channel_layer
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+import openpyxl
 
 from core.blueprint import Field
 from core.blueprint import BlueprintMeta
 from core.blueprint import Blueprint
 from core.blueprint.exceptions import BlueprintTypeException
+from core.blueprint import bench
+from core.blueprint import Projection
+from core.blueprint import ValuePool
+from core.blueprint.frozen import FrozenBlueprint
+from core.blueprint.versioning import Migration
+from core.blueprint.versioning import get_chain
+from core.blueprint.versioning import upgrade_payload
+from core.blueprint.versioning import register_upgrade
+from core.blueprint.versioning import UPGRADE_STEPS
+from core.blueprint.versioning import UPGRADE_CHAINS
+from core.blueprint.versioning import VERSIONED_FIELDS
+from core.blueprint.exceptions import BlueprintException
+from core.async_db import AsyncDB
+from core.async_db.write_behind import WriteBehind
+from core.asgi_middleware import Lifespan
+from core.asgi_middleware import LifespanFallbackMiddleware
+from core.asgi_middleware import AdmissionMiddleware
+from core.asgi_middleware import RateLimitMiddleware
+from core.ratelimit import TokenBucket
+from core.ratelimit import BucketRegistry
+from core.ratelimit import RateLimiter
+from core.state import LiveState
+from core.state.snapshot import SnapshotReader
+from core.state.snapshot import write_snapshot
+from core.state.exceptions import SnapshotException
+from core.offload import Pool
+from core.offload import POOLS
+from core.offload import offload
+from core.offload import loads_frame
+from core.offload import OffloadHandlersMixin
+from core.metrics.loop import LoopLagMonitor
+from core.metrics.sampling import SamplingProfiler
+from core.metrics.sampling import frame_stack
+from core.export import get_columns
+from core.export import iter_csv
+from core.export import iter_xlsx
+from core.export import iter_blueprints
+from core.export import register_export
+from core.export import EXPORT_SOURCES
+from core.consumers import ExportConsumer
+from core.consumers import LoopProfileConsumer
+from core.consumers import StateConsumer
+from core.wire import FORMATS
+from core.wire import EncodedCache
+from core.wire import negotiate
+from core.wire import FrameTooLarge
+from core.timer_wheel import TimerWheel
+from core.timer_wheel import ConnectionTimersMixin
+from core.presence import Presence
+from core.presence import PresenceIndex
+from core.membership import keep_groups
+from core.topics import TopicTrie
+from core.topics import topic_hub
+from core.topics import can_subscribe
+from core.topics import blueprint_paths
+from core import lanes
+from core.drain import drainer
+from core.lanes import PriorityLanesMixin
+from core.lanes import lane_channel
+from core.startup import parse_importtime
+from core.startup import profile_import
+from core.startup import check_budget
+from core.async_db import get_backend
+from core.async_db.db_orm import AsyncDBORM
+from core.async_db.db_redis import AsyncDBRedis
+from core.sharding import HashRing
+from core.dedup import BloomFilter
+from core.dedup import RollingBloomFilter
+from core.dedup import Deduplicator
+from core.sharding import ShardedRedis
+from core.sharding import routing_key
+from core.sharding import rebalance
+from core.layers import ShardedRedisChannelLayer
+from core.models import BlueprintRecord
+from core.log import SamplingFilter
+from core.log import NonBlockingQueueHandler
+from core.log import JsonFormatter
+from core.log import QueueLogging
 
 
 class BlueprintTestCase(TestCase):
@@ -276,3 +383,1971 @@ class BlueprintTestCase(TestCase):
         tb2 = self.TB_CLASS_NESTED()
         self.assertIsNot(tb1.field, tb2.field, 'should not be the same blueprint instance')
 
+
+@offload('cpu')
+def offloaded_sum(values, offset=0):
+    return sum(values) + offset
+
+
+class InMemoryAsyncDB(AsyncDB):
+    def __init__(self):
+        super(InMemoryAsyncDB, self).__init__()
+        self.data: typing.Dict = {}
+        self.bulk_calls: typing.List[typing.Dict] = []
+
+    async def insert(self, value: typing.Dict):
+        self.data[value['_id']] = value
+
+    async def filter(self, conditions: typing.Dict):
+        for value in list(self.data.values()):
+            if all(value.get(k) == v for k, v in conditions.items()):
+                yield value
+
+    async def set(self, key, value: typing.Dict):
+        self.data[key] = value
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def bulk_set(self, items: typing.Dict):
+        self.bulk_calls.append(dict(items))
+        self.data.update(items)
+
+
+class WriteBehindTestCase(SimpleTestCase):
+    def setUp(self) -> None:
+        class TestState(Blueprint):
+            name = Field(verbose_name='Name', data_type=str, required=True, default='')
+            score = Field(verbose_name='Score', data_type=int, required=True, default=0)
+
+            class Meta:
+                id_template = '{name}'
+
+        self.TS_CLASS = TestState
+        self.db = InMemoryAsyncDB()
+
+    async def test_coalesce_writes_of_same_key(self):
+        write_behind = WriteBehind(self.db, name='test_wb_coalesce')
+        state = self.TS_CLASS(name='u1')
+        for i in range(3):
+            state.score = i
+            write_behind.mark_dirty(state)
+        self.assertEqual(len(write_behind.pending), 1, 'same key should be coalesced')
+        self.assertEqual(write_behind.coalesced.value, 2)
+
+        await write_behind.flush()
+        self.assertEqual(len(self.db.bulk_calls), 1, 'should be written with one bulk call')
+        self.assertEqual(self.db.data['u1']['score'], 2, 'latest value should be written')
+        self.assertEqual(write_behind.queue_depth.value, 0)
+        self.assertEqual(write_behind.flush_latency.count, 1)
+
+    async def test_flush_in_batches(self):
+        write_behind = WriteBehind(self.db, max_batch_size=2, name='test_wb_batches')
+        for i in range(5):
+            write_behind.mark_dirty(self.TS_CLASS(name=f'u{i}'))
+        self.assertEqual(write_behind.queue_depth.value, 5)
+        await write_behind.flush()
+        self.assertEqual([len(call) for call in self.db.bulk_calls], [2, 2, 1])
+        self.assertEqual(len(self.db.data), 5)
+
+    async def test_flush_by_size_and_time(self):
+        write_behind = WriteBehind(self.db, max_batch_size=2, flush_interval=60, name='test_wb_size')
+        write_behind.start()
+        write_behind.mark_dirty(self.TS_CLASS(name='a'))
+        write_behind.mark_dirty(self.TS_CLASS(name='b'))
+        await asyncio.sleep(0.05)
+        self.assertEqual(len(self.db.data), 2, 'full batch should be flushed without waiting for interval')
+        await write_behind.stop()
+
+        write_behind = WriteBehind(self.db, max_batch_size=100, flush_interval=0.05, name='test_wb_time')
+        write_behind.start()
+        write_behind.mark_dirty(self.TS_CLASS(name='c'))
+        await asyncio.sleep(0.2)
+        self.assertIn('c', self.db.data, 'pending item should be flushed after flush_interval')
+        await write_behind.stop()
+
+    async def test_failed_flush_keeps_pending(self):
+        class BrokenAsyncDB(InMemoryAsyncDB):
+            async def bulk_set(self, items: typing.Dict):
+                raise ConnectionError('db down')
+
+        write_behind = WriteBehind(BrokenAsyncDB(), name='test_wb_broken')
+        write_behind.mark_dirty(self.TS_CLASS(name='a'))
+        with self.assertRaises(ConnectionError):
+            await write_behind.flush()
+        self.assertIn('a', write_behind.pending, 'failed batch should be restored')
+        self.assertEqual(write_behind.failures.value, 1)
+
+    async def test_flush_pending_on_lifespan_shutdown(self):
+        lifespan = Lifespan()
+        write_behind = WriteBehind(self.db, flush_interval=60, name='test_wb_lifespan')
+        write_behind.bind_lifespan(lifespan)
+
+        receive_q, send_q = asyncio.Queue(), asyncio.Queue()
+        app_task = asyncio.ensure_future(lifespan({'type': 'lifespan'}, receive_q.get, send_q.put))
+        await receive_q.put({'type': 'lifespan.startup'})
+        self.assertEqual((await send_q.get())['type'], 'lifespan.startup.complete')
+
+        write_behind.mark_dirty(self.TS_CLASS(name='a'))
+        write_behind.mark_dirty(self.TS_CLASS(name='b'))
+        self.assertEqual(self.db.data, {})
+
+        await receive_q.put({'type': 'lifespan.shutdown'})
+        self.assertEqual((await send_q.get())['type'], 'lifespan.shutdown.complete')
+        await app_task
+        self.assertEqual(set(self.db.data), {'a', 'b'}, 'pending items should be flushed on shutdown')
+
+    async def test_failed_serialize_keeps_pending(self):
+        write_behind = WriteBehind(self.db, name='test_wb_serialize')
+        broken = self.TS_CLASS(name='b')
+        broken.serialize = lambda: 1 / 0
+        write_behind.mark_dirty(self.TS_CLASS(name='a'))
+        write_behind.mark_dirty(broken)
+        with self.assertRaises(ZeroDivisionError):
+            await write_behind.flush()
+        self.assertEqual(set(write_behind.pending), {'a', 'b'}, 'the batch should be restored')
+
+    def test_flush_on_stop_signal_without_lifespan_protocol(self):
+        # like daphne: no 'lifespan' scope, the loop runs in the main thread and the server
+        # stops on a signal handler of its own
+        server_stopped = []
+        previous = signal.signal(signal.SIGUSR2, lambda signum, frame: server_stopped.append(signum))
+        self.addCleanup(signal.signal, signal.SIGUSR2, previous)
+        lifespan = Lifespan(signal_names=('SIGUSR2',))
+        write_behind = WriteBehind(self.db, flush_interval=60, name='test_wb_fallback')
+        write_behind.bind_lifespan(lifespan)
+
+        async def app(scope, receive, send):
+            pass
+
+        async def serve():
+            application = LifespanFallbackMiddleware(app, lifespan)
+            await application({'type': 'http'}, None, None)
+            self.assertIsNotNone(write_behind.task, 'startup hooks should run on the first request')
+            write_behind.mark_dirty(self.TS_CLASS(name='a'))
+            os.kill(os.getpid(), signal.SIGUSR2)
+            for _ in range(100):
+                if server_stopped:
+                    break
+                await asyncio.sleep(0.01)
+
+        asyncio.run(serve())
+        self.assertEqual(set(self.db.data), {'a'}, 'pending items should be flushed before the server stops')
+        self.assertEqual(server_stopped, [signal.SIGUSR2], 'the server handler should run after the hooks')
+        self.assertEqual(lifespan.previous_handlers, {})
+
+    def test_stop_signals_are_opt_in(self):
+        handler = signal.getsignal(signal.SIGTERM)
+        lifespan = Lifespan()
+
+        async def app(scope, receive, send):
+            pass
+
+        async def serve():
+            await LifespanFallbackMiddleware(app, lifespan)({'type': 'http'}, None, None)
+
+        asyncio.run(serve())
+        self.assertIs(signal.getsignal(signal.SIGTERM), handler, 'the handlers of the process should be left alone')
+        self.assertEqual(lifespan.previous_handlers, {})
+
+
+class LiveStateSnapshotTestCase(SimpleTestCase):
+    def setUp(self) -> None:
+        class TestUserState(Blueprint):
+            name = Field(verbose_name='Name', data_type=str, required=True, default='')
+            items = Field(verbose_name='Items', data_type=int, required=True, multi=True)
+
+            class Meta:
+                id_template = 'user_{name}'
+
+        self.TS_CLASS = TestUserState
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'state.snapshot')
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    async def test_snapshot_and_lazy_restore(self):
+        live_state = LiveState(self.TS_CLASS, name='test_snapshot_restore')
+        for i in range(10):
+            live_state.put(self.TS_CLASS(name=f'{i}', items=[i, i + 1]))
+        count = await live_state.write_snapshot(self.path)
+        self.assertEqual(count, 10)
+
+        restored = LiveState(self.TS_CLASS, name='test_snapshot_restored')
+        self.assertTrue(restored.open_snapshot(self.path))
+        self.assertEqual(len(restored), 0, 'nothing should be deserialized before first access')
+
+        state = await restored.get('user_3')
+        self.assertIsInstance(state, self.TS_CLASS)
+        self.assertEqual(state.serialize(), live_state.instances['user_3'].serialize())
+        self.assertEqual(len(restored), 1)
+        self.assertEqual(restored.snapshot_hits.value, 1)
+        self.assertIs(await restored.get('user_3'), state, 'loaded state should be live')
+        self.assertIsNone(await restored.get('user_missing'))
+
+    async def test_snapshot_carries_over_untouched_records(self):
+        live_state = LiveState(self.TS_CLASS, name='test_snapshot_carry')
+        for i in range(3):
+            live_state.put(self.TS_CLASS(name=f'{i}'))
+        await live_state.write_snapshot(self.path)
+
+        restored = LiveState(self.TS_CLASS, name='test_snapshot_carry_restored')
+        restored.open_snapshot(self.path)
+        state = await restored.get('user_0')
+        state.items = [42]
+        await restored.write_snapshot(self.path)
+
+        reader = SnapshotReader(self.path)
+        self.assertEqual(set(reader.keys()), {'user_0', 'user_1', 'user_2'})
+        self.assertEqual(reader.get('user_0')['items'], [42], 'live value should replace snapshot value')
+        reader.close()
+
+    async def test_fallback_to_db(self):
+        db = InMemoryAsyncDB()
+        await db.set('user_x', self.TS_CLASS(name='x').serialize())
+        live_state = LiveState(self.TS_CLASS, db=db, name='test_snapshot_db')
+        self.assertFalse(live_state.open_snapshot(self.path), 'missing snapshot should be ignored')
+        state = await live_state.get('user_x')
+        self.assertEqual(state.name, 'x')
+        self.assertEqual(live_state.db_hits.value, 1)
+
+    async def test_snapshot_never_shadows_newer_db_writes(self):
+        db = InMemoryAsyncDB()
+        live_state = LiveState(self.TS_CLASS, db=db, name='test_snapshot_stale')
+        live_state.put(self.TS_CLASS(name='a', items=[1]))
+        live_state.put(self.TS_CLASS(name='b', items=[1]))
+        await live_state.write_snapshot(self.path)
+
+        restored = LiveState(self.TS_CLASS, db=db, name='test_snapshot_stale_restored')
+        restored.open_snapshot(self.path)
+        state = await restored.get('user_a')
+        state.items = [2]
+        restored.mark_dirty(state)
+        self.assertFalse(os.path.exists(self.path), 'a write should invalidate the snapshot on disk')
+        await db.set('user_a', state.serialize())
+        restored.discard('user_a')
+
+        await restored.write_snapshot(self.path)
+        reader = SnapshotReader(self.path)
+        self.assertEqual(set(reader.keys()), {'user_b'}, 'a discarded key should not be carried over')
+        reader.close()
+        again = LiveState(self.TS_CLASS, db=db, name='test_snapshot_stale_again')
+        again.open_snapshot(self.path)
+        self.assertEqual((await again.get('user_a')).items, [2], 'the newer db record should be read')
+
+    async def test_saved_blueprints_are_written_behind(self):
+        db = InMemoryAsyncDB()
+        live_state = LiveState(self.TS_CLASS, db=db, name='test_snapshot_save')
+        lifespan = Lifespan()
+        live_state.bind_lifespan(lifespan, path=self.path, interval=60)
+        await lifespan.startup()
+        live_state.save(self.TS_CLASS(name='a', items=[1]))
+        self.assertIn('user_a', live_state)
+        self.assertEqual(db.data, {})
+
+        await lifespan.shutdown()
+        self.assertEqual(db.data['user_a']['items'], [1], 'pending writes should be flushed on shutdown')
+        self.assertIsNone(live_state.write_behind.task)
+
+    async def test_written_key_is_not_carried_over(self):
+        live_state = LiveState(self.TS_CLASS, name='test_snapshot_written')
+        live_state.put(self.TS_CLASS(name='a', items=[1]))
+        await live_state.write_snapshot(self.path)
+
+        restored = LiveState(self.TS_CLASS, name='test_snapshot_written_restored')
+        restored.open_snapshot(self.path)
+        restored.mark_dirty(self.TS_CLASS(name='a', items=[2]))
+        await restored.write_snapshot(self.path)
+        reader = SnapshotReader(self.path)
+        self.assertEqual(list(reader.keys()), [], 'the snapshot record of a written key is stale')
+        reader.close()
+
+    async def test_shutdown_waits_for_the_snapshot_in_flight(self):
+        live_state = LiveState(self.TS_CLASS, name='test_snapshot_in_flight')
+        lifespan = Lifespan()
+        live_state.bind_lifespan(lifespan, path=self.path, interval=0.01)
+        writing = threading.Event()
+        written = []
+
+        def slow_write_snapshot(path, items):
+            written.append('start')
+            writing.set()
+            time.sleep(0.1)
+            count = write_snapshot(path, items)
+            written.append(count)
+            return count
+
+        with mock.patch('core.state.write_snapshot', slow_write_snapshot):
+            live_state.put(self.TS_CLASS(name='a'))
+            await lifespan.startup()
+            while not writing.is_set():
+                await asyncio.sleep(0.01)
+            live_state.put(self.TS_CLASS(name='b'))
+            await lifespan.shutdown()
+        self.assertEqual(written, ['start', 1, 'start', 2], 'the final snapshot should be written after the one in flight')
+        reader = SnapshotReader(self.path)
+        self.assertEqual(set(reader.keys()), {'user_a', 'user_b'})
+        reader.close()
+        self.assertEqual(os.listdir(self.tmp_dir.name), ['state.snapshot'], 'no temporary file should be left')
+
+    def test_reject_invalid_snapshot(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'not a snapshot file at all')
+        with self.assertRaises(SnapshotException):
+            SnapshotReader(self.path)
+
+
+class OffloadTestCase(SimpleTestCase):
+    async def test_offload_to_process_pool(self):
+        result = await offloaded_sum([1, 2, 3], offset=10)
+        self.assertEqual(result, 16)
+        self.assertEqual(offloaded_sum.pool_name, 'cpu')
+        POOLS.pop('cpu').shutdown()
+
+    async def test_pool_concurrency_limit(self):
+        pool = Pool('test_limit', kind='thread', max_workers=4, max_pending=2)
+        lock = threading.Lock()
+        running = []
+        max_running = []
+
+        def work():
+            with lock:
+                running.append(1)
+                max_running.append(len(running))
+            time.sleep(0.02)
+            with lock:
+                running.pop()
+            return True
+
+        results = await asyncio.gather(*(pool.run(work) for _ in range(8)))
+        pool.shutdown()
+        self.assertTrue(all(results))
+        self.assertLessEqual(max(max_running), 2, 'calls in flight should not exceed max_pending')
+        self.assertEqual(pool.latency.count, 8)
+        self.assertEqual(pool.in_flight.value, 0)
+
+    def test_pool_on_several_event_loops(self):
+        pool = Pool('test_loops', kind='thread', max_workers=1, max_pending=1)
+        for _ in range(2):
+            self.assertEqual(asyncio.run(pool.run(sum, [1, 2])), 3)
+        pool.shutdown()
+        self.assertEqual(len(pool.semaphores), 1, 'semaphores of closed loops should be dropped')
+
+    async def test_offloaded_handlers(self):
+        class OffloadedConsumer(OffloadHandlersMixin):
+            offload_pool = 'io'
+
+            def __init__(self):
+                self.sent = []
+
+            async def send_payload(self, payload):
+                self.sent.append(payload)
+
+            @staticmethod
+            def offload_square(event):
+                return {'square': event['n'] ** 2, 'thread': threading.current_thread().name}
+
+            def offload_bound(self, event):
+                return {}
+
+        consumer = OffloadedConsumer()
+        await consumer.dispatch({'type': 'offload.square', 'n': 3})
+        self.assertEqual(consumer.sent[0]['square'], 9)
+        self.assertTrue(consumer.sent[0]['thread'].startswith('offload_io'))
+        with self.assertRaises(ValueError):
+            await consumer.dispatch({'type': 'offload.bound'})
+
+    async def test_loads_frame(self):
+        self.assertIsNone(await loads_frame(None))
+        self.assertEqual(await loads_frame('{"message": "init"}'), {'message': 'init'})
+        with self.settings(OFFLOAD_FRAME_THRESHOLD=10):
+            self.assertEqual(await loads_frame('{"message": "init"}'), {'message': 'init'})
+
+    async def test_loop_lag_monitor(self):
+        monitor = LoopLagMonitor(interval=0.01, name='test_loop')
+        monitor.start()
+        await asyncio.sleep(0.03)
+        # block the event loop
+        time.sleep(0.1)
+        await asyncio.sleep(0.03)
+        await monitor.stop()
+        self.assertGreaterEqual(monitor.lag.max, 0.05, 'blocking the loop should be measured as lag')
+
+
+class ExportTestCase(SimpleTestCase):
+    def setUp(self) -> None:
+        class TestRoom(Blueprint):
+            room_id = Field(verbose_name='Room ID', data_type=int, required=True, default=0)
+            tags = Field(verbose_name='Tags', data_type=str, required=True, multi=True)
+
+            class Meta:
+                id_template = 'room_{room_id}'
+
+        class TestProfile(Blueprint):
+            nickname = Field(verbose_name='Nickname', data_type=str, required=True, default='')
+
+            class Meta:
+                id_template = 'profile_{_ts}'
+
+        class TestUser(Blueprint):
+            name = Field(verbose_name='Name', data_type=str, required=True, default='')
+            profile = Field(verbose_name='Profile', data_type=TestProfile, required=True, default=TestProfile())
+            rooms = Field(verbose_name='Rooms', data_type=TestRoom, required=True, multi=True)
+
+            class Meta:
+                id_template = 'user_{name}'
+
+        self.TU_CLASS = TestUser
+        self.TR_CLASS = TestRoom
+        self.TP_CLASS = TestProfile
+
+    def make_user(self, i):
+        return self.TU_CLASS(
+            name=f'{i}',
+            profile={'nickname': f'nick{i}', '_id': f'p{i}', '_ts': 1},
+            rooms=[
+                {'room_id': 1, 'tags': ['a', 'b'], '_id': 'room_1', '_ts': 1},
+                {'room_id': 2, 'tags': ['c'], '_id': 'room_2', '_ts': 1},
+            ],
+        )
+
+    async def users(self, count):
+        for i in range(count):
+            yield self.make_user(i)
+
+    def test_flatten_columns_with_field_plan(self):
+        headers = [column.header for column in get_columns(self.TU_CLASS)]
+        self.assertEqual(headers[:5], ['name', 'profile.nickname', 'profile._id', 'profile._ts', 'rooms.room_id'])
+        self.assertIn('rooms.tags', headers)
+        self.assertEqual(headers[-2:], ['_id', '_ts'])
+
+    async def test_csv_export(self):
+        chunks = [chunk async for chunk in iter_csv(self.TU_CLASS, self.users(5), chunk_rows=2)]
+        self.assertEqual(len(chunks), 3, 'rows should be streamed in chunks')
+        rows = list(csv.DictReader(io.StringIO(b''.join(chunks).decode('utf-8'))))
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[3]['name'], '3')
+        self.assertEqual(rows[3]['profile.nickname'], 'nick3')
+        self.assertEqual(rows[3]['rooms.room_id'], '1|2')
+        self.assertEqual(rows[3]['rooms.tags'], 'a|b|c')
+
+    async def test_xlsx_export(self):
+        data = b''.join([chunk async for chunk in iter_xlsx(self.TU_CLASS, self.users(3), file_chunk_size=1024)])
+        workbook = openpyxl.load_workbook(io.BytesIO(data), read_only=True)
+        rows = list(workbook.active.iter_rows(values_only=True))
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[1][:2], ('0', 'nick0'))
+
+    async def test_iter_blueprints_from_async_db(self):
+        db = InMemoryAsyncDB()
+        for i in range(3):
+            user = self.make_user(i)
+            await db.insert(user.serialize())
+        names = [user.name async for user in iter_blueprints(self.TU_CLASS, db.filter({}))]
+        self.assertEqual(names, ['0', '1', '2'])
+
+    async def export_response(self, user, path_kwargs):
+        scope = {
+            'type': 'http',
+            'method': 'GET',
+            'path': '/export/',
+            'headers': [],
+            'user': user,
+            'url_route': {'kwargs': path_kwargs},
+        }
+        communicator = ApplicationCommunicator(ExportConsumer.as_asgi(), scope)
+        await communicator.send_input({'type': 'http.request', 'body': b''})
+        start = await communicator.receive_output()
+        body_messages = []
+        while True:
+            message = await communicator.receive_output()
+            body_messages.append(message)
+            if not message.get('more_body'):
+                break
+        return start, body_messages
+
+    async def test_export_consumer(self):
+        class StaffUser:
+            is_staff = True
+
+        class NormalUser:
+            is_staff = False
+
+        register_export('test_users', self.TU_CLASS, lambda: self.users(1200))
+        try:
+            start, _ = await self.export_response(NormalUser(), {'name': 'test_users', 'file_format': 'csv'})
+            self.assertEqual(start['status'], 403)
+
+            start, _ = await self.export_response(StaffUser(), {'name': 'no_such_export', 'file_format': 'csv'})
+            self.assertEqual(start['status'], 404)
+
+            start, body_messages = await self.export_response(
+                StaffUser(), {'name': 'test_users', 'file_format': 'csv'}
+            )
+            self.assertEqual(start['status'], 200)
+            self.assertIn((b'Content-Type', b'text/csv; charset=utf-8'), start['headers'])
+            self.assertGreater(len(body_messages), 2, 'response body should be streamed')
+            body = b''.join(message['body'] for message in body_messages).decode('utf-8')
+            self.assertEqual(len(body.strip().splitlines()), 1201)
+        finally:
+            EXPORT_SOURCES.pop('test_users')
+
+
+class WireFormatTestCase(SimpleTestCase):
+    def test_round_trip(self):
+        payload = {'message': 'state', 'items': list(range(100)), 'name': 'ä' * 10}
+        for name, wire_format in FORMATS.items():
+            data = wire_format.encode(payload)
+            self.assertIsInstance(data, bytes if wire_format.binary else str, f'{name} frame type')
+            self.assertEqual(wire_format.decode(data), payload, f'{name} should round trip')
+        self.assertLess(
+            len(FORMATS['msgpack.deflate'].encode(payload)), len(FORMATS['json'].encode(payload)),
+            'compressed binary format should be smaller'
+        )
+
+    def test_decompression_bomb_is_rejected(self):
+        wire_format = FORMATS['json.deflate']
+        with self.settings(WIRE_FORMAT=dict(settings.WIRE_FORMAT, max_frame=1000)):
+            bomb = zlib.compress(b'[' + b'0,' * 10 ** 6 + b'0]', 9)
+            with self.assertRaises(FrameTooLarge):
+                wire_format.decode(bomb)
+            exact = wire_format.encode('x' * 998)
+            self.assertEqual(wire_format.decode(exact), 'x' * 998, 'a frame of max_frame bytes is fine')
+            with self.assertRaises(FrameTooLarge):
+                wire_format.decode(wire_format.encode('x' * 999))
+
+    def test_negotiate(self):
+        self.assertIsNone(negotiate([]))
+        self.assertIsNone(negotiate(['graphql-ws', 'light.unknown']))
+        self.assertIs(negotiate(['graphql-ws', 'light.msgpack', 'light.json']), FORMATS['msgpack'])
+
+    def test_encoded_cache(self):
+        cache = EncodedCache(max_size=2)
+        wire_format = FORMATS['json.deflate']
+        first = cache.encode(wire_format, {'message': 'hi'}, 'p1')
+        self.assertIs(cache.encode(wire_format, {'message': 'hi'}, 'p1'), first, 'should be encoded once')
+        cache.encode(wire_format, {'message': 'a'}, 'p2')
+        cache.encode(wire_format, {'message': 'b'}, 'p3')
+        self.assertEqual(len(cache.entries), 2, 'least recently used entry should be evicted')
+        self.assertNotIn(('p1', 'json.deflate'), cache.entries)
+
+
+class RecordingApp:
+    """ASGI app that records every message it receives until disconnect"""
+    def __init__(self):
+        self.received = []
+
+    async def __call__(self, scope, receive, send):
+        while True:
+            message = await receive()
+            self.received.append(message)
+            if message['type'] == 'websocket.disconnect':
+                return
+
+
+class RateLimitTestCase(SimpleTestCase):
+    RATE_LIMIT = {
+        'user': {'rate': 1, 'burst': 3},
+        'room': {'rate': 100, 'burst': 100},
+        'max_buckets': 10,
+        'max_strikes': 5,
+        'redis': None,
+    }
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=2, capacity=2, now=0)
+        self.assertTrue(bucket.consume(now=0))
+        self.assertTrue(bucket.consume(now=0))
+        self.assertFalse(bucket.consume(now=0), 'burst exhausted')
+        self.assertTrue(bucket.consume(now=0.5), 'one token refilled after 0.5s')
+        self.assertFalse(bucket.consume(now=0.5))
+        bucket.consume(now=100)
+        self.assertLessEqual(bucket.tokens, 2, 'tokens are capped by capacity')
+
+    async def test_refused_frame_costs_no_user_token(self):
+        limiter = RateLimiter(dict(self.RATE_LIMIT, room={'rate': 0, 'burst': 1}))
+        self.assertTrue(await limiter.allow('u1', 'room1'))
+        # room1 is exhausted, u1 keeps its two remaining tokens for other rooms
+        for _ in range(5):
+            self.assertFalse(await limiter.allow('u1', 'room1'))
+        self.assertTrue(await limiter.allow('u1', 'room2'))
+        self.assertTrue(await limiter.allow('u1', 'room3'))
+        self.assertFalse(await limiter.allow('u1', 'room4'), 'user burst exhausted')
+
+        # the same for frames whose room is only known to the consumer
+        self.assertTrue(await limiter.allow('u2'))
+        self.assertTrue(limiter.allow_room('room5', 'u2'))
+        self.assertTrue(await limiter.allow('u2'))
+        self.assertFalse(limiter.allow_room('room5', 'u2'))
+        self.assertTrue(await limiter.allow('u2'))
+        self.assertTrue(await limiter.allow('u2'))
+        self.assertFalse(await limiter.allow('u2'), 'user burst exhausted')
+
+    def test_bucket_registry_is_bounded(self):
+        registry = BucketRegistry(rate=1, capacity=1, max_size=3)
+        for key in range(10):
+            registry.consume(key, now=0)
+        self.assertEqual(len(registry), 3)
+        self.assertEqual(list(registry.buckets), [7, 8, 9])
+
+    async def run_middleware(self, middleware, app, messages, scope=None):
+        receive_q, sent = asyncio.Queue(), []
+        for message in messages:
+            receive_q.put_nowait(message)
+
+        async def send(message):
+            sent.append(message)
+
+        scope = scope or {'type': 'websocket', 'path': '/ws/chat/room/', 'client': ('10.0.0.1', 1234)}
+        await middleware(scope, receive_q.get, send)
+        return app.received, sent
+
+    async def test_rate_limit_middleware_drops_and_closes(self):
+        app = RecordingApp()
+        middleware = RateLimitMiddleware(app, limiter=RateLimiter(self.RATE_LIMIT))
+        with self.settings(RATE_LIMIT=self.RATE_LIMIT):
+            received, sent = await self.run_middleware(
+                middleware, app,
+                [{'type': 'websocket.connect'}] +
+                [{'type': 'websocket.receive', 'text': f'{i}'} for i in range(20)]
+            )
+        frames = [m for m in received if m['type'] == 'websocket.receive']
+        self.assertEqual(len(frames), 3, 'only the burst should pass')
+        self.assertEqual(received[-1]['type'], 'websocket.disconnect')
+        self.assertEqual(sent, [{'type': 'websocket.close', 'code': RateLimitMiddleware.CLOSE_CODE}])
+
+    async def test_admission_control(self):
+        app = RecordingApp()
+        middleware = AdmissionMiddleware(app, config={'max_connections': 0, 'max_loop_lag': 1})
+        received, sent = await self.run_middleware(middleware, app, [{'type': 'websocket.connect'}])
+        self.assertEqual(sent, [{'type': 'websocket.close', 'code': AdmissionMiddleware.REFUSE_CODE}])
+        self.assertEqual(received[0]['type'], 'websocket.disconnect', 'app should never see the connect')
+
+        app = RecordingApp()
+        middleware = AdmissionMiddleware(app, config={'max_connections': 10, 'max_loop_lag': 1})
+        received, sent = await self.run_middleware(
+            middleware, app, [{'type': 'websocket.connect'}, {'type': 'websocket.disconnect', 'code': 1000}]
+        )
+        self.assertEqual([m['type'] for m in received], ['websocket.connect', 'websocket.disconnect'])
+        self.assertEqual(AdmissionMiddleware.connections.value, 0, 'connection count should be released')
+
+
+class TimerWheelTestCase(SimpleTestCase):
+    def test_timers_fire_on_their_tick_across_levels(self):
+        wheel = TimerWheel(tick=1, wheel_sizes=(4, 4, 4))
+        fired = []
+        random.seed(7)
+        delays = [random.randint(1, 70) for _ in range(200)]
+        for delay in delays:
+            wheel.call_later(delay, lambda d=delay: fired.append((d, wheel.current_tick)))
+        for _ in range(80):
+            wheel.fire(wheel.advance())
+        self.assertEqual(len(fired), len(delays))
+        for delay, tick in fired:
+            self.assertEqual(delay, tick, 'timer should fire exactly on its deadline tick')
+        self.assertEqual(len(wheel), 0)
+
+    def test_cancel_and_periodic(self):
+        wheel = TimerWheel(tick=1, wheel_sizes=(8, 8))
+        fired = []
+        cancelled = wheel.call_later(3, fired.append, 'cancelled')
+        periodic = wheel.call_every(2, fired.append, 'periodic')
+        cancelled.cancel()
+        self.assertIsNone(cancelled.slot)
+        for _ in range(7):
+            wheel.fire(wheel.advance())
+        self.assertEqual(fired, ['periodic'] * 3)
+        periodic.cancel()
+        for _ in range(10):
+            wheel.fire(wheel.advance())
+        self.assertEqual(len(fired), 3, 'cancelled periodic timer should not fire again')
+        self.assertEqual(len(wheel), 0)
+
+    async def test_batch_coroutine_callbacks(self):
+        wheel = TimerWheel(tick=0.01, wheel_sizes=(16, 16))
+        fired = []
+
+        async def callback(i):
+            fired.append(i)
+
+        for i in range(5):
+            wheel.call_later(0.03, callback, i)
+        await asyncio.sleep(0.1)
+        await wheel.stop()
+        self.assertEqual(sorted(fired), list(range(5)))
+        self.assertGreaterEqual(wheel.fired.value, 5)
+
+    async def test_connection_debounce(self):
+        class Connection(ConnectionTimersMixin):
+            pass
+
+        connection = Connection()
+        pushes = []
+        for i in range(5):
+            connection.debounce('init', 0.1, pushes.append, i)
+        self.assertEqual(len(connection.timers), 1, 'debounce should keep a single timer')
+        await asyncio.sleep(0.35)
+        self.assertEqual(pushes, [4], 'only the last call should run')
+        self.assertEqual(connection.timers, set())
+
+
+class FakeRedisPipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.calls = []
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            future = asyncio.get_event_loop().create_future()
+            self.calls.append((getattr(self.redis, name), args, kwargs, future))
+            return future
+        return call
+
+    async def execute(self, return_exceptions=False):
+        results = []
+        for method, args, kwargs, future in self.calls:
+            try:
+                result = await method(*args, **kwargs)
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                future.set_exception(e)
+                results.append(e)
+                continue
+            future.set_result(result)
+            results.append(result)
+        return results
+
+
+class FakeRedis:
+    """the sorted set / key value commands used by core, kept in dicts"""
+    def __init__(self):
+        self.zsets: typing.Dict = {}
+        self.executed_pipelines = 0
+
+    def pipeline(self):
+        self.executed_pipelines += 1
+        return FakeRedisPipeline(self)
+
+    async def zadd(self, key, score, member):
+        self.zsets.setdefault(key, {})[member] = score
+        return 1
+
+    async def zrem(self, key, member):
+        return 1 if self.zsets.get(key, {}).pop(member, None) is not None else 0
+
+    async def zscore(self, key, member):
+        return self.zsets.get(key, {}).get(member)
+
+    async def zrangebyscore(self, key, min=float('-inf'), max=float('inf'), encoding=None):
+        items = sorted(self.zsets.get(key, {}).items(), key=lambda item: item[1])
+        return [member for member, score in items if min <= score <= max]
+
+    async def zcount(self, key, min=float('-inf'), max=float('inf')):
+        return len(await self.zrangebyscore(key, min, max))
+
+    async def zremrangebyscore(self, key, min=float('-inf'), max=float('inf')):
+        zset = self.zsets.get(key, {})
+        expired = [member for member, score in zset.items() if min <= score <= max]
+        for member in expired:
+            del zset[member]
+        return len(expired)
+
+
+class PresenceTestCase(SimpleTestCase):
+    def test_local_index_reference_counts(self):
+        index = PresenceIndex()
+        self.assertTrue(index.connect(1))
+        self.assertFalse(index.connect(1), 'second socket of the same user')
+        self.assertTrue(index.join(1, 'room'))
+        self.assertFalse(index.join(1, 'room'))
+        index.join(2, 'room')
+        self.assertEqual(index.count('room'), 2)
+        self.assertEqual(sorted(index.online_users('room')), [1, 2])
+
+        self.assertFalse(index.leave(1, 'room'), 'user still has a socket in the room')
+        self.assertTrue(index.leave(1, 'room'))
+        self.assertEqual(index.room_counts(), {'room': 1})
+        index.leave(2, 'room')
+        self.assertEqual(index.room_counts(), {}, 'empty rooms should be dropped')
+        self.assertFalse(index.disconnect(1))
+        self.assertTrue(index.disconnect(1))
+        self.assertFalse(index.is_online(1))
+
+    async def test_cluster_presence_and_expiry(self):
+        redis = FakeRedis()
+        node_a = Presence(redis=redis, ttl=0.2, heartbeat_interval=60, namespace='test')
+        node_b = Presence(redis=redis, ttl=0.2, heartbeat_interval=60, namespace='test')
+
+        await node_a.connect(1)
+        await node_a.join(1, 'lobby')
+        await node_b.connect(2)
+        await node_b.join(2, 'lobby')
+        await node_b.join(2, 'games')
+
+        self.assertEqual(sorted(await node_a.cluster_online_users('lobby')), ['1', '2'])
+        self.assertEqual(await node_a.cluster_count('lobby'), 2)
+        self.assertEqual(await node_b.cluster_room_counts(), {'lobby': 2, 'games': 1})
+        self.assertTrue(await node_b.cluster_is_online(1))
+
+        # node a crashes: no more heartbeats, node b keeps refreshing its own entries
+        await asyncio.sleep(0.25)
+        await node_b.heartbeat()
+        self.assertEqual(await node_b.cluster_online_users('lobby'), ['2'])
+        self.assertFalse(await node_b.cluster_is_online(1), 'entries of a crashed node should expire')
+
+        await node_b.leave(2, 'games')
+        self.assertEqual(await node_b.cluster_count('games'), 0)
+
+        for presence in (node_a, node_b):
+            if presence.heartbeat_timer is not None:
+                presence.heartbeat_timer.cancel()
+
+
+class StateUser:
+    is_authenticated = True
+
+    def __init__(self, user_id):
+        self.id = user_id
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class TopicsTestCase(SimpleTestCase):
+    def tearDown(self):
+        # state connections register with the control lane, bound to the loop of the test
+        async_to_sync(lanes.control_lane.stop)()
+        async_to_sync(get_channel_layer().flush)()
+
+    def test_trie_match(self):
+        trie = TopicTrie()
+        trie.subscribe('inventory.*', 'a')
+        trie.subscribe('inventory.sword', 'b')
+        trie.subscribe('rooms.42.members', 'c')
+        trie.subscribe('rooms.*.members', 'd')
+        trie.subscribe('rooms', 'e')
+
+        self.assertEqual(trie.match('inventory.sword'), {'a', 'b'})
+        self.assertEqual(trie.match('inventory.sword.count'), {'a', 'b'}, 'subscriptions cover their subtree')
+        self.assertEqual(trie.match('inventory.shield'), {'a'})
+        self.assertEqual(trie.match('inventory'), set())
+        self.assertEqual(trie.match('rooms.42.members'), {'c', 'd', 'e'})
+        self.assertEqual(trie.match('rooms.7.members'), {'d', 'e'})
+        self.assertEqual(trie.match('rooms.7.topic'), {'e'})
+        self.assertEqual(trie.match('mailbox'), set())
+
+        self.assertTrue(trie.unsubscribe('rooms.42.members', 'c'))
+        self.assertFalse(trie.unsubscribe('rooms.42.members', 'c'))
+        self.assertNotIn('42', trie.root.children['rooms'].children, 'empty nodes should be pruned')
+        self.assertEqual(len(trie), 4)
+        with self.assertRaises(ValueError):
+            trie.subscribe('rooms..members', 'x')
+
+    def test_can_subscribe(self):
+        user = StateUser(7)
+        self.assertTrue(can_subscribe(user, 'rooms.42.members'))
+        self.assertTrue(can_subscribe(user, 'users.7.inventory.*'))
+        self.assertFalse(can_subscribe(user, 'users.8.inventory'))
+        self.assertFalse(can_subscribe(user, 'users.*'))
+        self.assertFalse(can_subscribe(user, 'users'))
+        self.assertFalse(can_subscribe(user, '*.7'))
+
+    def test_blueprint_paths(self):
+        class Position(Blueprint):
+            x = Field(data_type=int, default=0)
+            y = Field(data_type=int, default=0)
+
+            class Meta:
+                id_template = '{x}_{y}'
+
+        class Player(Blueprint):
+            name = Field(data_type=str)
+            position = Field(data_type=Position)
+            tags = Field(data_type=str, multi=True)
+
+            class Meta:
+                id_template = '{name}'
+
+        player = Player(name='bob', position={'x': 1, 'y': 2}, tags=['a'])
+        paths = dict(blueprint_paths(player, 'users.7.player'))
+        self.assertEqual(paths['users.7.player.name'], 'bob')
+        self.assertEqual(paths['users.7.player.position.x'], 1)
+        self.assertEqual(paths['users.7.player.position.y'], 2)
+        self.assertEqual(paths['users.7.player.tags'], ['a'])
+        self.assertIn('users.7.player._id', paths)
+
+    async def connect(self, user_id):
+        communicator = WebsocketCommunicator(StateConsumer.as_asgi(), '/ws/core/state/')
+        communicator.scope['user'] = StateUser(user_id)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_only_matching_connections_receive_updates(self):
+        first = await self.connect(1)
+        second = await self.connect(2)
+        try:
+            await first.send_json_to({'message': 'subscribe', 'path': 'rooms.*.members'})
+            self.assertEqual(await first.receive_json_from(), {'subscribed': 'rooms.*.members'})
+            await second.send_json_to({'message': 'subscribe', 'path': 'users.2.inventory'})
+            self.assertEqual(await second.receive_json_from(), {'subscribed': 'users.2.inventory'})
+            await second.send_json_to({'message': 'subscribe', 'path': 'users.1.inventory'})
+            self.assertIn('error', await second.receive_json_from())
+
+            await topic_hub.publish('rooms.42.members', [1, 2])
+            self.assertEqual(await first.receive_json_from(), {'path': 'rooms.42.members', 'value': [1, 2]})
+            self.assertTrue(await second.receive_nothing())
+
+            await topic_hub.publish('users.2.inventory.sword', 1)
+            self.assertEqual(await second.receive_json_from(), {'path': 'users.2.inventory.sword', 'value': 1})
+            self.assertTrue(await first.receive_nothing())
+
+            await first.send_json_to({'message': 'unsubscribe', 'path': 'rooms.*.members'})
+            self.assertEqual(await first.receive_json_from(), {'unsubscribed': 'rooms.*.members'})
+            await topic_hub.publish('rooms.42.members', [2])
+            self.assertTrue(await first.receive_nothing())
+        finally:
+            await first.disconnect()
+            await second.disconnect()
+            await topic_hub.stop()
+        self.assertEqual(len(topic_hub.trie), 0, 'subscriptions should be dropped on disconnect')
+
+    async def test_revoked_user_is_disconnected(self):
+        communicator = await self.connect(5)
+        await lanes.revoke_user(5)
+        self.assertEqual(await communicator.receive_output(timeout=1), {'type': 'websocket.close', 'code': 4003})
+        await communicator.disconnect()
+
+    async def test_state_connections_are_handed_off_on_drain(self):
+        communicator = await self.connect(6)
+        self.addCleanup(drainer.resume)
+        await drainer.drain(timeout=0.1)
+        self.assertIn('reconnect', await communicator.receive_json_from(timeout=1))
+        self.assertEqual(await communicator.receive_output(timeout=1), {'type': 'websocket.close', 'code': 1012})
+        await communicator.disconnect()
+        self.assertEqual(drainer.consumers, set())
+
+    async def test_listener_group_membership_renewed(self):
+        channel_layer = get_channel_layer()
+        channel_name = await channel_layer.new_channel(prefix='topics.')
+        # joined by the renewals alone, like a membership that expired
+        renew = asyncio.ensure_future(keep_groups(channel_name, lambda: ['renewed_group'], interval=0.01))
+        await asyncio.sleep(0.05)
+        renew.cancel()
+        await channel_layer.group_send('renewed_group', {'type': 'state.update'})
+        self.assertEqual((await channel_layer.receive(channel_name))['type'], 'state.update')
+
+    async def test_listener_survives_receive_failures(self):
+        await get_channel_layer().flush()
+        channel_layer = get_channel_layer()
+        receive = channel_layer.receive
+        failures = [ConnectionError('redis down')]
+
+        async def failing_receive(channel):
+            if failures:
+                raise failures.pop()
+            return await receive(channel)
+
+        class Subscriber:
+            def __init__(self):
+                self.received = asyncio.Queue()
+
+            async def send_payload(self, payload, payload_id=None):
+                self.received.put_nowait(payload)
+
+        subscriber = Subscriber()
+        failed = topic_hub.listener_failures.value
+        with mock.patch.object(channel_layer, 'receive', failing_receive), \
+                mock.patch('core.topics.LISTENER_RETRY_DELAY', 0.01):
+            await topic_hub.ensure_listening()
+            topic_hub.subscribe(subscriber, 'rooms.1')
+            try:
+                await topic_hub.publish('rooms.1', 'up')
+                self.assertEqual(await asyncio.wait_for(subscriber.received.get(), 1), {'path': 'rooms.1', 'value': 'up'})
+            finally:
+                topic_hub.unsubscribe_all(subscriber)
+                await topic_hub.stop()
+        self.assertEqual(topic_hub.listener_failures.value, failed + 1)
+
+    async def test_concurrent_connections_start_one_listener(self):
+        channel_layer = get_channel_layer()
+        new_channel = channel_layer.new_channel
+        created = []
+
+        async def slow_new_channel(prefix='specific.'):
+            await asyncio.sleep(0.01)
+            created.append(await new_channel(prefix))
+            return created[-1]
+
+        with mock.patch.object(channel_layer, 'new_channel', slow_new_channel):
+            try:
+                await asyncio.gather(*(topic_hub.ensure_listening() for _ in range(3)))
+                self.assertEqual(len(created), 1, 'the listener should be started once')
+                self.assertFalse(topic_hub.task.done())
+            finally:
+                await topic_hub.stop()
+
+
+class StartupTestCase(SimpleTestCase):
+    def test_parse_importtime(self):
+        self_times, cumulative_times = parse_importtime(
+            'import time: self [us] | cumulative | imported package\n'
+            'import time:       120 |        120 |     zlib\n'
+            'import time:      1000 |       1500 |   light.asgi\n'
+        )
+        self.assertEqual(self_times, {'zlib': 0.00012, 'light.asgi': 0.001})
+        self.assertEqual(cumulative_times['light.asgi'], 0.0015)
+
+    def test_asgi_import_within_budget(self):
+        profile = profile_import(settings.STARTUP_BUDGET['module'])
+        self.assertIn('light.asgi', profile.modules)
+        self.assertEqual(check_budget(profile), [])
+
+    def test_backends_loaded_on_first_use(self):
+        backend = get_backend('redis')
+        self.assertTrue(issubclass(backend, AsyncDB))
+
+
+class QueueLoggingTestCase(SimpleTestCase):
+    def make_record(self, name='chat.consumers', level=logging.DEBUG, lineno=10, msg='hello %s', args=('world',)):
+        return logging.LogRecord(name, level, __file__, lineno, msg, args, None)
+
+    def test_sampling_per_call_site(self):
+        sampling = SamplingFilter({'chat': 10})
+        kept = [sampling.filter(self.make_record()) for _ in range(100)]
+        self.assertEqual(sum(kept), 10)
+        self.assertTrue(sampling.filter(self.make_record(lineno=20)), 'first record of a call site is kept')
+        self.assertTrue(all(sampling.filter(self.make_record(level=logging.WARNING)) for _ in range(10)))
+        self.assertTrue(all(sampling.filter(self.make_record(name='core.state')) for _ in range(10)))
+
+    def test_full_queue_drops_instead_of_blocking(self):
+        log_queue = queue.SimpleQueue()
+        handler = NonBlockingQueueHandler(log_queue, max_size=3)
+        dropped = handler.dropped.value
+        for _ in range(5):
+            handler.handle(self.make_record())
+        self.assertEqual(log_queue.qsize(), 3)
+        self.assertEqual(handler.dropped.value - dropped, 2)
+
+    def test_records_written_by_listener_thread(self):
+        stream = io.StringIO()
+        target = logging.StreamHandler(stream)
+        target.setFormatter(JsonFormatter())
+        threads = []
+        target.addFilter(lambda record: threads.append(threading.current_thread()) or True)
+
+        queue_logging = QueueLogging()
+        queue_logging.configure({
+            'loggers': ('test_queue_logging',),
+            'level': 'INFO',
+            'max_queue_size': 100,
+            'sample_rates': {},
+        }, handlers=[target])
+        logger = logging.getLogger('test_queue_logging.consumers')
+        logger.debug('filtered out %s', 'by level')
+        logger.info('room %s joined', 'lobby', extra={'user': 7})
+        queue_logging.stop()
+
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 1)
+        data = json.loads(lines[0])
+        self.assertEqual(data['message'], 'room lobby joined')
+        self.assertEqual(data['user'], 7)
+        self.assertEqual(data['logger'], 'test_queue_logging.consumers')
+        self.assertNotIn(threading.current_thread(), threads)
+        self.assertTrue(logging.getLogger('test_queue_logging').propagate, 'stop should restore the logger')
+
+    def test_records_are_prepared_by_the_caller(self):
+        log_queue = queue.SimpleQueue()
+        handler = NonBlockingQueueHandler(log_queue)
+        members = ['a']
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            record = logging.LogRecord('chat', logging.ERROR, __file__, 10, 'members %s', (members,), sys.exc_info())
+        record.user = 7
+        handler.handle(record)
+        members.append('b')
+
+        queued = log_queue.get_nowait()
+        self.assertEqual(queued.getMessage(), "members ['a']", 'args are merged before they change')
+        self.assertIsNone(queued.exc_info)
+        self.assertIn('ValueError: boom', queued.exc_text)
+        data = json.loads(JsonFormatter().format(queued))
+        self.assertEqual(data['user'], 7)
+        self.assertIn('ValueError: boom', data['exc_info'])
+        self.assertIn('ValueError: boom', logging.Formatter().format(queued))
+        self.assertIsNotNone(record.exc_info, 'the caller\'s record is left untouched')
+
+
+class BlueprintBenchTestCase(SimpleTestCase):
+    def test_generated_schemas(self):
+        for name, generate in bench.SCHEMAS.items():
+            blueprint_class, data = generate()
+            serialized = blueprint_class(**data).serialize()
+            for key, value in data.items():
+                if isinstance(value, list):
+                    self.assertEqual(len(serialized[key]), len(value), f'{name}.{key}')
+                elif not isinstance(value, dict):
+                    self.assertEqual(serialized[key], value, f'{name}.{key}')
+
+        blueprint_class, data = bench.nested(depth=3, width=2)
+        instance = blueprint_class(**data)
+        self.assertEqual(instance.child.child.f1, 'value')
+        bench.validate(instance)
+
+    def test_run_save_and_compare(self):
+        results = bench.run(['flat'], min_time=0.001, repeat=1)
+        self.assertEqual(set(results), {
+            'flat/construct', 'flat/validate', 'flat/serialize', 'flat/serialize_selected',
+            'flat/serialize_paths', 'flat/copy', 'flat/freeze', 'flat/evolve_in', 'flat/frozen_hash',
+        })
+        self.assertTrue(all(result['seconds'] > 0 for result in results.values()))
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'baseline.json')
+            bench.save_baseline(path, results)
+            baseline = bench.load_baseline(path)
+        self.assertEqual(bench.compare(baseline, results), [])
+        slower = {case: dict(result, seconds=result['seconds'] * 2) for case, result in results.items()}
+        regressions = bench.compare(baseline, slower, threshold=0.5)
+        self.assertEqual(len(regressions), len(results))
+        self.assertTrue(all(metric == 'seconds' for _, metric, _ in regressions))
+
+
+class ProjectionTestCase(SimpleTestCase):
+    def setUp(self):
+        class Room(Blueprint):
+            id = Field(data_type=int)
+            title = Field(data_type=str, default='')
+            tags = Field(data_type=str, multi=True)
+
+            class Meta:
+                id_template = '{id}'
+
+        class Profile(Blueprint):
+            name = Field(data_type=str)
+            bio = Field(data_type=str, default='')
+
+            class Meta:
+                id_template = '{name}'
+
+        class Player(Blueprint):
+            level = Field(data_type=int, default=1)
+            profile = Field(data_type=Profile)
+            rooms = Field(data_type=Room, multi=True)
+
+            class Meta:
+                id_template = 'player'
+
+        self.player_class = Player
+        self.player = Player(
+            profile={'name': 'bob', 'bio': 'hi'},
+            rooms=[{'id': 1, 'title': 'a', 'tags': ['x']}, {'id': 2, 'title': 'b'}],
+        )
+
+    def test_nested_paths(self):
+        serialized = self.player.serialize(['profile.name', 'rooms.*.id'])
+        self.assertEqual(serialized, {'profile': {'name': 'bob'}, 'rooms': [{'id': 1}, {'id': 2}]})
+        self.assertEqual(self.player.serialize(['rooms.id']), self.player.serialize(['rooms.*.id']))
+
+        whole = self.player.serialize(['profile', 'profile.name'])
+        self.assertEqual(whole['profile'], self.player.profile.serialize(), 'a selected field wins over its paths')
+        self.assertEqual(self.player.serialize([]), self.player.serialize(), 'no selection serializes everything')
+
+    def test_compiled_once_per_class(self):
+        projection = self.player_class.projection(['rooms.*.id', 'profile.name'])
+        self.assertIsInstance(projection, Projection)
+        self.assertIs(self.player_class.projection(['profile.name', 'rooms.*.id']), projection)
+        self.assertIs(self.player_class.projection(None), self.player_class.projection(None))
+        self.assertEqual([field.name for field, _ in projection.fields], ['profile', 'rooms'])
+
+    def test_invalid_paths(self):
+        with self.assertRaises(BlueprintException):
+            self.player_class.projection(['missing'])
+        with self.assertRaises(BlueprintException):
+            self.player_class.projection(['level.value'])
+        with self.assertRaises(BlueprintException):
+            self.player_class.projection(['rooms.*.missing'])
+
+
+class VersioningTestCase(SimpleTestCase):
+    def setUp(self):
+        class Item(Blueprint):
+            label = Field(data_type=str)
+
+            class Meta:
+                id_template = '{label}'
+                version = 2
+
+        class Player(Blueprint):
+            name = Field(data_type=str)
+            score = Field(data_type=int, default=0)
+            items = Field(data_type=Item, multi=True)
+
+            class Meta:
+                id_template = '{name}'
+                version = 3
+
+        self.step_calls = []
+
+        @register_upgrade(Item, 1)
+        def item_title_to_label(payload):
+            payload['label'] = payload.pop('title')
+            return payload
+
+        @register_upgrade(Player, 1)
+        def nick_to_name(payload):
+            self.step_calls.append(1)
+            payload['name'] = payload.pop('nick')
+            return payload
+
+        @register_upgrade(Player, 2)
+        def points_to_score(payload):
+            self.step_calls.append(2)
+            payload['score'] = int(payload.pop('points'))
+            return payload
+
+        self.Item, self.Player = Item, Player
+        self.addCleanup(self.forget_classes, Item, Player)
+
+    @staticmethod
+    def forget_classes(*classes):
+        """the registries are global, classes of a test are dropped once it is done"""
+        for blueprint_class in classes:
+            UPGRADE_STEPS.pop(blueprint_class, None)
+            VERSIONED_FIELDS.pop(blueprint_class, None)
+            for key in [key for key in UPGRADE_CHAINS if key[0] is blueprint_class]:
+                del UPGRADE_CHAINS[key]
+
+    def test_serialize_stamps_version(self):
+        serialized = self.Player(name='bob', items=[{'label': 'sword'}]).serialize()
+        self.assertEqual(serialized['_v'], 3)
+        self.assertEqual(serialized['items'][0]['_v'], 2)
+        upgraded, changed = upgrade_payload(self.Player, serialized)
+        self.assertFalse(changed)
+        self.assertIs(upgraded, serialized, 'current payloads should not be copied')
+
+    def test_upgrade_chain(self):
+        stored = {'_id': 'bob', 'nick': 'bob', 'points': '7', 'items': [{'_id': 'a', 'title': 'axe'}]}
+        upgraded, changed = upgrade_payload(self.Player, stored)
+        self.assertTrue(changed)
+        self.assertEqual(upgraded['name'], 'bob')
+        self.assertEqual(upgraded['score'], 7)
+        self.assertEqual(upgraded['_v'], 3)
+        self.assertEqual(upgraded['items'][0]['label'], 'axe')
+        self.assertIn('nick', stored, 'the stored payload should not be modified')
+        self.assertEqual(self.step_calls, [1, 2])
+        player = self.Player(**upgraded)
+        self.assertEqual(player.items[0].label, 'axe')
+
+        self.assertIs(get_chain(self.Player, 1, 3), get_chain(self.Player, 1, 3), 'chains are composed once')
+        upgraded, _ = upgrade_payload(self.Player, {'_id': 'bob', 'name': 'bob', 'points': 1, '_v': 2})
+        self.assertEqual(upgraded['score'], 1)
+        with self.assertRaises(BlueprintException):
+            get_chain(self.Player, 0, 3)
+
+    async def test_lazy_upgrade_with_write_back(self):
+        db = InMemoryAsyncDB()
+        await db.set('bob', {'_id': 'bob', 'nick': 'bob', 'points': 5, 'items': []})
+        write_behind = WriteBehind(db, name='test_versioning_wb')
+        live_state = LiveState(self.Player, db=db, write_behind=write_behind, name='test_versioning')
+        player = await live_state.get('bob')
+        self.assertEqual(player.score, 5)
+        self.assertIn('bob', write_behind.pending, 'upgraded blueprints should be written back')
+        await write_behind.flush()
+        self.assertEqual(db.data['bob']['_v'], 3)
+
+    async def test_bulk_migration(self):
+        db = InMemoryAsyncDB()
+        for i in range(25):
+            await db.set(f'p{i}', {'_id': f'p{i}', 'nick': f'p{i}', 'points': i, 'items': []})
+        await db.set('current', self.Player(name='current').serialize())
+
+        live_keys = {'p0'}
+        in_flight, max_in_flight = 0, 0
+        bulk_replace = db.bulk_replace
+        newer = self.Player(name='p9', score=99).serialize()
+
+        async def slow_bulk_replace(items):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.01)
+            # loaded once scanned and written by the write behind, while its batch waits for a free slot
+            db.data['p9'] = newer
+            written = await bulk_replace(items)
+            in_flight -= 1
+            return written
+
+        db.bulk_replace = slow_bulk_replace
+        migration = Migration(db, self.Player, batch_size=4, concurrency=2, live_state=live_keys,
+                              name='test_versioning')
+        scanned = await migration.run()
+        self.assertEqual(scanned, 26)
+        self.assertLessEqual(max_in_flight, 2)
+        self.assertEqual(migration.upgraded.value, 23, 'current, live and newer payloads are skipped')
+        self.assertEqual(migration.skipped.value, 1)
+        self.assertEqual(db.data['p3']['score'], 3)
+        self.assertEqual(db.data['p3']['_v'], 3)
+        self.assertNotIn('_v', db.data['p0'], 'live keys are left to the write behind')
+        self.assertEqual(db.data['p9'], newer, 'a payload written since it was read should be kept')
+
+
+class FrozenBlueprintTestCase(SimpleTestCase):
+    def setUp(self):
+        class Room(Blueprint):
+            id = Field(data_type=int)
+            title = Field(data_type=str, default='')
+
+            class Meta:
+                id_template = '{id}'
+
+        class Profile(Blueprint):
+            name = Field(data_type=str)
+            tags = Field(data_type=str, multi=True)
+
+            class Meta:
+                id_template = '{name}'
+
+        class Player(Blueprint):
+            level = Field(data_type=int, default=1)
+            profile = Field(data_type=Profile)
+            rooms = Field(data_type=Room, multi=True)
+
+            class Meta:
+                id_template = 'player'
+
+        self.Player = Player
+        self.player = Player(
+            profile={'name': 'bob', 'tags': ['a']},
+            rooms=[{'id': 1, 'title': 'one'}, {'id': 2, 'title': 'two'}],
+        )
+
+    def test_freeze_and_read(self):
+        frozen = self.player.freeze()
+        self.assertIsInstance(frozen, FrozenBlueprint)
+        self.assertEqual(frozen.profile.name, 'bob')
+        self.assertEqual(frozen.profile.tags, ('a',))
+        self.assertEqual(frozen.rooms[1].title, 'two')
+        self.assertEqual(frozen.serialize(), self.player.serialize())
+        self.assertEqual(frozen.serialize(['rooms.*.id']), {'rooms': [{'id': 1}, {'id': 2}]})
+        with self.assertRaises(BlueprintException):
+            frozen.level = 2
+
+        # later mutations of the blueprint do not reach the snapshot
+        self.player.level = 5
+        self.assertEqual(frozen.level, 1)
+        self.assertEqual(frozen.thaw().serialize(), frozen.serialize())
+
+    def test_evolve_shares_unchanged_subtrees(self):
+        frozen = self.player.freeze()
+        changed = frozen.evolve_in('rooms.1.title', 'renamed')
+        self.assertEqual(changed.rooms[1].title, 'renamed')
+        self.assertEqual(frozen.rooms[1].title, 'two')
+        self.assertIs(changed.profile, frozen.profile)
+        self.assertIs(changed.rooms[0], frozen.rooms[0])
+
+        changed = frozen.evolve(level='3')
+        self.assertEqual(changed.level, 3, 'values are cleaned like on assignment')
+        self.assertIs(changed.rooms, frozen.rooms)
+        with self.assertRaises(BlueprintException):
+            frozen.evolve(missing=1)
+        with self.assertRaises(BlueprintException):
+            frozen.evolve_in('rooms.9.title', 'x')
+        with self.assertRaises(BlueprintTypeException):
+            frozen.evolve(level='not a number')
+
+    def test_hash_and_equality(self):
+        frozen = self.player.freeze()
+        same = frozen.evolve_in('profile.name', 'bob')
+        self.assertIsNot(same, frozen)
+        self.assertEqual(same, frozen)
+        self.assertEqual(hash(same), hash(frozen))
+        self.assertNotEqual(frozen.evolve_in('profile.name', 'alice'), frozen)
+        self.assertEqual(len({frozen, same}), 1)
+
+
+class InternTestCase(SimpleTestCase):
+    def setUp(self):
+        self.pool = ValuePool(2)
+
+        class Member(Blueprint):
+            name = Field()
+            status = Field(intern=True)
+            room = Field(intern=self.pool)
+            tags = Field(multi=True, intern=True)
+            level = Field(data_type=int, intern=True)
+
+            class Meta:
+                id_template = 'member'
+
+        self.Member = Member
+
+    def make(self, **data):
+        payload = json.dumps(dict({'name': 'alice', 'status': 'online', 'room': 'lobby',
+                                   'tags': ['admin'], 'level': 1000}, **data))
+        return self.Member(**json.loads(payload))
+
+    def test_equal_values_share_one_object(self):
+        first, second = self.make(), self.make()
+        self.assertIs(first.status, second.status)
+        self.assertIs(first.room, second.room)
+        self.assertIs(first.tags[0], second.tags[0])
+        self.assertIs(first.level, second.level)
+        self.assertIsNot(first.name, second.name)
+        # copies are built from the kept kwargs, they share the pooled values too
+        self.assertIs(copy.copy(first).status, first.status)
+
+    def test_pool_is_bounded(self):
+        for room in ('lobby', 'games', 'music'):
+            self.make(room=room)
+        self.assertEqual(len(self.pool), 2)
+        self.assertIs(self.make(room='games').room, self.make(room='games').room)
+        music = self.make(room='music')
+        self.assertEqual(music.room, 'music')
+        self.assertIsNot(music.room, self.make(room='music').room)
+
+    def test_invalid_intern(self):
+        with self.assertRaises(BlueprintException):
+            Field(intern='yes')
+
+
+class AsyncDBORMTestCase(TransactionTestCase):
+    def setUp(self):
+        class Player(Blueprint):
+            name = Field()
+            level = Field(data_type=int, default=1)
+            tags = Field(multi=True)
+
+            class Meta:
+                id_template = 'player.{name}'
+
+        self.Player = Player
+        self.db = AsyncDBORM(Player, batch_size=2)
+
+    def payload(self, name, **data):
+        return self.Player(name=name, **data).serialize()
+
+    async def test_bulk_set_inserts_then_updates(self):
+        await self.db.bulk_set({f'player.{name}': self.payload(name) for name in ('a', 'b')})
+        await self.db.bulk_set({'player.a': self.payload('a', level=5), 'player.c': self.payload('c')})
+        payloads = await self.db.get_many(['player.a', 'player.b', 'player.c', 'player.missing'])
+        self.assertEqual(sorted(payloads), ['player.a', 'player.b', 'player.c'])
+        self.assertEqual(payloads['player.a']['level'], 5)
+        self.assertEqual(self.Player(**payloads['player.a']).name, 'a')
+        self.assertIsNone(await self.db.get('player.missing'))
+        self.assertEqual(await self.db.run(BlueprintRecord.objects.filter(kind='player').count), 3)
+
+    async def test_bulk_replace_compares_stored_payloads(self):
+        await self.db.bulk_set({f'player.{name}': self.payload(name) for name in ('a', 'b')})
+        read = await self.db.get_many(['player.a', 'player.b'])
+        await self.db.set('player.b', self.payload('b', level=7))
+        written = await self.db.bulk_replace({
+            key: (payload, dict(payload, level=3)) for key, payload in list(read.items()) + [('player.c', {})]
+        })
+        self.assertEqual(written, {'player.a'})
+        payloads = await self.db.get_many(['player.a', 'player.b', 'player.c'])
+        self.assertEqual({key: payload['level'] for key, payload in payloads.items()}, {'player.a': 3, 'player.b': 7})
+
+    async def test_bulk_set_updates_keys_created_concurrently(self):
+        records = self.db.records
+        calls = []
+
+        def stale_records(keys):
+            calls.append(keys)
+            if len(calls) == 1:
+                # read before another writer committed the key
+                return {}
+            return records(keys)
+
+        await self.db.insert(self.payload('a'))
+        with mock.patch.object(self.db, 'records', stale_records):
+            await self.db.bulk_set({'player.a': self.payload('a', level=5), 'player.b': self.payload('b')})
+        self.assertEqual(len(calls), 2, 'retried once')
+        payloads = await self.db.get_many(['player.a', 'player.b'])
+        self.assertEqual(payloads['player.a']['level'], 5)
+        self.assertEqual(sorted(payloads), ['player.a', 'player.b'])
+
+    async def test_classes_sharing_a_key_are_kept_apart(self):
+        class Guest(Blueprint):
+            name = Field()
+            level = Field(data_type=int, default=1)
+
+            class Meta:
+                id_template = 'player.{name}'
+
+        guests = AsyncDBORM(Guest)
+        await self.db.bulk_set({'player.a': self.payload('a', level=2)})
+        await guests.bulk_set({'player.a': Guest(name='a', level=9).serialize()})
+        await guests.set('player.a', Guest(name='a', level=8).serialize())
+        self.assertEqual((await self.db.get('player.a'))['level'], 2, 'another class should not overwrite it')
+        self.assertEqual((await guests.get('player.a'))['level'], 8)
+        self.assertEqual([payload['level'] async for payload in guests.filter({})], [8])
+        self.assertEqual(await self.db.run(BlueprintRecord.objects.filter(key='player.a').count), 2)
+
+    async def test_filter_pages_through_matches(self):
+        await self.db.bulk_insert([self.payload(f'p{i}', level=i % 2) for i in range(5)])
+        await self.db.insert(self.payload('other', level=1))
+        names = [payload['name'] async for payload in self.db.filter({'level': 1})]
+        self.assertEqual(names, ['p1', 'p3', 'other'])
+        self.assertEqual(len([payload async for payload in self.db.filter({})]), 6)
+        names = [payload['name'] async for payload in self.db.filter({'_id': 'player.p2'})]
+        self.assertEqual(names, ['p2'])
+
+    async def test_queries_run_in_db_pool(self):
+        threads = set()
+
+        def record_thread():
+            threads.add(threading.current_thread().name)
+
+        await self.db.run(record_thread)
+        self.assertTrue(all(name.startswith('offload_db') for name in threads))
+
+    def test_conditions_map_to_lookups(self):
+        # BlueprintRecord has no column named like a field, everything is in data
+        self.assertEqual(self.db.columns, ())
+        self.assertEqual(self.db.lookups({'level': 1, '_id': 'x'}), {'data__level': 1, 'key': 'x'})
+        # the kind scopes every query instead
+        self.assertIn('"kind" = player', str(self.db.objects.query))
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class LoopProfilingTestCase(SimpleTestCase):
+    def setUp(self):
+        # a handler defined in a consumers module, like chat.consumers
+        namespace = {'__name__': 'test.consumers', 'time': time}
+        exec('def chat_message(seconds):\n    time.sleep(seconds)\n', namespace)
+        self.chat_message = namespace['chat_message']
+
+    async def test_slow_callbacks_are_recorded_with_handler(self):
+        monitor = LoopLagMonitor(interval=0.01, name='test_slow_loop', slow_threshold=0.05)
+        monitor.start()
+        await asyncio.sleep(0.03)
+        self.chat_message(0.2)
+        await asyncio.sleep(0.03)
+        await monitor.stop()
+        self.assertEqual(len(monitor.slow_callbacks), 1)
+        record = monitor.slow_callbacks[0]
+        self.assertGreaterEqual(record['lag'], 0.1)
+        self.assertEqual(record['handler'], 'chat_message')
+        self.assertIn('test.consumers:chat_message', record['stack'])
+        self.assertFalse(monitor.watchdog)
+
+    def test_sampling_profiler_collapsed_stacks(self):
+        profiler = SamplingProfiler(threading.get_ident(), interval=0.001)
+        sampler = threading.Thread(target=profiler.run, args=(0.1,))
+        sampler.start()
+        self.chat_message(0.15)
+        sampler.join()
+        self.assertGreater(profiler.samples, 10)
+        lines = profiler.collapsed().splitlines()
+        stack, count = lines[0].rsplit(' ', 1)
+        self.assertTrue(stack.endswith('test.consumers:chat_message'), 'the hottest stack is the sleeping handler')
+        self.assertEqual(sum(int(line.rsplit(' ', 1)[1]) for line in lines), profiler.samples)
+        self.assertEqual(stack.split(';'), frame_stack(sys._getframe()) + ['test.consumers:chat_message'])
+
+    async def profile_response(self, user, query_string):
+        scope = {'type': 'http', 'method': 'GET', 'path': '/debug/loop/profile', 'headers': [],
+                 'query_string': query_string, 'user': user}
+        communicator = ApplicationCommunicator(LoopProfileConsumer.as_asgi(), scope)
+        await communicator.send_input({'type': 'http.request', 'body': b''})
+        start = await communicator.receive_output(timeout=3)
+        body = await communicator.receive_output()
+        return start['status'], body['body'].decode('utf-8')
+
+    async def test_profile_endpoint(self):
+        class StaffUser:
+            is_staff = True
+
+        class NormalUser:
+            is_staff = False
+
+        status, _ = await self.profile_response(NormalUser(), b'seconds=0.1')
+        self.assertEqual(status, 403)
+        status, _ = await self.profile_response(StaffUser(), b'seconds=600')
+        self.assertEqual(status, 400)
+        status, body = await self.profile_response(StaffUser(), b'seconds=0.1')
+        self.assertEqual(status, 200)
+        self.assertTrue(all(line.rsplit(' ', 1)[1].isdigit() for line in body.splitlines()))
+        self.assertIn('asyncio', body, 'the event loop thread is sampled')
+
+
+class LaneTestConsumer(PriorityLanesMixin, AsyncJsonWebsocketConsumer):
+    async def connect(self):
+        await self.lane_group_add('lanes_test')
+        await self.accept()
+
+    async def disconnect(self, code):
+        await self.lane_group_discard('lanes_test')
+        await self.close_lanes()
+
+    async def bulk_message(self, event):
+        # a handler doing some work per message
+        await asyncio.sleep(0.002)
+        await self.send_json({'bulk': event['n']})
+
+    async def control_ping(self, event):
+        await self.send_json({'control': event['sent_at']})
+
+
+@override_settings(CHANNEL_LAYERS={'default': {
+    'BACKEND': 'channels.layers.InMemoryChannelLayer',
+    'CONFIG': {'capacity': 100, 'channel_capacity': {'*!control': 100}},
+}})
+class PriorityLanesTestCase(SimpleTestCase):
+    def tearDown(self):
+        # the lane's tasks and the layer queues it used are bound to the loop of the test
+        async_to_sync(lanes.control_lane.stop)()
+        async_to_sync(get_channel_layer().flush)()
+
+    def test_lane_channel_of_process(self):
+        self.assertEqual(lane_channel('specific.abc123!def'), 'specific.abc123!control')
+        self.assertEqual(lane_channel('specific.abc123!control'), 'specific.abc123!control')
+
+    async def flush_layer(self):
+        # the in memory layer outlives the event loop of a test, its queues do not
+        await get_channel_layer().flush()
+
+    async def test_control_latency_under_bulk_flood(self):
+        await self.flush_layer()
+        communicator = WebsocketCommunicator(LaneTestConsumer.as_asgi(), '/ws/lanes/')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        channel_layer = get_channel_layer()
+        # far more than the channel holds, the bulk lane is full and drops the rest
+        for n in range(1000):
+            await lanes.group_send(channel_layer, 'lanes_test', {'type': 'bulk.message', 'n': n})
+        sent_at = time.perf_counter()
+        await lanes.group_send(channel_layer, 'lanes_test', {
+            'type': 'control.ping', 'priority': 'control', 'sent_at': sent_at,
+        })
+
+        bulk_before = 0
+        while True:
+            frame = await communicator.receive_json_from(timeout=2)
+            if 'control' in frame:
+                break
+            bulk_before += 1
+        latency = time.perf_counter() - sent_at
+        # draining the queued bulk messages first would take 100 * 2ms
+        self.assertLessEqual(bulk_before, 2)
+        self.assertLess(latency, 0.1)
+
+        # bulk traffic goes on after the control message
+        self.assertIn('bulk', await communicator.receive_json_from())
+        await communicator.disconnect()
+        self.assertNotIn('lanes_test', lanes.control_lane.groups)
+
+    async def test_control_send_to_one_channel(self):
+        await self.flush_layer()
+        communicator = WebsocketCommunicator(LaneTestConsumer.as_asgi(), '/ws/lanes/')
+        await communicator.connect()
+        channel_layer = get_channel_layer()
+        members = lanes.control_lane.groups['lanes_test']
+        channel_name = next(iter(members))
+        await lanes.send(channel_layer, channel_name, {'type': 'control.ping', 'priority': 'control', 'sent_at': 1})
+        self.assertEqual(await communicator.receive_json_from(), {'control': 1})
+        await communicator.disconnect()
+
+    async def test_lane_groups_renewed(self):
+        channel_layer = get_channel_layer()
+        with mock.patch('core.membership.group_refresh_interval', return_value=0.01):
+            inbox = await lanes.control_lane.register('specific.inmemory!member')
+            await lanes.control_lane.group_add('lanes_renewed', 'specific.inmemory!member')
+            # expired by the layer, joined again by the renewals
+            await channel_layer.group_discard(lanes.lane_group('lanes_renewed'), lanes.control_lane.channel_name)
+            await asyncio.sleep(0.05)
+        await lanes.group_send(channel_layer, 'lanes_renewed', {'type': 'control.ping', 'priority': 'control'})
+        self.assertEqual(await asyncio.wait_for(inbox.get(), 1), {'type': 'control.ping', 'priority': 'control'})
+
+    async def test_control_channel_is_process_local(self):
+        channel_layer = get_channel_layer()
+        new_channel = channel_layer.new_channel
+        created = []
+
+        async def slow_new_channel(prefix='specific.'):
+            await asyncio.sleep(0.01)
+            created.append(await new_channel(prefix))
+            return created[-1]
+
+        with mock.patch.object(channel_layer, 'new_channel', slow_new_channel):
+            await asyncio.gather(*(lanes.control_lane.register(f'specific.inmemory!m{i}') for i in range(3)))
+        self.assertEqual(len(created), 1, 'the listener should be started once')
+        self.assertEqual(lanes.control_lane.channel_name, lane_channel(created[0]))
+        self.assertTrue(lanes.control_lane.channel_name.endswith('!control'), 'a channel of the process')
+
+    async def test_receive_survives_closed_lanes(self):
+        class Receiver(PriorityLanesMixin):
+            channel_name = 'specific.inmemory!receiver'
+
+        bulk = asyncio.Queue()
+        receiver = Receiver()
+        receiver.channel_receive = bulk.get
+        receiving = asyncio.ensure_future(receiver.lanes_receive())
+        await asyncio.sleep(0.01)
+        # the consumer disconnects while its receive waits
+        await receiver.close_lanes()
+        bulk.put_nowait({'type': 'bulk.message', 'n': 1})
+        self.assertEqual(await asyncio.wait_for(receiving, 1), {'type': 'bulk.message', 'n': 1})
+
+
+class FakeKeyValueRedis(FakeRedis):
+    """FakeRedis with the string commands used by ShardedRedis, calls are counted by command"""
+    def __init__(self):
+        super(FakeKeyValueRedis, self).__init__()
+        self.values: typing.Dict = {}
+        self.calls: typing.Dict[typing.AnyStr, int] = {}
+
+    def count(self, command):
+        self.calls[command] = self.calls.get(command, 0) + 1
+
+    SET_IF_NOT_EXIST = 'SET_IF_NOT_EXIST'
+
+    async def get(self, key):
+        return self.values.get(key)
+
+    async def set(self, key, value, expire=0, exist=None):
+        if exist is self.SET_IF_NOT_EXIST and key in self.values:
+            return False
+        self.values[key] = value
+        return True
+
+    async def mget(self, *keys):
+        self.count('mget')
+        return [self.values.get(key) for key in keys]
+
+    async def mset(self, *pairs):
+        self.count('mset')
+        self.values.update(zip(pairs[::2], pairs[1::2]))
+
+    async def delete(self, *keys):
+        return sum(self.values.pop(key, None) is not None for key in keys)
+
+    async def iscan(self, match=None):
+        prefix = match.rstrip('*')
+        for key in list(self.values):
+            if key.startswith(prefix):
+                yield key.encode('utf-8')
+
+    async def dump(self, key):
+        return None if key not in self.values else ('dump', self.values[key])
+
+    async def pttl(self, key):
+        return -1 if key in self.values else -2
+
+    async def restore(self, key, ttl, value):
+        if key in self.values:
+            raise Exception('BUSYKEY Target key name already exists.')
+        self.values[key] = value[1]
+
+    async def eval(self, script, keys=(), args=()):
+        # COMPARE_AND_SET_SCRIPT
+        self.count('eval')
+        written = []
+        for key, expected, value in zip(keys, args[::2], args[1::2]):
+            if self.values.get(key) == expected:
+                self.values[key] = value
+                written.append(key.encode('utf-8'))
+        return written
+
+
+class ShardingTestCase(SimpleTestCase):
+    def make_shards(self, names, clients=None, previous_names=None):
+        clients = clients if clients is not None else {}
+        for name in names:
+            clients.setdefault(name, FakeKeyValueRedis())
+        previous_nodes = {name: {} for name in previous_names} if previous_names else None
+        shards = ShardedRedis({name: {} for name in names}, vnodes=160, namespace='test', clients=clients,
+                              previous_nodes=previous_nodes)
+        return shards, clients
+
+    def test_ring_spreads_keys_and_moves_few(self):
+        keys = [f'user.{i}' for i in range(10000)]
+        ring = HashRing(['a', 'b', 'c'])
+        before = {key: ring.node_for(key) for key in keys}
+        counts = collections.Counter(before.values())
+        self.assertTrue(all(2500 < count < 4200 for count in counts.values()), counts)
+
+        ring.add_node('d')
+        moved = [key for key in keys if ring.node_for(key) != before[key]]
+        self.assertTrue(all(ring.node_for(key) == 'd' for key in moved), 'keys only move to the new node')
+        self.assertTrue(1800 < len(moved) < 3200, len(moved))
+
+        ring.remove_node('d')
+        self.assertEqual({key: ring.node_for(key) for key in keys}, before)
+
+    def test_hash_tags_keep_keys_together(self):
+        self.assertEqual(routing_key('tag:db:{player.42}:rooms'), 'player.42')
+        self.assertEqual(routing_key('no tag'), 'no tag')
+        ring = HashRing(['a', 'b', 'c', 'd'])
+        for i in range(100):
+            self.assertEqual(ring.node_for(f'tag:db:{{user.{i}}}'), ring.node_for(f'tag:history:{{user.{i}}}:x'))
+
+    async def test_multi_key_operations_split_per_node(self):
+        shards, clients = self.make_shards(['a', 'b', 'c'])
+        items = {shards.key('db', i): str(i) for i in range(300)}
+        await shards.mset(items)
+        self.assertEqual(await shards.mget(list(items) + [shards.key('db', 'missing')]), items)
+        for client in clients.values():
+            self.assertEqual(client.calls, {'mset': 1, 'mget': 1})
+            self.assertTrue(client.values)
+
+    async def test_async_db_redis(self):
+        shards, _ = self.make_shards(['a', 'b'])
+        db = AsyncDBRedis(shards, scan_batch_size=7)
+        await db.bulk_set({f'player.{i}': {'_id': f'player.{i}', 'level': i % 3} for i in range(20)})
+        await db.insert({'_id': 'player.x', 'level': 1})
+        self.assertEqual(await db.get('player.3'), {'_id': 'player.3', 'level': 0})
+        self.assertIsNone(await db.get('player.missing'))
+        self.assertEqual(sorted(await db.get_many(['player.1', 'player.2', 'missing'])), ['player.1', 'player.2'])
+        found = sorted([payload['_id'] async for payload in db.filter({'level': 1})])
+        self.assertEqual(len(found), 8)
+        self.assertIn('player.x', found)
+
+        stored = await db.get('player.1')
+        await db.set('player.2', {'_id': 'player.2', 'level': 9})
+        written = await db.bulk_replace({
+            'player.1': (stored, dict(stored, level=5)),
+            'player.2': ({'_id': 'player.2', 'level': 2}, {'_id': 'player.2', 'level': 5}),
+        })
+        self.assertEqual(written, {'player.1'})
+        self.assertEqual((await db.get('player.1'))['level'], 5)
+        self.assertEqual((await db.get('player.2'))['level'], 9, 'changed since read, should be kept')
+
+    async def test_rebalance_moves_only_keys_of_the_new_node(self):
+        shards, clients = self.make_shards(['a', 'b', 'c'])
+        items = {shards.key('db', i): str(i) for i in range(1000)}
+        await shards.mset(items)
+        before = {key: shards.ring.node_for(key) for key in items}
+
+        # keys of the namespace not routed by the ring, e.g. the channel layer's
+        clients['a'].values['test:asgi:group:chat_room1'] = 'members'
+
+        grown, clients = self.make_shards(['a', 'b', 'c', 'd'], clients, previous_names=['a', 'b', 'c'])
+        moving = [key for key in items if grown.ring.node_for(key) != before[key]]
+        # deployed, not rebalanced yet: keys not moved are read from their previous owner
+        self.assertEqual(await grown.mget(items), items)
+        self.assertEqual(await grown.get(moving[0]), items[moving[0]])
+        await grown.set(moving[1], 'written through the new ring')
+
+        moves = await rebalance(grown, batch_size=50)
+        self.assertEqual(set(target for _, target in moves), {'d'})
+        self.assertEqual(sum(moves.values()), len(moving))
+        self.assertEqual(clients['a'].values.pop('test:asgi:group:chat_room1'), 'members')
+        for name, client in clients.items():
+            self.assertTrue(all(grown.ring.node_for(key) == name for key in client.values))
+        items[moving[1]] = 'written through the new ring'
+        self.assertEqual(await grown.mget(items), items)
+        self.assertEqual(await rebalance(grown), {}, 'nothing left to move')
+        rebalanced, _ = self.make_shards(['a', 'b', 'c', 'd'], clients)
+        self.assertEqual(await rebalanced.mget(items), items, 'every key is on its owner')
+
+    async def test_deleted_keys_are_not_read_from_the_previous_owner(self):
+        shards, clients = self.make_shards(['a', 'b'], previous_names=['a'])
+        key = next(shards.key('db', i) for i in range(100) if shards.ring.node_for(shards.key('db', i)) == 'b')
+        clients['a'].values[key] = 'not moved'
+        self.assertEqual(await shards.get(key), 'not moved')
+        await shards.delete([key])
+        self.assertIsNone(await shards.get(key))
+        self.assertEqual(await shards.mget([key]), {})
+
+    def test_rebalance_needs_the_previous_nodes_deployed(self):
+        with self.assertRaises(CommandError):
+            call_command('rebalance_redis', '--dry-run')
+
+    async def test_move_keeps_the_newer_target_copy(self):
+        shards, clients = self.make_shards(['a', 'b'])
+        stale, fresh = shards.key('db', 'stale'), shards.key('db', 'fresh')
+        clients['a'].values.update({stale: 'old', fresh: 'value'})
+        # written through the new ring while the move was pending
+        clients['b'].values[stale] = 'new'
+        kept = shards.kept_target.value
+        self.assertEqual(await shards.move([stale, fresh], 'a', 'b'), 1)
+        self.assertEqual(clients['b'].values, {stale: 'new', fresh: 'value'})
+        self.assertEqual(clients['a'].values, {}, 'both source copies are dropped')
+        self.assertEqual(shards.kept_target.value - kept, 1)
+
+    def test_channel_layer_hash(self):
+        hosts = [f'redis://10.0.0.{i}:6379' for i in range(3)]
+        layer = ShardedRedisChannelLayer(hosts=hosts)
+        grown = ShardedRedisChannelLayer(hosts=hosts + ['redis://10.0.0.3:6379'])
+        groups = [f'chat_room{i}' for i in range(1000)]
+        self.assertEqual({layer.consistent_hash(group) for group in groups}, {0, 1, 2})
+        kept = sum(layer.consistent_hash(group) == grown.consistent_hash(group) for group in groups)
+        self.assertGreater(kept, 650)
+
+
+class DedupTestCase(SimpleTestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.clock = lambda: self.now
+
+    def test_bloom_filter_error_rate(self):
+        bloom = BloomFilter(10000, 0.01)
+        for i in range(10000):
+            bloom.add(f'id-{i}')
+        self.assertTrue(all(f'id-{i}' in bloom for i in range(10000)), 'no false negatives')
+        false_positives = sum(f'other-{i}' in bloom for i in range(10000))
+        self.assertLess(false_positives / 10000, 0.02)
+        # about 9.6 bits per item at 1%
+        self.assertLess(bloom.nbytes, 10000 * 10 / 8 + 8)
+
+    def test_rolling_filter_forgets_after_window(self):
+        bloom = RollingBloomFilter(1000, 0.001, window=60, clock=self.clock)
+        bloom.add('a')
+        self.now = 31
+        bloom.add('b')
+        self.assertIn('a', bloom)
+        self.now = 61
+        self.assertNotIn('a', bloom)
+        self.assertIn('b', bloom)
+        self.now = 1000
+        self.assertNotIn('b', bloom)
+
+    async def test_deduplicator(self):
+        deduplicator = Deduplicator(window=60, capacity=1000, error_rate=0.001, exact_size=2, clock=self.clock)
+        self.assertFalse(await deduplicator.seen('room1', 'm1'))
+        self.assertTrue(await deduplicator.seen('room1', 'm1'))
+        self.assertFalse(await deduplicator.seen('room2', 'm1'), 'ids are scoped by key')
+        self.assertFalse(await deduplicator.seen('room1', 'm2'))
+        self.now = 100
+        self.assertFalse(await deduplicator.seen('room1', 'm2'), 'older than the window')
+
+        # bounded whatever the capacity
+        self.assertEqual(Deduplicator(capacity=1000000).store.size, 10000)
+
+    async def test_local_store_trusts_the_filter_past_its_size(self):
+        deduplicator = Deduplicator(window=60, capacity=1000, error_rate=0.001, exact_size=2, clock=self.clock)
+        # a false positive of the filter, confirmed new while the store holds the whole window
+        deduplicator.filter.add('room1 m0')
+        self.assertFalse(await deduplicator.seen('room1', 'm0'))
+
+        for message_id in ('m1', 'm2', 'm3'):
+            self.assertFalse(await deduplicator.seen('room1', message_id))
+        unconfirmed = deduplicator.store.unconfirmed.value
+        self.assertTrue(await deduplicator.seen('room1', 'm1'), 'pushed out, the filter hit is trusted')
+        self.assertEqual(deduplicator.store.unconfirmed.value - unconfirmed, 1)
+        deduplicator.filter.add('room1 m4')
+        self.assertTrue(await deduplicator.seen('room1', 'm4'), 'a false positive is dropped meanwhile')
+
+        self.now = 61
+        deduplicator.filter.add('room1 m5')
+        self.assertFalse(await deduplicator.seen('room1', 'm5'), 'the ids pushed out left the window')
+
+    async def test_shared_id_store(self):
+        redis = FakeKeyValueRedis()
+        deduplicator = Deduplicator(window=60, capacity=1000, redis={'conn_args': {}}, project_tag='test')
+        deduplicator.store.redis = redis
+        self.assertFalse(await deduplicator.seen('room1', 'm1'))
+        self.assertTrue(await deduplicator.seen('room1', 'm1'), 'resent while its key is being written')
+        await asyncio.sleep(0)
+        self.assertEqual(redis.values, {'test:dedup:room1 m1': 1})
+        self.assertTrue(await deduplicator.seen('room1', 'm1'))
+
+        # a false positive of the filter is confirmed new by the store
+        deduplicator.filter.add('room1 m2')
+        possible = deduplicator.possible.value
+        self.assertFalse(await deduplicator.seen('room1', 'm2'))
+        self.assertEqual(deduplicator.possible.value - possible, 1)
+        self.assertIn('test:dedup:room1 m2', redis.values)
@@ -0,0 +1,256 @@
+import time
+import typing
+import asyncio
+import logging
+
+from django.conf import settings
+
+from core import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Timer:
+    __slots__ = ('callback', 'args', 'deadline', 'interval', 'slot', 'cancelled')
+
+    def __init__(self, callback: typing.Callable, args: typing.Tuple, deadline: int, interval: int = 0):
+        self.callback: typing.Callable = callback
+        self.args: typing.Tuple = args
+        # in ticks
+        self.deadline: int = deadline
+        self.interval: int = interval
+        # the wheel slot holding the timer, cancelling just removes it from there
+        self.slot: typing.Optional[typing.Set] = None
+        self.cancelled: bool = False
+
+    def cancel(self):
+        self.cancelled = True
+        if self.slot is not None:
+            self.slot.discard(self)
+            self.slot = None
+
+
+class TimerWheel:
+    """
+    Hierarchical timer wheel (Varghese & Lauck). Level 0 has one slot per tick, every slot of
+    level n covers a whole turn of level n - 1. Timers due far away sit in a coarse slot and
+    cascade down when its turn comes. Scheduling and cancelling are O(1), and one asyncio task
+    drives every timer of the process instead of a sleeping coroutine per connection.
+
+    Callbacks due on the same tick run as one batch, coroutine callbacks of the batch are
+    gathered in a single task.
+    """
+    def __init__(self, tick: float = 0.1, wheel_sizes: typing.Tuple[int, ...] = (256, 64, 64, 64)):
+        self.tick: float = tick
+        self.wheel_sizes: typing.Tuple[int, ...] = wheel_sizes
+        self.levels: typing.List[typing.List[typing.Set]] = [
+            [set() for _ in range(size)] for size in wheel_sizes
+        ]
+        # ticks covered by one slot of every level
+        self.spans: typing.List[int] = []
+        span = 1
+        for size in wheel_sizes:
+            self.spans.append(span)
+            span *= size
+        self.max_ticks: int = span - 1
+
+        self.current_tick: int = 0
+        self.started_at: float = 0.0
+        self.task: typing.Optional[asyncio.Task] = None
+
+        self.timers = metrics.gauge('timer_wheel.timers')
+        self.fired = metrics.counter('timer_wheel.fired')
+        self.batch_latency = metrics.timer('timer_wheel.batch_latency')
+
+    def __len__(self) -> int:
+        return sum(len(slot) for level in self.levels for slot in level)
+
+    def ticks(self, seconds: float) -> int:
+        return max(1, int(round(seconds / self.tick)))
+
+    def schedule(self, timer: Timer):
+        delta = min(max(timer.deadline - self.current_tick, 0), self.max_ticks)
+        deadline = self.current_tick + delta
+        for level, size in enumerate(self.wheel_sizes):
+            if level == len(self.wheel_sizes) - 1 or delta < self.spans[level] * size:
+                slot = self.levels[level][(deadline // self.spans[level]) % size]
+                slot.add(timer)
+                timer.slot = slot
+                return
+
+    def call_later(self, delay: float, callback: typing.Callable, *args) -> Timer:
+        timer = Timer(callback, args, self.current_tick + self.ticks(delay))
+        self.schedule(timer)
+        self.ensure_started()
+        return timer
+
+    def call_every(self, interval: float, callback: typing.Callable, *args, delay: float = None) -> Timer:
+        ticks = self.ticks(interval)
+        first = ticks if delay is None else self.ticks(delay)
+        timer = Timer(callback, args, self.current_tick + first, interval=ticks)
+        self.schedule(timer)
+        self.ensure_started()
+        return timer
+
+    def cascade(self, level: int):
+        size = self.wheel_sizes[level]
+        slot = self.levels[level][(self.current_tick // self.spans[level]) % size]
+        timers = list(slot)
+        slot.clear()
+        for timer in timers:
+            self.schedule(timer)
+
+    def advance(self) -> typing.List[Timer]:
+        """move the wheel one tick forward, return the timers due on the new tick"""
+        self.current_tick += 1
+        for level in range(len(self.wheel_sizes) - 1, 0, -1):
+            if self.current_tick % self.spans[level] == 0:
+                self.cascade(level)
+        slot = self.levels[0][self.current_tick % self.wheel_sizes[0]]
+        due = [timer for timer in slot if timer.deadline <= self.current_tick]
+        for timer in due:
+            slot.discard(timer)
+            timer.slot = None
+        return due
+
+    def fire(self, due: typing.List[Timer]):
+        coroutines = []
+        for timer in due:
+            if timer.cancelled:
+                continue
+            if timer.interval:
+                # never into the past, a late timer would otherwise wait for a whole turn of level 0
+                timer.deadline = max(timer.deadline + timer.interval, self.current_tick + 1)
+                self.schedule(timer)
+            try:
+                result = timer.callback(*timer.args)
+            except Exception as e:
+                logger.error('timer callback %s failed: %r', timer.callback, e)
+                continue
+            if asyncio.iscoroutine(result):
+                coroutines.append(result)
+        self.fired.inc(len(due))
+        if coroutines:
+            asyncio.ensure_future(self.run_batch(coroutines))
+
+    @staticmethod
+    async def run_batch(coroutines: typing.List[typing.Coroutine]):
+        results = await asyncio.gather(*coroutines, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error('timer callback failed: %r', result)
+
+    def run_pending(self, now: float):
+        target_tick = int((now - self.started_at) / self.tick)
+        start = time.perf_counter()
+        # a lagging loop catches up tick by tick, timers still fire in order
+        while self.current_tick < target_tick:
+            due = self.advance()
+            if due:
+                self.fire(due)
+        self.batch_latency.observe(time.perf_counter() - start)
+        self.timers.set(len(self))
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        self.started_at = loop.time() - self.current_tick * self.tick
+        while True:
+            next_tick_at = self.started_at + (self.current_tick + 1) * self.tick
+            await asyncio.sleep(max(0.0, next_tick_at - loop.time()))
+            self.run_pending(loop.time())
+
+    def ensure_started(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # not in a running loop (e.g. scheduling from sync code), started by the next async caller
+            return
+        if self.task is None or self.task.done() or self.task.get_loop() is not loop:
+            self.task = loop.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+
+timer_wheel = TimerWheel(
+    tick=settings.TIMER_WHEEL['tick'],
+    wheel_sizes=settings.TIMER_WHEEL['wheel_sizes'],
+)
+
+
+# clients answer every {"heartbeat": ts} with this text frame, in every wire format
+PONG_FRAME = 'pong'
+
+
+class ConnectionTimersMixin:
+    """
+    Timers of one websocket connection on the shared timer wheel: heartbeats, idle timeout
+    reaping, debounced pushes and handler timers. Everything is cancelled on disconnect.
+
+    A connection is alive while it sends frames: clients that only listen answer each heartbeat
+    with a PONG_FRAME text frame, consumed here without reaching the consumer's receive. Pings
+    of the websocket transport are handled by the server, the application never sees them.
+    """
+    def __init__(self, *args, **kwargs):
+        super(ConnectionTimersMixin, self).__init__(*args, **kwargs)
+        self.timers: typing.Set[Timer] = set()
+        self.debounced: typing.Dict[typing.Any, Timer] = {}
+        self.last_seen: float = time.monotonic()
+
+    def add_timer(self, timer: Timer) -> Timer:
+        self.timers.add(timer)
+        return timer
+
+    def cancel_timer(self, timer: Timer):
+        timer.cancel()
+        self.timers.discard(timer)
+
+    def cancel_timers(self):
+        for timer in self.timers:
+            timer.cancel()
+        self.timers.clear()
+        self.debounced.clear()
+
+    def debounce(self, key, delay: float, callback: typing.Callable, *args) -> Timer:
+        """run callback once, delay seconds after the last call with the same key"""
+        previous = self.debounced.pop(key, None)
+        if previous is not None:
+            self.cancel_timer(previous)
+
+        def fire():
+            self.debounced.pop(key, None)
+            self.timers.discard(timer)
+            return callback(*args)
+
+        timer = self.add_timer(timer_wheel.call_later(delay, fire))
+        self.debounced[key] = timer
+        return timer
+
+    def start_heartbeat(self):
+        config = settings.TIMER_WHEEL
+        self.last_seen = time.monotonic()
+        self.add_timer(timer_wheel.call_every(config['heartbeat_interval'], self.heartbeat))
+
+    async def heartbeat(self):
+        if time.monotonic() - self.last_seen > settings.TIMER_WHEEL['idle_timeout']:
+            # nothing received for too long, the socket is most likely dead
+            self.cancel_timers()
+            await self.close()
+        else:
+            await self.send_payload({'heartbeat': int(time.time())})
+
+    async def websocket_receive(self, message):
+        self.last_seen = time.monotonic()
+        if message.get('text') == PONG_FRAME:
+            return
+        await super(ConnectionTimersMixin, self).websocket_receive(message)
+
+    async def websocket_disconnect(self, message):
+        self.cancel_timers()
+        await super(ConnectionTimersMixin, self).websocket_disconnect(message)
@@ -0,0 +1,252 @@
+import typing
+import asyncio
+import logging
+
+from channels.layers import get_channel_layer
+
+from core import metrics
+from core.wire import new_payload_id
+from core.asgi_middleware import lifespan
+from core.membership import keep_groups
+from core.membership import LISTENER_RETRY_DELAY
+from core.blueprint import BlueprintMeta
+
+SEPARATOR = '.'
+# matches exactly one path segment
+WILDCARD = '*'
+# channel layer group joined by one listener channel per process
+TOPICS_GROUP = 'state_topics'
+
+logger = logging.getLogger(__name__)
+
+
+def split_path(path: typing.AnyStr) -> typing.List[typing.AnyStr]:
+    segments = path.split(SEPARATOR)
+    if not all(segments):
+        raise ValueError(f'invalid state path {path!r}')
+    return segments
+
+
+class TopicNode:
+    __slots__ = ('children', 'subscribers')
+
+    def __init__(self):
+        self.children: typing.Dict[typing.AnyStr, 'TopicNode'] = {}
+        self.subscribers: typing.Set = set()
+
+
+class TopicTrie:
+    """
+    Subscriptions by state path, one trie level per path segment. A subscription covers the
+    subtree under its path: 'inventory' and 'inventory.*' both receive 'inventory.sword.count'.
+    Matching walks the published path once (plus one branch per '*' child), so its cost depends
+    on the path length, not on the number of subscribers.
+    """
+    def __init__(self):
+        self.root = TopicNode()
+        self.size: int = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def subscribe(self, pattern: typing.AnyStr, subscriber) -> bool:
+        node = self.root
+        for segment in split_path(pattern):
+            child = node.children.get(segment)
+            if child is None:
+                child = TopicNode()
+                node.children[segment] = child
+            node = child
+        if subscriber in node.subscribers:
+            return False
+        node.subscribers.add(subscriber)
+        self.size += 1
+        return True
+
+    def unsubscribe(self, pattern: typing.AnyStr, subscriber) -> bool:
+        # remember the walk to prune nodes left empty
+        trail = []
+        node = self.root
+        for segment in split_path(pattern):
+            child = node.children.get(segment)
+            if child is None:
+                return False
+            trail.append((node, segment))
+            node = child
+        if subscriber not in node.subscribers:
+            return False
+        node.subscribers.discard(subscriber)
+        self.size -= 1
+        for parent, segment in reversed(trail):
+            child = parent.children[segment]
+            if child.subscribers or child.children:
+                break
+            del parent.children[segment]
+        return True
+
+    def match(self, path: typing.AnyStr) -> typing.Set:
+        matched = set()
+        nodes = [self.root]
+        for segment in split_path(path):
+            next_nodes = []
+            for node in nodes:
+                for key in (segment, WILDCARD):
+                    child = node.children.get(key)
+                    if child is not None:
+                        # subscribers of an ancestor path receive the updates of its subtree
+                        matched.update(child.subscribers)
+                        next_nodes.append(child)
+            if not next_nodes:
+                break
+            nodes = next_nodes
+        return matched
+
+
+class TopicHub:
+    """
+    Process wide routing of state updates to websocket consumers. Every process listens on one
+    channel of the TOPICS_GROUP group, a published update crosses the channel layer once per
+    process and is matched against the local trie, so only subscribed connections get a frame.
+    """
+    def __init__(self):
+        self.trie = TopicTrie()
+        # consumer -> its patterns, dropped in one call on disconnect
+        self.patterns: typing.Dict[typing.Any, typing.Set[typing.AnyStr]] = {}
+        self.channel_name: typing.Optional[typing.AnyStr] = None
+        self.task: typing.Optional[asyncio.Task] = None
+        self.renew_task: typing.Optional[asyncio.Task] = None
+        # (loop, lock), connections of one loop start the listener one at a time
+        self.listen_lock: typing.Optional[typing.Tuple[asyncio.AbstractEventLoop, asyncio.Lock]] = None
+
+        self.subscriptions = metrics.gauge('topics.subscriptions')
+        self.listener_failures = metrics.counter('topics.listener_failures')
+        self.delivered = metrics.counter('topics.delivered')
+        self.match_latency = metrics.timer('topics.match_latency')
+
+    def subscribe(self, subscriber, pattern: typing.AnyStr) -> bool:
+        added = self.trie.subscribe(pattern, subscriber)
+        if added:
+            self.patterns.setdefault(subscriber, set()).add(pattern)
+            self.subscriptions.set(len(self.trie))
+        return added
+
+    def unsubscribe(self, subscriber, pattern: typing.AnyStr) -> bool:
+        removed = self.trie.unsubscribe(pattern, subscriber)
+        if removed:
+            patterns = self.patterns.get(subscriber)
+            patterns.discard(pattern)
+            if not patterns:
+                del self.patterns[subscriber]
+            self.subscriptions.set(len(self.trie))
+        return removed
+
+    def unsubscribe_all(self, subscriber):
+        for pattern in list(self.patterns.get(subscriber, ())):
+            self.unsubscribe(subscriber, pattern)
+
+    async def dispatch(self, path: typing.AnyStr, value: typing.Any, payload_id: typing.AnyStr = None):
+        with self.match_latency.time():
+            subscribers = self.trie.match(path)
+        payload = {'path': path, 'value': value}
+        for subscriber in subscribers:
+            try:
+                await subscriber.send_payload(payload, payload_id=payload_id)
+            except Exception as e:
+                logger.error('state update to %s failed: %r', subscriber, e)
+        self.delivered.inc(len(subscribers))
+
+    async def publish(self, path: typing.AnyStr, value: typing.Any):
+        split_path(path)
+        await get_channel_layer().group_send(TOPICS_GROUP, {
+            'type': 'state.update',
+            'path': path,
+            'value': value,
+            'payload_id': new_payload_id(),
+        })
+
+    async def publish_blueprint(self, prefix: typing.AnyStr, blueprint):
+        for path, value in blueprint_paths(blueprint, prefix):
+            await self.publish(path, value)
+
+    async def listen(self):
+        channel_layer = get_channel_layer()
+        while True:
+            try:
+                message = await channel_layer.receive(self.channel_name)
+                if message.get('type') == 'state.update':
+                    await self.dispatch(message['path'], message['value'], message.get('payload_id'))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # e.g. redis unreachable, the process keeps its listener and tries again
+                self.listener_failures.inc()
+                logger.error('state topics listener failed: %r', e)
+                await asyncio.sleep(LISTENER_RETRY_DELAY)
+
+    def is_listening(self, loop) -> bool:
+        return self.task is not None and not self.task.done() and self.task.get_loop() is loop
+
+    async def ensure_listening(self):
+        loop = asyncio.get_running_loop()
+        if self.is_listening(loop):
+            return
+        if self.listen_lock is None or self.listen_lock[0] is not loop:
+            self.listen_lock = (loop, asyncio.Lock())
+        async with self.listen_lock[1]:
+            # another connection may have started it while this one waited
+            if not self.is_listening(loop):
+                await self.start_listening(loop)
+
+    async def start_listening(self, loop):
+        if self.task is not None and self.task.get_loop() is not loop:
+            # the listener of a previous (closed) loop
+            await self.stop()
+        channel_layer = get_channel_layer()
+        if self.channel_name is None:
+            # a channel of the process like the consumers' ones, read by the receive loop they share
+            self.channel_name = await channel_layer.new_channel()
+        await channel_layer.group_add(TOPICS_GROUP, self.channel_name)
+        self.task = loop.create_task(self.listen())
+        if self.renew_task is None or self.renew_task.done():
+            self.renew_task = loop.create_task(keep_groups(self.channel_name, lambda: [TOPICS_GROUP]))
+
+    async def stop(self):
+        for task in (self.task, self.renew_task):
+            if task is None or task.done() or task.get_loop().is_closed():
+                continue
+            task.cancel()
+            if task.get_loop() is asyncio.get_running_loop():
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self.task = self.renew_task = None
+        if self.channel_name is not None:
+            await get_channel_layer().group_discard(TOPICS_GROUP, self.channel_name)
+            self.channel_name = None
+
+
+def can_subscribe(user, pattern: typing.AnyStr) -> bool:
+    """state under 'users.<id>' is private to that user, everything else is shared"""
+    segments = split_path(pattern)
+    if segments[0] in ('users', WILDCARD):
+        return len(segments) > 1 and segments[0] == 'users' and segments[1] == str(user.id)
+    return True
+
+
+def blueprint_paths(blueprint, prefix: typing.AnyStr) -> typing.Iterator[typing.Tuple[typing.AnyStr, typing.Any]]:
+    """(path, serialized value) of every leaf field, nested blueprints become nested paths"""
+    for field in blueprint.field_plan:
+        value = getattr(blueprint, field.name)
+        path = f'{prefix}{SEPARATOR}{field.name}'
+        if isinstance(field.data_type, BlueprintMeta):
+            if field.multi:
+                yield path, [item.serialize() for item in value]
+            else:
+                yield from blueprint_paths(value, path)
+        else:
+            yield path, list(value) if field.multi else value
+
+
+topic_hub = TopicHub()
+lifespan.on_shutdown(topic_hub.stop)
@@ -0,0 +1,162 @@
+import json
+import uuid
+import zlib
+import typing
+import collections
+
+import msgpack
+from django.conf import settings
+
+from core import metrics
+from core.offload import loads_frame
+
+# subprotocol names are prefixed, e.g. a client asks for 'light.msgpack.deflate'
+SUBPROTOCOL_PREFIX = 'light.'
+
+
+class FrameTooLarge(ValueError):
+    pass
+
+
+# a client frame failing with one of these is rejected: oversized, not deflate, not json / msgpack
+# (msgpack raises ValueError subclasses, e.g. ExtraData, and TypeError for unhashable map keys)
+UNDECODABLE = (zlib.error, ValueError, TypeError, msgpack.UnpackException)
+
+
+class WireFormat:
+    def __init__(self, name: typing.AnyStr, binary: bool, dumps: typing.Callable, loads: typing.Callable,
+                 compressed: bool = False):
+        self.name: typing.AnyStr = name
+        self.binary: bool = binary
+        self.compressed: bool = compressed
+        self.dumps: typing.Callable = dumps
+        self.loads: typing.Callable = loads
+        self.subprotocol: typing.AnyStr = f'{SUBPROTOCOL_PREFIX}{name}'
+        self.bytes_out = metrics.counter(f'wire.{name}.bytes_out')
+
+    def encode(self, payload: typing.Any) -> typing.Union[str, bytes]:
+        data = self.dumps(payload)
+        if self.compressed:
+            data = zlib.compress(data, settings.WIRE_FORMAT['compress_level'])
+        return data
+
+    def decode(self, data: typing.Union[str, bytes]) -> typing.Any:
+        if self.compressed:
+            # client frames are untrusted, a few KB may inflate to GBs: stop at max_frame
+            max_frame = settings.WIRE_FORMAT['max_frame']
+            decompressor = zlib.decompressobj()
+            data = decompressor.decompress(data, max_frame)
+            # input left over, or all of it read but more output still buffered
+            truncated = bool(decompressor.unconsumed_tail) or (
+                not decompressor.eof and bool(decompressor.decompress(b'', 1))
+            )
+            if truncated:
+                raise FrameTooLarge(f'{self.name} frame inflates to more than {max_frame} bytes')
+        return self.loads(data)
+
+
+def json_dumps_bytes(payload: typing.Any) -> bytes:
+    return json.dumps(payload, separators=(',', ':')).encode('utf-8')
+
+
+def msgpack_dumps(payload: typing.Any) -> bytes:
+    return msgpack.packb(payload, use_bin_type=True)
+
+
+def msgpack_loads(data: bytes) -> typing.Any:
+    return msgpack.unpackb(data, raw=False)
+
+
+# text frames for 'json' so existing clients keep working, everything else travels as binary frames
+FORMATS: typing.Dict[typing.AnyStr, WireFormat] = {
+    wire_format.name: wire_format for wire_format in (
+        WireFormat('json', binary=False, dumps=json.dumps, loads=json.loads),
+        WireFormat('json.deflate', binary=True, dumps=json_dumps_bytes, loads=json.loads, compressed=True),
+        WireFormat('msgpack', binary=True, dumps=msgpack_dumps, loads=msgpack_loads),
+        WireFormat('msgpack.deflate', binary=True, dumps=msgpack_dumps, loads=msgpack_loads, compressed=True),
+    )
+}
+DEFAULT_FORMAT = FORMATS['json']
+
+
+def negotiate(subprotocols: typing.Iterable[typing.AnyStr]) -> typing.Optional[WireFormat]:
+    """first subprotocol offered by the client that we support, None if there is none"""
+    for subprotocol in subprotocols:
+        if subprotocol.startswith(SUBPROTOCOL_PREFIX):
+            wire_format = FORMATS.get(subprotocol[len(SUBPROTOCOL_PREFIX):])
+            if wire_format is not None:
+                return wire_format
+    return None
+
+
+class EncodedCache:
+    """
+    LRU of encoded payloads keyed by (payload id, format name). A payload broadcast to a group
+    reaches every consumer of the group, with a shared payload id it is encoded (and compressed)
+    once per format, not once per socket.
+    """
+    def __init__(self, max_size: int = 1024):
+        self.max_size: int = max_size
+        self.entries: collections.OrderedDict = collections.OrderedDict()
+        self.hits = metrics.counter('wire.cache.hits')
+        self.misses = metrics.counter('wire.cache.misses')
+
+    def encode(self, wire_format: WireFormat, payload: typing.Any, payload_id: typing.AnyStr = None):
+        if payload_id is None:
+            return wire_format.encode(payload)
+        key = (payload_id, wire_format.name)
+        data = self.entries.get(key)
+        if data is not None:
+            self.hits.inc()
+            self.entries.move_to_end(key)
+            return data
+        self.misses.inc()
+        data = wire_format.encode(payload)
+        self.entries[key] = data
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return data
+
+
+encoded_cache = EncodedCache(settings.WIRE_FORMAT['cache_size'])
+
+
+def new_payload_id() -> typing.AnyStr:
+    return uuid.uuid4().hex
+
+
+class WireFormatMixin:
+    """
+    Per connection wire format for websocket consumers, negotiated through the websocket
+    subprotocol at connect time, clients offering none get plain json text frames.
+    """
+    wire_format: WireFormat = DEFAULT_FORMAT
+
+    rejected = metrics.counter('wire.rejected')
+
+    async def accept_with_wire_format(self):
+        wire_format = negotiate(self.scope.get('subprotocols') or [])
+        if wire_format is None:
+            self.wire_format = DEFAULT_FORMAT
+            await self.accept()
+        else:
+            self.wire_format = wire_format
+            await self.accept(subprotocol=wire_format.subprotocol)
+
+    async def send_payload(self, payload: typing.Any, payload_id: typing.AnyStr = None):
+        data = encoded_cache.encode(self.wire_format, payload, payload_id)
+        self.wire_format.bytes_out.inc(len(data))
+        if self.wire_format.binary:
+            await self.send(bytes_data=data)
+        else:
+            await self.send(text_data=data)
+
+    async def decode_frame(self, text_data=None, bytes_data=None) -> typing.Any:
+        """decoded client frame, None for a frame that can not be decoded, answered like invalid data"""
+        try:
+            if bytes_data is not None:
+                return self.wire_format.decode(bytes_data)
+            return await loads_frame(text_data)
+        except UNDECODABLE:
+            self.rejected.inc()
+            return None
@@ -8,21 +8,34 @@ https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
 """
 
 import os
+from django.urls import re_path
 from django.core.asgi import get_asgi_application
-from channels.routing import ProtocolTypeRouter, URLRouter
-
-from core.asgi_middleware import TokenAuthMiddlewareStack
-import chat.routing as chat_routing
-import core.routing as core_routing
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'light.settings')
+# set up django (apps registry, settings) before anything importing models is loaded
+django_asgi_application = get_asgi_application()
+
+from channels.routing import ProtocolTypeRouter, URLRouter  # noqa: E402
+
+from core.asgi_middleware import TokenAuthMiddlewareStack  # noqa: E402
+from core.asgi_middleware import lifespan  # noqa: E402
+from core.asgi_middleware import LifespanFallbackMiddleware  # noqa: E402
+import chat.routing as chat_routing  # noqa: E402
+import core.routing as core_routing  # noqa: E402
 
-application = ProtocolTypeRouter({
-    'http': get_asgi_application(),
+# daphne does not speak the lifespan protocol, the startup hooks run from the first request and the
+# shutdown hooks on the stop signals of LIFESPAN_FALLBACK
+application = LifespanFallbackMiddleware(ProtocolTypeRouter({
+    'http': URLRouter(
+        core_routing.http_urlpatterns + [
+            re_path(r'', django_asgi_application),
+        ]
+    ),
+    'lifespan': lifespan,
     'websocket': TokenAuthMiddlewareStack(
         URLRouter(
             chat_routing.websocket_urlpatterns +
             core_routing.websocket_urlpatterns
         )
     )
-})
+}), lifespan)
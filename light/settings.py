@@ -42,8 +42,8 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'channels',
-    'accounts',
-    'core',
+    'accounts.apps.AccountsConfig',
+    'core.apps.CoreConfig',
     'chat',
 ]
 
@@ -82,12 +82,20 @@ ASGI_APPLICATION = 'light.asgi.application'
 
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        # channels_redis with groups and channels spread over the hosts by consistent hashing
+        'BACKEND': 'core.layers.ShardedRedisChannelLayer',
         'CONFIG': {
             'hosts': [
                 'redis://:rpassword@127.0.0.1:6379/0',
             ],
+            'prefix': f'{PROJECT_TAG}:asgi:',
+            'vnodes': 160,
             'capacity': 5000,
+            # process control channels of priority lanes (core.lanes), glob patterns: share the queue
+            # of their process, above the default capacity control messages get in once bulk filled it
+            'channel_capacity': {
+                '*!control': 6000,
+            },
         },
     },
 }
@@ -100,6 +108,7 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'CONN_MAX_AGE': 60,  # connections of the 'db' offload pool threads are reused
     }
 }
 
@@ -148,6 +157,18 @@ STATIC_ROOT = f'/tmp/{PROJECT_TAG}/static_root/'  # Change this as needed
 # Use email to identify a user
 AUTH_USER_MODEL = 'accounts.User'
 
+# Redis nodes sharing user and room keys (AsyncDBRedis...) by consistent hashing, see core.sharding.
+# After adding or removing nodes, move the keys with the rebalance_redis command
+REDIS_SHARDS = {
+    'nodes': {
+        'node0': {'address': 'redis://localhost', 'db': 15, 'password': 'rpassword'},
+    },
+    'vnodes': 160,  # points of every node on the ring, more spreads keys more evenly
+    # nodes before the last change of 'nodes', read from until rebalance_redis moved their keys,
+    # see core.sharding
+    'previous_nodes': None,
+}
+
 EXCHANGE_LAYER = {
     'q': 'AsyncQRedis',  # used to receive user input, and pub updates to user
     'conn_args': {
@@ -157,3 +178,173 @@ EXCHANGE_LAYER = {
     }
 }
 
+
+# Periodic snapshot of live state, memory mapped on startup for warm restart
+STATE_SNAPSHOT = {
+    'dir': f'/tmp/{PROJECT_TAG}/snapshots/',
+    'interval': 60,  # seconds
+}
+
+# Write behind of live state mutations to its AsyncDB, see core.async_db.write_behind
+WRITE_BEHIND = {
+    'max_batch_size': 500,
+    'flush_interval': 1.0,  # seconds
+}
+
+# Executors for cpu heavy or GIL releasing work, see core.offload
+OFFLOAD_POOLS = {
+    'cpu': {
+        'kind': 'process',
+        'max_workers': 2,
+        'max_pending': 64,  # calls in flight, more callers wait on the event loop
+    },
+    'io': {
+        'kind': 'thread',
+        'max_workers': 4,
+        'max_pending': 64,
+    },
+    # queries of core.async_db.db_orm, one database connection per thread
+    'db': {
+        'kind': 'thread',
+        'max_workers': 4,
+        'max_pending': 256,
+    },
+}
+
+# inbound websocket frames at least this long are parsed in the 'cpu' offload pool
+OFFLOAD_FRAME_THRESHOLD = 256 * 1024
+
+# Websocket wire formats, see core.wire
+WIRE_FORMAT = {
+    'compress_level': 6,  # zlib level of the *.deflate formats
+    'cache_size': 1024,  # encoded broadcast payloads kept for reuse across sockets
+    'max_frame': 1024 * 1024,  # bytes an inbound compressed frame may inflate to, larger ones are rejected
+}
+
+# Inbound websocket frames, token buckets: rate is frames per second, burst the bucket size
+RATE_LIMIT = {
+    'user': {'rate': 10, 'burst': 20},
+    'room': {'rate': 200, 'burst': 400},
+    'max_buckets': 100000,  # per registry, least recently used buckets are dropped
+    'max_strikes': 50,  # consecutive frames over the limit before the socket is closed
+    # optional cluster wide counters, e.g.
+    # {'conn_args': {'address': 'redis://localhost', 'db': 15, 'password': 'rpassword'},
+    #  'window': 1, 'user_limit': 20}
+    'redis': None,
+}
+
+# Refuse new websocket connections when the process is overloaded
+ADMISSION = {
+    'max_connections': 10000,
+    'max_loop_lag': 0.5,  # seconds
+}
+
+# Shared timer wheel for per connection timers, see core.timer_wheel
+TIMER_WHEEL = {
+    'tick': 0.1,  # seconds
+    'wheel_sizes': (256, 64, 64, 64),  # slots per level, level 0 covers 25.6s with 0.1s ticks
+    'heartbeat_interval': 25,  # seconds
+    # seconds without any inbound frame before a socket is closed, 'pong' answers to heartbeats included
+    'idle_timeout': 300,
+}
+
+# Presence of connected users and room members, see core.presence
+PRESENCE = {
+    # aioredis conn args of the cluster wide index, None keeps presence local to the process
+    'redis': None,
+    'ttl': 30,  # seconds an entry lives without heartbeat, entries of crashed processes expire
+    'heartbeat_interval': 10,  # seconds
+}
+
+STATE_TOPICS = {
+    # state path subscriptions a single websocket connection may hold
+    'max_subscriptions': 100,
+}
+
+# Chat room history, see chat.history
+CHAT_HISTORY = {
+    'per_room': 100,  # messages kept in memory for every warm room, replayed on join
+    'max_messages': 100000,  # messages kept in memory over all rooms, coldest rooms are evicted
+    'max_length': 10000,  # messages kept in redis for every room
+    # aioredis conn args of the durable history, None keeps history in process memory only
+    'redis': None,
+}
+
+CHAT_MULTIPLEX = {
+    # rooms a single multiplexed websocket connection may join
+    'max_rooms': 50,
+}
+
+# Import budget of an ASGI worker, checked by tests and the bench_startup command, see core.startup
+STARTUP_BUDGET = {
+    'module': 'light.asgi',
+    'seconds': 2.0,  # cumulative import time of the module, generous for slow CI machines
+    'modules': 1200,  # modules loaded in total, interpreter start up included
+    # heavy optional subsystems, imported on first use only
+    'lazy': ('openpyxl', 'pandas', 'aioredis', 'aioelasticsearch', 'aiokafka'),
+}
+
+# Logging of the project loggers through a queue drained by a background thread, see core.log
+QUEUE_LOGGING = {
+    'loggers': ('core', 'chat', 'accounts'),
+    'level': 'INFO',
+    'max_queue_size': 10000,  # records waiting for the writer thread, newer records are dropped
+    'json': False,  # one json object per line instead of plain text
+    # keep 1 in n records below WARNING of these loggers (per call site), for per message events
+    'sample_rates': {
+        'core.consumers': 100,
+        'chat.consumers': 100,
+    },
+}
+
+# Batched, cached User lookups of async code, see accounts.loaders
+USER_LOADER = {
+    'ttl': 30,  # seconds a loaded user is cached, saving the user drops it earlier
+    'max_size': 10000,
+}
+
+# Event loop lag of the worker, see core.metrics.loop
+LOOP_MONITOR = {
+    'interval': 0.1,  # seconds between lag measures
+    'slow_threshold': 0.1,  # blocks longer than this are recorded with their stack and handler
+    'max_records': 100,
+}
+
+# On demand sampling of the event loop thread, GET /debug/loop/profile?seconds=N (staff)
+LOOP_PROFILER = {
+    'interval': 0.005,  # seconds between samples
+    'max_seconds': 60,
+}
+
+# Client supplied message ids ({"message": ..., "id": ...}) seen again within the window are
+# not fanned out twice, see core.dedup
+MESSAGE_DEDUP = {
+    'window': 60,  # seconds
+    'capacity': 100000,  # ids expected per half window, the error rate holds up to it
+    'error_rate': 0.001,  # false positives of the filter, each one costs an id store lookup
+    # last ids kept in the process to confirm filter hits when there is no redis store, about 140
+    # bytes each: a hit on an id pushed out is trusted, a false positive then drops a new message
+    'exact_size': 10000,
+    # optional store shared by every process, e.g.
+    # {'conn_args': {'address': 'redis://localhost', 'db': 15, 'password': 'rpassword'}}
+    'redis': None,
+}
+
+# Drain mode on worker shutdown, see core.drain
+DRAIN = {
+    'timeout': 10,  # seconds in-flight handler tasks get to finish, then they are cancelled
+    # clients reconnect after a delay spread over this range, in seconds
+    'reconnect_min': 1,
+    'reconnect_max': 30,
+    'close_code': 1012,  # service restart
+    # drain on this signal ahead of the shutdown, the worker keeps running refusing connections,
+    # None to only drain on lifespan shutdown
+    'signal_name': 'SIGUSR1',
+}
+
+# Servers without the lifespan protocol (daphne): the shutdown hooks run on these signals, handled
+# ahead of the server's own handlers, e.g. ('SIGTERM', 'SIGINT'). Empty leaves the process's handlers alone,
+# the hooks then only run under servers sending the lifespan scope
+LIFESPAN_FALLBACK = {
+    'signal_names': (),
+}